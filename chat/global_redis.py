@@ -4,62 +4,33 @@ from datetime import datetime
 import logging
 
 import redis
-import tornadoredis
+from django.conf import settings
 
 from chat.models import get_milliseconds
-from chat.settings import ALL_REDIS_ROOM, REDIS_PORT, REDIS_HOST, REDIS_DB
+from chat.settings import REDIS_PORT, REDIS_HOST, REDIS_DB, REDIS_POOL_SIZE, MESSAGES_CACHE_SIZE, MESSAGES_CACHE_TTL, \
+	LAST_READ_BATCH_SIZE, COMPACT_PUBSUB, WEBRTC_CONNECTION, WEBRTC_CONNECTION_TTL, WEBRTC_SWEEP_BATCH_SIZE, \
+	SESSION_CACHE_SIZE, SESSION_CACHE_TTL, FIREBASE_URL, PUSH_BATCH_SIZE, PUSH_BATCH_INTERVAL, PUSH_QUEUE_SIZE, \
+	PUSH_RETRIES, PUSH_RETRY_DELAY, WS_REPLAY_SIZE, WS_REPLAY_TTL, WS_REPLAY_GRACE, PREVIEW_WORKERS, PREVIEW_SIZE, \
+	PREVIEW_QUALITY, PREVIEW_QUEUE_SIZE, PREVIEW_FFMPEG
 from chat.settings_base import ALL_ROOM_ID
+from chat.tornado import compact_protocol
 from chat.tornado.constants import RedisPrefix
 from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.cluster import ClusterNode
+from chat.tornado.last_read_queue import LastReadQueue
+from chat.tornado.messages_cache import MessagesCache
+from chat.tornado.preview_pool import PreviewPool
+from chat.tornado.push_queue import PushQueue
+from chat.tornado.redis_client import AsyncRedis
+from chat.tornado.replay_log import ReplayLog
+from chat.tornado.session_cache import SessionCache
+from chat.tornado.subscription_hub import SubscriptionHub
+from chat.tornado.user_directory import UserDirectory
+from chat.tornado.webrtc_state import WebRtcConnections, WebRtcSweeper
 
 logger = logging.getLogger(__name__)
 
 
-def new_read(instance, *args, **kwargs):
-	try:
-		return instance.old_read(*args, **kwargs)
-	except Exception as e:
-		redis_online = sync_redis.hgetall(ALL_REDIS_ROOM)
-		logger.warning("Error occurred during reading tornadoredis connection. Redis online  %s", redis_online)
-		raise e
-
-
-def patch_read(tornado_redis):
-	fabric = type(tornado_redis.connection.read)
-	tornado_redis.connection.old_read = tornado_redis.connection.read
-	tornado_redis.connection.read = fabric(new_read, tornado_redis.connection)
-
-
-def new_hget(instance, *args, **kwargs):
-	res = instance.hget(*args, **kwargs)
-	return res.decode('utf-8') if res else None
-
-
-def patch_hget(arg_red):
-	fabric = type(arg_red.hget)
-	arg_red.shget = fabric(new_hget, arg_red)
-
-
-def patch_hgetall(arg_red):
-	fabric = type(arg_red.hgetall)
-	arg_red.shgetall = fabric(new_hgetall, arg_red)
-
-
-def new_hgetall(instance, *args, **kwargs):
-	res = instance.hgetall(*args, **kwargs) # neither key or value are null
-	return {k.decode('utf-8'): res[k].decode('utf-8') for k in res}
-
-
-def patch_smembers(arg_red):
-	fabric = type(arg_red.smembers)
-	arg_red.ssmembers = fabric(new_smembers, arg_red)
-
-
-def new_smembers(instance, *args, **kwargs):
-	res = instance.smembers(*args, **kwargs) # neither key or value are null
-	return [k.decode('utf-8') for k in res]
-
-
 def encode_message(message, parsable):
 	"""
 	@param parsable: Marks message with prefix to specify that
@@ -67,7 +38,10 @@ def encode_message(message, parsable):
 	@param message: message to mark
 	@return: marked message
 	"""
-	jsoned_mess = json.dumps(message)
+	if COMPACT_PUBSUB:
+		jsoned_mess = compact_protocol.dumps(message)
+	else:
+		jsoned_mess = json.dumps(message)
 	if parsable:
 		jsoned_mess = RedisPrefix.PARSABLE_PREFIX + jsoned_mess
 	return jsoned_mess
@@ -78,18 +52,51 @@ def remove_parsable_prefix(message):
 		return message[1:]
 
 
+def publish_logout(user_ids):
+	for user_id in user_ids:
+		async_redis.publish(ALL_ROOM_ID, encode_message(MessagesCreator.user_logout(user_id), False))
+
+
+def publish_message(channel, message):
+	async_redis.publish(channel, encode_message(message, False))
+
+
 def ping_online():
 	message = encode_message(MessagesCreator.ping_client(get_milliseconds()), True)
 	logger.info("Pinging clients: %s", message)
-	async_redis_publisher.publish(ALL_ROOM_ID, message)
+	async_redis.publish(ALL_ROOM_ID, message)
 
 
-# # global connection to read synchronously
+# blocking connection, only for db executor threads and management commands
 sync_redis = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-patch_hget(sync_redis)
-patch_hgetall(sync_redis)
-patch_smembers(sync_redis)
-# patch(sync_redis)
-# Redis connection cannot be shared between publishers and subscribers.
-async_redis_publisher = tornadoredis.Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
-patch_read(async_redis_publisher)
\ No newline at end of file
+# everything that runs on IOLoop uses this one
+async_redis = AsyncRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_POOL_SIZE)
+cluster_node = ClusterNode(async_redis, publish_logout)
+user_directory = UserDirectory(sync_redis)
+messages_cache = MessagesCache(sync_redis, async_redis, MESSAGES_CACHE_SIZE, MESSAGES_CACHE_TTL)
+last_read_queue = LastReadQueue(sync_redis, async_redis, LAST_READ_BATCH_SIZE)
+session_cache = SessionCache(sync_redis, async_redis, SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+webrtc_connections = WebRtcConnections(async_redis, WEBRTC_CONNECTION, WEBRTC_CONNECTION_TTL)
+webrtc_sweeper = WebRtcSweeper(async_redis, WEBRTC_CONNECTION, WEBRTC_SWEEP_BATCH_SIZE)
+push_queue = PushQueue(
+	async_redis,
+	getattr(settings, 'FIREBASE_API_KEY', None),
+	FIREBASE_URL,
+	PUSH_BATCH_SIZE,
+	PUSH_BATCH_INTERVAL,
+	PUSH_QUEUE_SIZE,
+	PUSH_RETRIES,
+	PUSH_RETRY_DELAY
+)
+preview_pool = PreviewPool(
+	publish_message,
+	messages_cache,
+	PREVIEW_WORKERS,
+	PREVIEW_SIZE,
+	PREVIEW_QUALITY,
+	PREVIEW_QUEUE_SIZE,
+	PREVIEW_FFMPEG
+)
+replay_log = ReplayLog(async_redis, WS_REPLAY_SIZE, WS_REPLAY_TTL, WS_REPLAY_GRACE)
+# Single subscriber connection shared by all websockets of this process
+subscription_hub = SubscriptionHub(REDIS_HOST, REDIS_PORT, REDIS_DB)
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management import BaseCommand
+
+from chat.media_store import media_store
+from chat.models import UploadedFile
+
+
+class Command(BaseCommand):
+	help = 'Removes uploaded files that have not been sent in a message, so media store can release them'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--hours',
+			dest='hours',
+			default=24,
+			type=int,
+			help='Files uploaded earlier than this are removed'
+		)
+
+	def handle(self, *args, **options):
+		before = int((time.time() - options['hours'] * 3600) * 1000)
+		removed = 0
+		while True:
+			files = list(UploadedFile.objects.filter(time__lt=before).values_list('id', 'file')[:1000])
+			if not files:
+				break
+			# deleted rows only, a message could have taken some of them meanwhile
+			for file_id, name in files:
+				if UploadedFile.objects.filter(id=file_id).delete()[0] and name:
+					media_store.release([name])
+					removed += 1
+		print("Removed %d uploaded files that haven't been sent" % removed)
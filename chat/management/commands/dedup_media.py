@@ -0,0 +1,47 @@
+import os
+
+from django.core.management import BaseCommand
+
+from chat.media_store import media_store, get_name_hash, hash_file
+from chat.models import UploadedFile, Image, UserProfile, MediaFile
+
+# every field that can point to a file in MEDIA_ROOT
+FIELDS = (
+	(UploadedFile, 'file'),
+	(Image, 'img'),
+	(Image, 'preview'),
+	(UserProfile, 'photo'),
+)
+
+
+class Command(BaseCommand):
+	help = 'Moves files with random names to media store, so every content is kept in MEDIA_ROOT once'
+
+	def handle(self, *args, **options):
+		moved = 0
+		duplicates = 0
+		freed = 0
+		for model, field in FIELDS:
+			names = list(model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True})
+				.values_list(field, flat=True).distinct())
+			for name in names:
+				if get_name_hash(name) is not None:
+					continue  # already in store
+				path = media_store.path(name)
+				if not os.path.isfile(path):
+					print("Skipping %s, file doesn't exist" % name)
+					continue
+				size = os.path.getsize(path)
+				hexdigest = hash_file(path)
+				duplicate = MediaFile.objects.filter(sha256=hexdigest).exists()
+				# the same name can be in a few fields, e.g. UploadedFile that hasn't been moved to Image
+				references = sum(m.objects.filter(**{f: name}).count() for m, f in FIELDS)
+				new_name = media_store.add(path, name, hexdigest, references)
+				for m, f in FIELDS:
+					m.objects.filter(**{f: name}).update(**{f: new_name})
+				if duplicate:
+					duplicates += 1
+					freed += size
+				else:
+					moved += 1
+		print("Moved %d files to store, removed %d duplicates of %d bytes" % (moved, duplicates, freed))
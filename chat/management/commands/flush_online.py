@@ -12,4 +12,5 @@ class Command(BaseCommand):
 
 	def handle(self, *args, **options):
 		from chat.global_redis import sync_redis
-		sync_redis.delete(RedisPrefix.ONLINE_VAR)
\ No newline at end of file
+		nodes = [RedisPrefix.NODE_ONLINE % node_id.decode('utf-8') for node_id in sync_redis.zrange(RedisPrefix.NODES, 0, -1)]
+		sync_redis.delete(RedisPrefix.ONLINE_VAR, RedisPrefix.NODES, *nodes)
\ No newline at end of file
@@ -1,4 +1,6 @@
 from django.core.management.base import BaseCommand
+from tornado import gen
+from tornado.ioloop import IOLoop
 
 from chat.settings import WEBRTC_CONNECTION
 
@@ -9,12 +11,19 @@ class Command(BaseCommand):
 		super(Command, self).__init__()
 	help = 'Removes all information about current webrtc connections status from redis'
 
+	@gen.coroutine
+	def flush(self):
+		from chat.global_redis import webrtc_sweeper
+		total = 0
+		done = False
+		while not done:  # batch by batch, so redis isn't blocked
+			removed, done = yield webrtc_sweeper.sweep(remove_all=True)
+			total += removed
+		return total
+
 	def handle(self, *args, **options):
-		from chat.global_redis import sync_redis
-		webrtc_connections = sync_redis.hgetall(WEBRTC_CONNECTION)
-		if webrtc_connections:
-			sync_redis.delete(*webrtc_connections.keys())
-			sync_redis.delete(WEBRTC_CONNECTION)
-			print('Flushed webrtc connections: {}'.format(webrtc_connections))
+		total = IOLoop.current().run_sync(self.flush)
+		if total:
+			print('Flushed {} webrtc connections'.format(total))
 		else:
 			print("There're no connections to flush in '{}' redis key, skipping...".format(WEBRTC_CONNECTION))
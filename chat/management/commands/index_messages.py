@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from chat.models import Message
+from chat.utils import index_message
+
+
+class Command(BaseCommand):
+	help = 'Rebuilds search index of all messages, used by search_messages'
+
+	def handle(self, *args, **options):
+		last_id = 0
+		while True:
+			messages = list(Message.objects.filter(id__gt=last_id).order_by('id')[:1000])
+			if not messages:
+				break
+			for message in messages:
+				index_message(message)
+			last_id = messages[-1].id
+			print("Indexed messages up to id %d" % last_id)
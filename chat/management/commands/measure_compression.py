@@ -0,0 +1,54 @@
+import json
+import time
+import zlib
+
+from django.core.management import BaseCommand
+
+from chat.models import Message, Room
+from chat.tornado.message_creator import MessagesCreator
+from chat.utils import get_message_images_videos
+
+
+class Command(BaseCommand):
+	help = 'Measures websocket permessage-deflate on loadMessages payloads of the biggest rooms, ' \
+		'prints compression ratio and cpu time for every level and memory level'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--rooms', dest='rooms', default=10, type=int)
+		parser.add_argument('--count', dest='count', default=10, type=int, help='messages per payload like loadMessages')
+
+	def handle(self, *args, **options):
+		payloads = []
+		for room in Room.objects.all()[:options['rooms']]:
+			messages = list(Message.objects.filter(room_id=room.id).order_by('-pk')[:options['count']])
+			imv = get_message_images_videos(messages)
+			response = MessagesCreator.get_messages(messages, room.id, imv, MessagesCreator.prepare_img_video, 1)
+			payloads.append(json.dumps(response).encode('utf-8'))
+			for message in messages:  # single messages as they're broadcasted
+				payloads.append(json.dumps(MessagesCreator.create_message(message, None)).encode('utf-8'))
+		total = sum(len(p) for p in payloads)
+		print("%d payloads, %d bytes" % (len(payloads), total))
+		print("level mem  context  bytes      ratio   ms")
+		for context_takeover in (True, False):
+			for level in (1, 3, 6, 9):
+				for mem_level in (4, 8, 9):
+					compressed, spent = self.measure(payloads, level, mem_level, context_takeover)
+					print("%-5d %-4d %-8s %-10d %5.1f%% %7.2f" % (
+						level, mem_level, context_takeover, compressed, 100.0 * compressed / max(total, 1), spent * 1000
+					))
+
+	@staticmethod
+	def measure(payloads, level, mem_level, context_takeover):
+		"""
+		Compresses payloads the same way tornado _PerMessageDeflateCompressor does
+		:return: (compressed bytes, seconds)
+		"""
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+		size = 0
+		start = time.time()
+		for payload in payloads:
+			if not context_takeover:
+				compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+			data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			size += len(data) - 4
+		return size, time.time() - start
@@ -2,7 +2,8 @@ import json
 from chat.py2_3 import urlopen
 
 from chat import settings
-from chat.models import IpAddress
+from chat.global_redis import user_directory
+from chat.models import IpAddress, UserJoinedInfo
 
 api_url = getattr(settings, "IP_API_URL", "http://ip-api.com/json/%s")
 
@@ -30,3 +31,5 @@ class Command(BaseCommand):
 				ip.save()
 			except Exception as e:
 				print("Skip %s because %s" % (ip, e))
+		for user_id in UserJoinedInfo.objects.values_list('user_id', flat=True).distinct():
+			user_directory.mark_changed(user_id)
@@ -1,18 +1,19 @@
+import os
+import socket
 import time
 
 import signal
 from django.conf import settings
-from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from tornado import gen
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.web import Application, StaticFileHandler
-from chat.global_redis import ping_online
-from chat.tornado.http_handler import HttpHandler
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+from tornado.web import Application
 import logging
 
 TORNADO_SSL_OPTIONS = getattr(settings, "TORNADO_SSL_OPTIONS", None)
-from chat.tornado.tornado_handler import TornadoHandler
 
 
 logger = logging.getLogger(__name__)
@@ -40,39 +41,101 @@ class Command(BaseCommand):
 			action='store_true',
 			dest='keep_online',
 			default=False,
-			help='Execute flush command as well',
+			help='Don\'t remove online users left by the previous run of this process',
+		)
+		parser.add_argument(
+			'--workers',
+			dest='workers',
+			default=1,
+			type=int,
+			help='Amount of processes that share the port, 0 for the number of cpus',
 		)
 
 	def sig_handler(self, a, b):
 		"""Catch signal and init callback"""
 		IOLoop.instance().add_callback(self.shutdown)
 
+	@gen.coroutine
 	def shutdown(self):
-		"""Stop server and add callback to stop i/o loop"""
+		"""Stop server, write pending last read messages and add callback to stop i/o loop"""
+		from chat.global_redis import last_read_queue, cluster_node, push_queue, preview_pool
 		self.http_server.stop()
+		yield last_read_queue.flush()
+		yield push_queue.flush()
+		preview_pool.shutdown()
+		yield cluster_node.stop()
 		io_loop = IOLoop.instance()
 		io_loop.add_timeout(time.time() + 2, io_loop.stop)
 
+	@gen.coroutine
+	def heartbeat(self):
+		from chat.global_redis import cluster_node
+		if self.parent_pid is not None and os.getppid() != self.parent_pid:
+			logger.warning("Parent process %s has exited, stopping worker", self.parent_pid)
+			self.parent_pid = None
+			IOLoop.instance().add_callback(self.shutdown)
+		try:
+			yield cluster_node.heartbeat(settings.CLUSTER_NODE_TIMEOUT)
+		except Exception as e:
+			logger.error("Unable to send heartbeat, because %s", e)
+
+	def ping(self):
+		from chat.global_redis import ping_online, cluster_node
+		if cluster_node.is_leader:
+			ping_online()
+
+	@gen.coroutine
+	def sweep_webrtc(self):
+		from chat.global_redis import webrtc_sweeper, cluster_node
+		if cluster_node.is_leader:
+			removed, _ = yield webrtc_sweeper.sweep()
+			if removed:
+				logger.info("Removed %d stale webrtc connections", removed)
+
 	def handle(self, *args, **options):
+		port = options['port']
+		host = options['host']
+		workers = options['workers']
+		task_id = 0
+		sockets = None
+		self.parent_pid = None
+		if workers != 1:
+			if not hasattr(socket, 'SO_REUSEPORT'):
+				# accept queue is shared by all workers
+				sockets = bind_sockets(port, host)
+			self.parent_pid = os.getpid()
+			# IOLoop is created on import of handlers and redis clients, so they're imported after fork
+			task_id = fork_processes(workers)
+		if sockets is None:
+			# every worker has its own accept queue, kernel balances connections between them
+			sockets = bind_sockets(port, host, reuse_port=workers != 1)
+		from chat.global_redis import last_read_queue, cluster_node, session_cache, subscription_hub
+		from chat.tornado.constants import RedisPrefix
+		from chat.tornado.http_handler import HttpHandler, UploadHandler, MediaFileHandler
+		from chat.tornado.tornado_handler import TornadoHandler
 		application = Application([
+			(r'/api/(?:upload_file|upload_profile_image)', UploadHandler),
 			(r'/api/.*', HttpHandler),
-			(r'/photo/(.*)', StaticFileHandler, {'path': settings.MEDIA_ROOT}),
+			(r'/photo/(.*)', MediaFileHandler, {'path': settings.MEDIA_ROOT}),
 			(r'/ws', TornadoHandler),
-		], debug=settings.DEBUG, default_host=options['host'])
-		self.http_server = HTTPServer(application, ssl_options=TORNADO_SSL_OPTIONS, max_buffer_size=1000000000) # 1GB, limit in nginx if u need
-		self.http_server.bind(options['port'], options['host'])
-		print('tornado server started at {}:{}'.format(options['host'], options['port']))
-		#  uncomment me for multiple process
-		self.http_server.start(1)
+		], debug=settings.DEBUG and workers == 1, default_host=host)
+		self.http_server = HTTPServer(application, ssl_options=TORNADO_SSL_OPTIONS, max_buffer_size=settings.HTTP_MAX_BUFFER_SIZE)
+		node_id = '%s:%d:%d' % (socket.gethostname(), port, task_id)
+		# online of the previous process with this node id is flushed before its clients reconnect here
+		IOLoop.instance().run_sync(lambda: cluster_node.start(node_id, not options['keep_online']))
+		self.heartbeat()
+		PeriodicCallback(self.heartbeat, settings.CLUSTER_HEARTBEAT_INTERVAL).start()
+		# every process checks whether it's the leader, so pinger moves if leader dies
+		PeriodicCallback(self.ping, settings.PING_INTERVAL).start()
+		PeriodicCallback(self.sweep_webrtc, settings.WEBRTC_SWEEP_INTERVAL).start()
+		# logout in any process drops the session from cache of this one
+		subscription_hub.subscribe(session_cache, [RedisPrefix.SESSIONS_CHANNEL])
+		last_read_queue.init_last_message()
+		PeriodicCallback(last_read_queue.flush, settings.LAST_READ_FLUSH_INTERVAL).start()
+		# connections are accepted only when node is registered in cluster
+		self.http_server.add_sockets(sockets)
+		print('tornado server {} started at {}:{}'.format(task_id, host, port))
 		# Init signals handler
-		if not options['keep_online']:
-			call_command('flush_online')
-		if not hasattr(settings, 'MAIN_TORNADO_PROCESS_PORT') \
-				or settings.MAIN_TORNADO_PROCESS_PORT == options['port']:
-			logger.info("Starting pinger")
-			PeriodicCallback(ping_online, settings.PING_INTERVAL).start()
-		else:
-			logger.info("Skipping pinger for this instance")
 		signal.signal(signal.SIGTERM, self.sig_handler)
 		# This will also catch KeyboardInterrupt exception
 		IOLoop.instance().start()
@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from chat.models import MediaFile
+
+logger = logging.getLogger(__name__)
+
+# ab/cd/abcd...64 hex chars.ext
+HASH_NAME_REGEX = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]{1,10})?$')
+EXTENSION_REGEX = re.compile(r'^\.[a-z0-9]{1,10}$')
+READ_CHUNK_SIZE = 1024 * 1024
+
+# File that is not in MEDIA_ROOT yet, hexdigest is None if it's not known
+Upload = namedtuple('Upload', ('path', 'filename', 'hexdigest'))
+
+
+def get_hash_name(hexdigest, filename):
+	"""
+	:param filename: only its extension is used
+	:return: name relative to MEDIA_ROOT, first 2 levels of hash are directories so none of them gets too big
+	"""
+	extension = os.path.splitext(filename)[1].lower()
+	if not EXTENSION_REGEX.match(extension):
+		extension = ''
+	return '{}/{}/{}{}'.format(hexdigest[:2], hexdigest[2:4], hexdigest, extension)
+
+
+def get_name_hash(name):
+	"""
+	:return: sha256 of a name from get_hash_name, None for names of files that are not in the store
+	"""
+	match = HASH_NAME_REGEX.match(name or '')
+	return match.group(1) if match else None
+
+
+def hash_file(path):
+	sha256 = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+
+class MediaStore(object):
+	"""
+	Content addressed files of MEDIA_ROOT. Every content is stored once under its sha256,
+	MediaFile row counts fields that point to it and the file is removed with the last reference.
+	Blocking, runs in db executor.
+	"""
+
+	def __init__(self, media_root):
+		self.media_root = media_root
+
+	def path(self, name):
+		return os.path.join(self.media_root, name)
+
+	def add(self, path, filename, hexdigest=None, references=1):
+		"""
+		Moves file at path to the store, or removes it if the same content is already there
+		:param filename: original name of the file, extension of the stored file is taken from it
+		:param references: amount of fields that are going to point to the file
+		:return: name relative to MEDIA_ROOT that should be saved to the fields
+		"""
+		if hexdigest is None:
+			hexdigest = hash_file(path)
+		size = os.path.getsize(path)
+		while True:
+			stored = MediaFile.objects.filter(sha256=hexdigest).values_list('id', 'name').first()
+			if stored is not None:
+				# the last reference could've been released since the row was read
+				if MediaFile.objects.filter(id=stored[0]).update(references=F('references') + references):
+					if os.path.abspath(path) != os.path.abspath(self.path(stored[1])):
+						os.remove(path)
+					logger.debug("%s is a duplicate of %s", filename, stored[1])
+					return stored[1]
+			else:
+				name = get_hash_name(hexdigest, filename)
+				try:
+					MediaFile.objects.create(sha256=hexdigest, name=name, size=size, references=references)
+				except IntegrityError:
+					continue  # the same content is being added by another thread
+				target = self.path(name)
+				if os.path.abspath(path) != os.path.abspath(target):
+					os.makedirs(os.path.dirname(target), exist_ok=True)
+					shutil.move(path, target)
+				return name
+
+	def add_upload(self, upload):
+		"""
+		:type upload: Upload
+		"""
+		return self.add(upload.path, upload.filename, upload.hexdigest)
+
+	def add_content(self, content, filename):
+		"""
+		:param content: bytes of the file
+		"""
+		fd, path = tempfile.mkstemp(dir=self.media_root)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(content)
+		return self.add(path, filename, hashlib.sha256(content).hexdigest())
+
+	def release(self, names):
+		"""
+		Fields that pointed to names don't do it anymore. Names that aren't in the store are ignored.
+		The last reference removes the file while the row is locked, so add of the same content
+		waits for it and stores the content again
+		"""
+		for name in names:
+			hexdigest = get_name_hash(name)
+			if hexdigest is None:
+				continue
+			with transaction.atomic():
+				stored = MediaFile.objects.select_for_update().filter(sha256=hexdigest).values_list('id', 'references').first()
+				if stored is None:
+					logger.warning("Released %s is not in media store", name)
+				elif stored[1] > 1:
+					MediaFile.objects.filter(id=stored[0]).update(references=F('references') - 1)
+				else:
+					MediaFile.objects.filter(id=stored[0]).delete()
+					try:
+						os.remove(self.path(name))
+					except OSError as e:
+						logger.warning("Unable to remove %s, because %s", name, e)
+
+
+media_store = MediaStore(settings.MEDIA_ROOT)
@@ -235,6 +235,8 @@ class UploadedFile(models.Model):
 	file = FileField(upload_to=get_random_path, null=True)
 	user = models.ForeignKey(User, models.CASCADE, null=False)
 	type = models.CharField(null=False, max_length=1)
+	# files that haven't been sent for a long time are removed by clean_uploads
+	time = models.BigIntegerField(default=get_milliseconds)
 
 	@property
 	def type_enum(self):
@@ -270,6 +272,35 @@ class Image(models.Model):
 		unique_together = ('symbol', 'message')
 
 
+class MediaFile(models.Model):
+	"""
+	File in MEDIA_ROOT stored by sha256 of its content, so the same content is kept once.
+	references is amount of UploadedFile.file, Image.img, Image.preview and UserProfile.photo that point to it,
+	they are released when photo is changed, message is deleted and upload isn't sent, see clean_uploads
+	"""
+	sha256 = models.CharField(null=False, max_length=64, unique=True)
+	name = models.CharField(null=False, max_length=100)
+	size = models.BigIntegerField(null=False)
+	references = models.IntegerField(null=False, default=0)
+
+	class Meta:  # pylint: disable=C1001
+		db_table = ''.join((User._meta.app_label, '_media_file'))
+
+
+class MessageSearchToken(models.Model):
+	"""
+	Inverted index of words in messages content, room is copied from message
+	so search within a room is a single index range
+	"""
+	token = models.CharField(null=False, max_length=32)
+	room = models.ForeignKey(Room, models.CASCADE, null=False)
+	message = models.ForeignKey(Message, models.CASCADE, null=False)
+
+	class Meta:  # pylint: disable=C1001
+		index_together = ('room', 'token', 'message')
+		db_table = ''.join((User._meta.app_label, '_message_search_token'))
+
+
 class RoomUsers(models.Model):
 	room = models.ForeignKey(Room, models.CASCADE, null=False)
 	user = models.ForeignKey(User, models.CASCADE, null=False)
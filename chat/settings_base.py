@@ -44,6 +44,8 @@ EMAIL_SUBJECT_PREFIX = '[Pychat] '
 REDIS_PORT = 6379
 REDIS_HOST ='localhost'
 REDIS_DB = 0
+# Connections of non-blocking redis client in every tornado process, commands are pipelined over them
+REDIS_POOL_SIZE = 2
 REDIS_SESSION_DB = 3
 
 
@@ -77,9 +79,103 @@ GIPHY_REGEX = r"^\s*\/giphy (.+)"
 AUTH_USER_MODEL = 'chat.User'
 
 FIREBASE_URL = 'https://fcm.googleapis.com/fcm/send'
+# Messages sent within this interval in ms are notified together, every device gets a single push
+PUSH_BATCH_INTERVAL = 1000
+# Max registration ids in a single FireBase request, 1000 is the limit of FCM
+PUSH_BATCH_SIZE = 1000
+# Messages waiting for the next batch, notifications of the rest are skipped
+PUSH_QUEUE_SIZE = 10000
+# Failed requests are retried PUSH_RETRIES times, the first retry after PUSH_RETRY_DELAY ms, then delay doubles
+PUSH_RETRIES = 5
+PUSH_RETRY_DELAY = 1000
 
 CONCURRENT_THREAD_WORKERS = 10
 
+# Processes of every tornado worker that generate previews of sent images and videos (python 3.7+), 0 disables previews
+PREVIEW_WORKERS = 2
+# Max width and height of preview in px, and its jpeg quality 1..95
+PREVIEW_SIZE = 400
+PREVIEW_QUALITY = 75
+# Images waiting for a preview process, previews of the rest are skipped
+PREVIEW_QUEUE_SIZE = 1000
+# Executable that extracts poster frames of videos, None disables previews of videos
+PREVIEW_FFMPEG = 'ffmpeg'
+
+# Bodies of api requests are kept in memory, uploads are streamed to MEDIA_ROOT and limited by UPLOAD_MAX_SIZE
+HTTP_MAX_BUFFER_SIZE = 10 * 1024 * 1024
+UPLOAD_MAX_SIZE = 1000000000  # 1GB, limit in nginx if u need
+# Bytes a single user can be uploading at once to a single tornado process
+UPLOAD_USER_QUOTA = 2 * 1000000000
+
+# Threads that run blocking mysql queries outside of tornado IOLoop
+DB_THREAD_WORKERS = 10
+# Queries waiting for a free db thread, after this limit new requests are rejected
+DB_MAX_QUEUE_SIZE = 1000
+
+# Websocket flood protection, token buckets as (tokens refilled per second, bucket capacity)
+SPAM_CONNECTION_MESSAGES_LIMIT = (5, 30)
+SPAM_CONNECTION_BYTES_LIMIT = (20000, 200000)
+SPAM_USER_MESSAGES_LIMIT = (10, 60)
+SPAM_USER_BYTES_LIMIT = (50000, 500000)
+# Per connection limits for specific events, others are limited only by the limits above
+SPAM_ACTIONS_LIMITS = {
+	'sendMessage': (1, 10),
+	'editMessage': (1, 10),
+	'addRoom': (0.1, 3),
+	'inviteUser': (0.2, 5),
+	'setUserProfile': (0.1, 3),
+	'setSettings': (0.2, 5),
+	'loadMessages': (2, 10),
+}
+# Keep user limits in redis so they are shared between all tornado processes
+SPAM_REDIS_USER_LIMITS = False
+
+# Tornado processes report to redis every interval ms, leader is reelected if it's silent for timeout ms
+CLUSTER_HEARTBEAT_INTERVAL = 5000
+CLUSTER_NODE_TIMEOUT = 15000
+# Frames written to websockets are kept in redis, so client that reconnects with the same id
+# gets only the frames it has missed instead of loading everything from db
+WS_REPLAY = True
+# Max frames kept for a single websocket
+WS_REPLAY_SIZE = 500
+# Seconds log of an idle websocket is kept, should be longer than PING_INTERVAL since pings refresh it
+WS_REPLAY_TTL = 600
+# Seconds closed websocket stays subscribed and can be resumed
+WS_REPLAY_GRACE = 30
+
+# Outgoing websocket messages waiting for slow client, after the limit client is disconnected
+WS_OUTBOUND_MAX_BYTES = 4 * 1024 * 1024
+WS_OUTBOUND_MAX_MESSAGES = 2000
+# Bytes passed to socket at once, the rest waits in the queue
+WS_OUTBOUND_WRITE_BUFFER = 64 * 1024
+
+# permessage-deflate for websockets, see zlib.compressobj for level and memory,
+# use `./manage.py measure_compression` to compare them on your data
+WS_COMPRESSION = False
+WS_COMPRESSION_LEVEL = 6
+WS_COMPRESSION_MEM_LEVEL = 8
+# Messages shorter than this amount of characters are sent uncompressed
+WS_COMPRESSION_THRESHOLD = 256
+# Redis pubsub messages are encoded with short codes of VarNames/Actions instead of json keys,
+# clients that connect with `protocol=compact` receive them without re-encoding
+COMPACT_PUBSUB = True
+# Allow clients to negotiate compact protocol, others get json
+WS_COMPACT_PROTOCOL = True
+
+# Sessions cached in every tornado process, for at most SESSION_CACHE_TTL seconds
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 60
+
+# Interval in ms between writes of last read messages of closed websockets
+LAST_READ_FLUSH_INTERVAL = 5000
+# Max amount of users whose last read messages are updated by a single query
+LAST_READ_BATCH_SIZE = 500
+
+# Latest messages of every room kept in redis, so loadMessages doesn't hit db
+MESSAGES_CACHE_SIZE = 300
+# Seconds after the last write when room cache is dropped
+MESSAGES_CACHE_TTL = 3 * 24 * 3600
+
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 # pip install PyMySQL
@@ -119,6 +215,10 @@ DEFAULT_CHARSET = 'utf-8'
 PROJECT_DIR = os.path.dirname(os.path.realpath(project_module.__file__))
 
 MESSAGES_PER_SEARCH = 10
+# Max missed messages of a single room sent on connect, the newest ones are sent and room is marked with hasMore
+HISTORY_SYNC_ROOM_LIMIT = 100
+# Rooms whose missed messages are fetched by a single UNION query on connect
+HISTORY_SYNC_ROOMS_PER_QUERY = 20
 AUTH_PROFILE_MODULE = 'chat.UserProfile'
 
 
@@ -155,6 +255,11 @@ IP_API_URL = 'http://ip-api.com/json/%s'
 
 ALL_REDIS_ROOM = 'all'
 WEBRTC_CONNECTION = 'webrtc_conn'
+# Seconds webrtc connection state is kept in redis after its last signaling message
+WEBRTC_CONNECTION_TTL = 24 * 3600
+# Leader checks WEBRTC_SWEEP_BATCH_SIZE connections every WEBRTC_SWEEP_INTERVAL ms and removes expired or closed ones
+WEBRTC_SWEEP_INTERVAL = 60000
+WEBRTC_SWEEP_BATCH_SIZE = 200
 ALL_ROOM_ID = 1
 
 PING_CLOSE_JS_DELAY = 10000  # milliseconds
@@ -176,17 +281,20 @@ WHERE a.id IN %s AND
 					HAVING COUNT(b.user_id) = 1
 			)"""
 
-UPDATE_LAST_READ_MESSAGE = """
+# {pending} - rows of (user_id, id of the latest message the user has read or NULL)
+UPDATE_LAST_READ_MESSAGES = """
 UPDATE chat_room_users out_cru
 	INNER JOIN
 		(SELECT
 			max(chat_message.id) message_id,
 			chat_room_users.id rooms_users_id
 		 FROM chat_room_users
+			JOIN ({pending}) pending ON pending.user_id = chat_room_users.user_id
 			JOIN chat_message ON chat_message.room_id = chat_room_users.room_id
-		WHERE chat_room_users.user_id = %s
-		GROUP BY chat_message.room_id) last_message ON out_cru.id = last_message.rooms_users_id
-SET out_cru.last_read_message_id = last_message.message_id 
+		WHERE pending.message_id IS NULL OR chat_message.id <= pending.message_id
+		GROUP BY chat_room_users.id) last_message ON out_cru.id = last_message.rooms_users_id
+SET out_cru.last_read_message_id = last_message.message_id
+WHERE out_cru.last_read_message_id IS NULL OR out_cru.last_read_message_id < last_message.message_id
 """
 
 # ---------------JAVASCRIPT CONSTANTS --------------------
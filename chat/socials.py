@@ -2,7 +2,6 @@ import json
 import re
 
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
 from oauth2client import client
 from oauth2client.crypt import AppIdentityError
 from tornado import httpclient
@@ -10,8 +9,10 @@ from tornado.httpclient import HTTPRequest
 from tornado.httputil import url_concat
 
 from chat import settings
+from chat.global_redis import user_directory
 from chat.log_filters import id_generator
-from chat.models import UserProfile, get_random_path, RoomUsers
+from chat.media_store import media_store
+from chat.models import UserProfile, RoomUsers
 from chat.py2_3 import urlopen
 from chat.utils import check_user
 
@@ -41,9 +42,7 @@ class SocialAuth():
 		if url is not None:
 			try:
 				response = urlopen(url)
-				filename = get_random_path(None, url.split('/')[-1])
-				content = ContentFile(response.read())
-				user_profile.photo.save(filename, content, False)
+				user_profile.photo.name = media_store.add_content(response.read(), url.split('/')[-1])
 			except Exception as e:
 				self.logger.error("Unable to download photo from url %s for user %s because %s",
 						url, user_profile.username, e)
@@ -74,6 +73,7 @@ class SocialAuth():
 			self.download_http_photo(picture, user_profile)
 			user_profile.save()
 			RoomUsers(user_id=user_profile.id, room_id=settings.ALL_ROOM_ID, notifications=False).save()
+			user_directory.mark_changed(user_profile.id)
 		return user_profile
 
 
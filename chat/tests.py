@@ -1,12 +1,27 @@
+import hashlib
 import json
+import logging
+import os
+import shutil
 import ssl
+import tempfile
 from random import randint
 from random import random
 from threading import Thread
 from time import sleep
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from tornado.concurrent import Future
+from tornado.httputil import HTTPServerRequest
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.web import Application
 from websocket import create_connection
 
 # class ModelTest(TestCase):
@@ -49,20 +64,35 @@ from websocket import create_connection
 # 		self.assertRegexpMatches(elem.text, "^[a-zA-Z-_0-9]{1,16}$")
 # 		driver.close()
 from chat.global_redis import sync_redis
-from chat.models import UserProfile
+from chat.media_store import MediaStore
+from chat.models import UserProfile, User, Room, Message, MediaFile, Image, UploadedFile
 from chat.socials import GoogleAuth
-from chat.tornado.constants import VarNames, Actions
+from chat.tornado import compact_protocol
+from chat.tornado.anti_spam import TokenBucket, LocalUserLimits, RedisUserLimits
+from chat.tornado.constants import VarNames, Actions, RedisPrefix, HandlerNames
+from chat.tornado.history_sync import HistorySync, parse_known_messages
+from chat.tornado.heartbeat import HeartbeatWheel, heartbeat_wheel
+from chat.tornado.message_handler import MessagesHandler
+from chat.tornado.outbound_queue import OutboundQueue, build_text_frame
+from chat.tornado.preview_pool import PreviewPool
+from chat.tornado.replay_log import count_overlap
+from chat.tornado.redis_client import CommandConnection, RedisError, ReplyParser, encode_command
+from chat.tornado.subscription_hub import PubSubMessage
+from chat.tornado.tornado_handler import TornadoHandler
+from chat.tornado.upload_stream import MultipartParser, get_boundary, MAX_HEADERS_SIZE
+from chat.tornado.message_creator import MessagesCreator
+from chat.utils import get_search_tokens, index_message, find_messages, group_images, get_message_images_videos
 
 
 class RegisterTest(TestCase):
 
-    def test_animals_can_speak(self):
+	def test_animals_can_speak(self):
 		user_profile = UserProfile(
-			 name='test',
-			 surname='test',
-			 email='asd@mail.ru',
-			 username='test'
-		 )
+			name='test',
+			surname='test',
+			email='asd@mail.ru',
+			username='test'
+		)
 		gauth = GoogleAuth()
 		gauth.download_http_photo('https://lh4.googleusercontent.com/-CuLSUOTQ4Kw/AAAAAAAAAAI/AAAAAAAAANQ/VlgHrqehE90/s96-c/photo.jpg', user_profile)
 
@@ -110,3 +140,763 @@ class WebSocketLoadTest(TestCase):
 			for i in range(randint(3, 7)):
 				thread = Thread(target=self.threaded_function, args=(session, i))
 				thread.start()
+
+
+class FakeStream(object):
+	"""
+	IOStream of tornado 4.5 that keeps written data, blocked stream drains only on drain call.
+	Like tornado, every write replaces the pending write future, so the previous one never resolves
+	"""
+
+	def __init__(self, blocked=False):
+		self._write_buffer_size = 0
+		self.blocked = blocked
+		self.written = []
+		self.write_future = None
+
+	def write(self, data):
+		self.written.append(data)
+		future = self.write_future = Future()
+		if self.blocked:
+			self._write_buffer_size += len(data)
+		else:
+			future.set_result(None)
+		return future
+
+	def drain(self):
+		self._write_buffer_size = 0
+		if not self.write_future.done():
+			self.write_future.set_result(None)
+
+
+class FakeProtocol(object):
+	"""
+	WebSocketProtocol13 of tornado 4.5 without compression
+	"""
+
+	def __init__(self, stream):
+		self.stream = stream
+		self._compressor = None
+		self._message_bytes_out = 0
+		self._wire_bytes_out = 0
+
+	def _abort(self):
+		pass
+
+
+class FakeWsHandler(object):
+
+	def __init__(self, stream):
+		self.ws_connection = FakeProtocol(stream)
+		self.logger = logging.getLogger(__name__)
+		self.closed = None
+		self.written_frames = []
+
+	def close(self, code, reason):
+		self.closed = code
+		self.ws_connection = None
+
+	def on_frames_written(self, frames):
+		self.written_frames.extend(frames)
+
+
+class OutboundQueueTest(SimpleTestCase):
+
+	def create_queue(self, blocked=False, max_bytes=1000, max_messages=10):
+		handler = FakeWsHandler(FakeStream(blocked))
+		return handler, OutboundQueue(handler, max_bytes, max_messages, 1, 1000)
+
+	def test_write(self):
+		handler, queue = self.create_queue()
+		queue.put('hello', log=True)
+		self.assertEqual(handler.ws_connection.stream.written, [build_text_frame('hello')[0]])
+		self.assertEqual(handler.written_frames, ['hello'])
+		self.assertEqual(queue.count, 0)
+
+	def test_key_replaces_queued_frame(self):
+		handler, queue = self.create_queue(blocked=True)
+		queue.put('first')  # fills write buffer
+		queue.put('a', key='typing')
+		queue.put('b', key='typing')
+		self.assertEqual([f.text for f in queue.frames if not f.dropped], ['b'])
+		self.assertEqual(queue.count, 1)
+
+	def test_drop_droppable(self):
+		handler, queue = self.create_queue(blocked=True, max_messages=2)
+		queue.put('first')
+		queue.put('a', droppable=True)
+		queue.put('b')
+		queue.put('c')
+		self.assertIsNone(handler.closed)
+		self.assertEqual([f.text for f in queue.frames], ['b', 'c'])
+
+	def test_write_outside_of_queue(self):
+		handler, queue = self.create_queue(blocked=True)
+		stream = handler.ws_connection.stream
+		queue.put('first')  # fills write buffer
+		queue.put('second')
+		flushed = queue.flush()
+		stream.write(b'pong')  # tornado answers ping of client, future of the queue write is lost
+		stream.drain()
+		IOLoop.current().run_sync(lambda: flushed, timeout=1)
+		self.assertEqual(stream.written[-1], build_text_frame('second')[0])
+		self.assertEqual(queue.count, 0)
+
+	def test_close_slow_consumer(self):
+		handler, queue = self.create_queue(blocked=True, max_messages=2)
+		queue.put('first')
+		queue.put('a')
+		queue.put('b')
+		self.assertTrue(queue.put('c') is False)
+		self.assertEqual(handler.closed, 1008)
+		self.assertEqual(queue.count, 0)
+
+
+class FakeReplayLog(object):
+	"""
+	ReplayLog of a single websocket kept in memory
+	"""
+	grace = 30
+
+	def __init__(self, handler=None, published=()):
+		self.handler = handler
+		self.published = published
+		self.frames = []
+		self.channels = None
+
+	def append(self, ws_id, owner, frames):
+		self.frames.extend(frames)
+		future = Future()
+		future.set_result(len(self.frames))
+		return future
+
+	def detach(self, ws_id, owner, channels):
+		self.channels = list(channels)
+
+	def set_channels(self, ws_id, owner, channels):
+		self.channels = list(channels)
+
+	def frames_after(self, seq):
+		return self.frames[seq:]
+
+	def get_channels(self, ws_id):
+		future = Future()
+		future.set_result(self.channels)
+		return future
+
+	def claim(self, ws_id, owner, node_id, user_id, seq, alive_since):
+		"""
+		:return: state of json websocket, pubsub messages published meanwhile are delivered before it
+		"""
+		for message in self.published:
+			self.handler.on_pub_sub_message(message)
+		future = Future()
+		future.set_result((len(self.frames), self.channels, '', self.frames_after(seq)))
+		return future
+
+
+def create_tornado_handler():
+	return TornadoHandler(Application(), HTTPServerRequest(method='GET', uri='/ws', connection=mock.Mock()))
+
+
+def sent_texts(stream):
+	"""
+	:return: payloads of short unmasked text frames written to stream
+	"""
+	return [frame[2:].decode('utf-8') for frame in stream.written]
+
+
+class ReplayDetachTest(SimpleTestCase):
+
+	def test_queued_frames_are_resumed(self):
+		handler = create_tornado_handler()
+		stream = FakeStream(blocked=True)
+		handler.ws_connection = FakeProtocol(stream)
+		handler.replay_log = FakeReplayLog()
+		handler.replay_owner = 'owner'
+		handler.id = '0001:abcd'
+		handler.channels = [1]
+		handler.connected = True
+		handler.write_frame('received')
+		stream._write_buffer_size = settings.WS_OUTBOUND_WRITE_BUFFER  # client stops reading
+		handler.write_frame('queued 1')
+		handler.write_frame('queued 2')
+		handler.on_close()
+		IOLoop.current().remove_timeout(handler.detach_timeout)
+		self.assertTrue(handler.detached)
+		self.assertEqual(handler.replay_log.channels, [1])
+		# client has received a single frame and resumes with seq 1
+		self.assertEqual(handler.replay_log.frames_after(1), ['queued 1', 'queued 2'])
+
+	def test_resume_skips_replayed_messages(self):
+		handler = create_tornado_handler()
+		stream = FakeStream()
+		handler.ws_connection = FakeProtocol(stream)
+		handler.id = '0001:abcd'
+		handler.user_id = 1
+		handler.subscription_hub = mock.Mock()
+		handler.cluster_node = mock.Mock(node_id='node')
+		online = Future()
+		online.set_result(1)
+		handler.cluster_node.add_online.return_value = online
+		old, missed, ping, new = (json.dumps({VarNames.EVENT: e, VarNames.TIME: 1}) for e in ('old', 'missed', Actions.PING, 'new'))
+		published = [
+			PubSubMessage('1', RedisPrefix.PARSABLE_PREFIX + ping),
+			PubSubMessage('1', new),
+		]
+		handler.replay_log = FakeReplayLog(handler, published)
+		handler.replay_log.channels = [1]
+		# old websocket has logged the ping after the client had received the first frame
+		handler.replay_log.frames = [old, missed, ping]
+		self.assertTrue(IOLoop.current().run_sync(lambda: handler.resume(1)))
+		texts = sent_texts(stream)
+		self.assertEqual(texts[:2], [missed, ping])
+		self.assertEqual(json.loads(texts[2])[VarNames.EVENT], Actions.RESUMED)
+		self.assertEqual(texts[3:], [new])
+
+	def test_room_added_while_detached_is_resumed(self):
+		handler = create_tornado_handler()
+		handler.ws_connection = FakeProtocol(FakeStream())
+		handler.replay_log = FakeReplayLog()
+		handler.replay_owner = 'owner'
+		handler.id = '0001:abcd'
+		handler.user_id = 1
+		handler.channels = [1]
+		handler.connected = True
+		handler.subscription_hub = mock.Mock()
+		handler.on_close()
+		IOLoop.current().remove_timeout(handler.detach_timeout)
+		created = json.dumps({VarNames.EVENT: Actions.CREATE_ROOM_CHANNEL, VarNames.ROOM_ID: 5})
+		handler.on_pub_sub_message(PubSubMessage('u1', RedisPrefix.PARSABLE_PREFIX + created))
+		self.assertEqual(handler.replay_log.channels, [1, 5])
+		resumed = create_tornado_handler()
+		resumed.ws_connection = FakeProtocol(FakeStream())
+		resumed.id = handler.id
+		resumed.user_id = 1
+		resumed.subscription_hub = mock.Mock()
+		resumed.cluster_node = mock.Mock(node_id='node')
+		online = Future()
+		online.set_result(1)
+		resumed.cluster_node.add_online.return_value = online
+		resumed.replay_log = handler.replay_log
+		resumed.replay_log.handler = resumed
+		self.assertTrue(IOLoop.current().run_sync(lambda: resumed.resume(0)))
+		self.assertEqual(resumed.channels, [1, 5])
+
+
+class FakeRedisStream(object):
+	"""
+	IOStream of redis connection, pending read gets data passed to receive
+	"""
+
+	def __init__(self):
+		self.written = []
+		self.reading = None
+		self.closed = False
+
+	def set_nodelay(self, value):
+		pass
+
+	def write(self, data):
+		self.written.append(data)
+
+	def read_bytes(self, num_bytes, partial=False):
+		self.reading = Future()
+		return self.reading
+
+	def receive(self, data):
+		self.reading.set_result(data)
+
+	def close(self):
+		self.closed = True
+
+
+class RedisProtocolTest(SimpleTestCase):
+	REPLIES = b'+OK\r\n:42\r\n$5\r\nh\xc3\xa9ll\r\n$-1\r\n*-1\r\n*0\r\n-ERR wrong\r\n' \
+		b'*3\r\n$7\r\nmessage\r\n$1\r\n1\r\n*2\r\n:1\r\n$0\r\n\r\n'
+
+	def assert_replies(self, replies):
+		self.assertEqual(replies[:6], ['OK', 42, 'h\xe9ll', None, None, []])
+		self.assertIsInstance(replies[6], RedisError)
+		self.assertEqual(str(replies[6]), 'ERR wrong')
+		self.assertEqual(replies[7:], [['message', '1', [1, '']]])
+
+	def test_encode_command(self):
+		self.assertEqual(encode_command(('SET', 'k\xe9y', 10)), b'*3\r\n$3\r\nSET\r\n$4\r\nk\xc3\xa9y\r\n$2\r\n10\r\n')
+
+	def test_parse_whole(self):
+		self.assert_replies(ReplyParser().feed(self.REPLIES))
+
+	def test_parse_split(self):
+		for size in (1, 2, 3, 7, 100):
+			parser = ReplyParser()
+			replies = []
+			for i in range(0, len(self.REPLIES), size):
+				replies.extend(parser.feed(self.REPLIES[i:i + size]))
+			self.assert_replies(replies)
+			self.assertEqual(len(parser.buffer), 0)
+
+	def test_bulk_is_parsed_once(self):
+		parser = ReplyParser()
+		self.assertEqual(parser.feed(b'$6\r\nab'), [])
+		self.assertEqual(parser.bulk_length, 6)
+		self.assertEqual(parser.feed(b'cd'), [])
+		self.assertEqual(parser.feed(b'ef\r\n:1\r'), ['abcdef'])
+		self.assertEqual(parser.feed(b'\n'), [1])
+
+	def test_invalid_reply(self):
+		self.assertRaises(ValueError, ReplyParser().feed, b'$1\r\n\xff\r\n')
+		self.assertRaises(ValueError, ReplyParser().feed, b'?\r\n')
+
+	def test_invalid_reply_fails_waiting_commands(self):
+		stream = FakeRedisStream()
+		connected = Future()
+		connected.set_result(stream)
+		with mock.patch('chat.tornado.redis_client.TCPClient') as client:
+			client.return_value.connect.return_value = connected
+			connection = CommandConnection('localhost', 6379, 0)
+			first = connection.execute('GET', 'a')
+			second = connection.execute('GET', 'b')
+		# reply to SELECT and invalid utf-8 in reply to the first GET
+		stream.receive(b'+OK\r\n$1\r\n\xff\r\n')
+		self.assertRaises(StreamClosedError, IOLoop.current().run_sync, lambda: second)
+		self.assertTrue(stream.closed)
+		self.assertIsNone(connection.stream)
+		self.assertIsNotNone(first.exception())
+		self.assertIsNotNone(second.exception())
+		self.assertFalse(connection.waiting)
+
+
+class CompactProtocolTest(SimpleTestCase):
+
+	def test_round_trip(self):
+		message = {
+			VarNames.EVENT: Actions.PING,
+			VarNames.HANDLER_NAME: HandlerNames.CHANNELS,
+			VarNames.CONTENT: [{VarNames.EVENT: 3, VarNames.HANDLER_NAME: Actions.PING}, 'text', None],
+			'unknown': {VarNames.ROOM_ID: 1, VarNames.EVENT: 'not a constant'},
+		}
+		text = compact_protocol.dumps(message)
+		self.assertTrue(compact_protocol.is_compact(text))
+		self.assertEqual(compact_protocol.loads(text), message)
+		self.assertEqual(compact_protocol.loads(json.dumps(message)), message)
+
+	def test_only_message_values_are_coded(self):
+		compacted = compact_protocol.compact({
+			VarNames.EVENT: Actions.PING,
+			VarNames.CONTENT: {VarNames.EVENT: Actions.PING},
+		})
+		event = compact_protocol.KEY_CODES[VarNames.EVENT]
+		content = compact_protocol.KEY_CODES[VarNames.CONTENT]
+		self.assertEqual(compacted, {
+			event: compact_protocol.VALUE_CODES[Actions.PING],
+			content: {event: Actions.PING},
+		})
+
+	def test_values_not_in_table_are_escaped(self):
+		for value in (7, 'not a constant', None):
+			compacted = compact_protocol.compact({VarNames.EVENT: value, 1: 2})
+			self.assertEqual(compacted, {compact_protocol.ESCAPE + VarNames.EVENT: value, compact_protocol.ESCAPE + '1': 2})
+			self.assertEqual(compact_protocol.expand(compacted), {VarNames.EVENT: value, '1': 2})
+
+
+class SearchMessagesTest(TestCase):
+
+	def setUp(self):
+		self.user = User.objects.create(username='search')
+		self.room = Room.objects.create(name='search')
+		self.other_room = Room.objects.create(name='other')
+
+	def send(self, content, room=None):
+		message = Message.objects.create(sender=self.user, room=room or self.room, content=content)
+		index_message(message)
+		return message
+
+	def test_get_search_tokens(self):
+		self.assertEqual(get_search_tokens('Hello, hello WORLD! \u041f\u0440\u0438\u0432\u0435\u0442'), ['hello', 'world', '\u043f\u0440\u0438\u0432\u0435\u0442'])
+		self.assertEqual(get_search_tokens(None), [])
+		self.assertEqual(get_search_tokens('a' * 100), ['a' * 32])
+
+	def test_every_word_and_prefix_of_the_last(self):
+		first = self.send('quick brown fox')
+		self.send('quick red fox')
+		self.send('quick brown fox', self.other_room)
+		self.assertEqual(find_messages(self.room.id, 'brown qui', None, 10), [first])
+		self.assertEqual(find_messages(self.room.id, 'qui brown', None, 10), [])
+		self.assertEqual(find_messages(self.room.id, '!!', None, 10), [])
+
+	def test_pages(self):
+		messages = [self.send('word %d' % i) for i in range(5)]
+		first_page = find_messages(self.room.id, 'word', None, 2)
+		self.assertEqual(first_page, messages[:2:-1])
+		second_page = find_messages(self.room.id, 'word', first_page[-1].id, 2)
+		self.assertEqual(second_page, messages[2:0:-1])
+		self.assertEqual(find_messages(self.room.id, 'word', second_page[-1].id, 2), messages[:1])
+
+	def test_edited_and_deleted(self):
+		message = self.send('old text')
+		message.content = 'new text'
+		index_message(message)
+		self.assertEqual(find_messages(self.room.id, 'old', None, 10), [])
+		self.assertEqual(find_messages(self.room.id, 'new', None, 10), [message])
+		message.deleted = True
+		index_message(message)
+		self.assertEqual(find_messages(self.room.id, 'text', None, 10), [])
+
+
+class MultipartParserTest(SimpleTestCase):
+	BOUNDARY = b'----WebKitFormBoundary7MA4YWxk'
+	# content has partial delimiters, so they can't be taken for the boundary
+	CONTENT = b'\x00\r\n--' + BOUNDARY[:-1] + b'\r\n\r\n--' + b'x' * 1000
+
+	def setUp(self):
+		self.media_root = tempfile.mkdtemp()
+		self.received = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.media_root)
+
+	def on_data(self, size):
+		self.received += size
+
+	def body(self, *files):
+		parts = [b'preamble\r\n--' + self.BOUNDARY + b'\r\nContent-Disposition: form-data; name="text"\r\n\r\nvalue']
+		for field in files:
+			parts.append(
+				b'\r\n--' + self.BOUNDARY + b'\r\nContent-Disposition: form-data; name="' + field +
+				b'"; filename="a.png"\r\nContent-Type: image/png\r\n\r\n' + self.CONTENT)
+		parts.append(b'\r\n--' + self.BOUNDARY + b'--\r\nepilogue')
+		return b''.join(parts)
+
+	def parse(self, body, size):
+		parser = MultipartParser(self.BOUNDARY, self.media_root, self.on_data)
+		for i in range(0, len(body), size):
+			parser.feed(body[i:i + size])
+		return parser
+
+	def test_get_boundary(self):
+		self.assertEqual(get_boundary('multipart/form-data; boundary="%s"' % self.BOUNDARY.decode()), self.BOUNDARY)
+		self.assertIsNone(get_boundary('application/x-www-form-urlencoded'))
+		self.assertRaises(ValidationError, get_boundary, 'multipart/form-data')
+
+	def test_split_feeds(self):
+		body = self.body(b'i0', b'v1')
+		# 1 splits every delimiter, the rest split them at different positions
+		for size in (1, 3, 7, 50, len(body)):
+			self.received = 0
+			parser = self.parse(body, size)
+			self.assertTrue(parser.finished)
+			self.assertEqual(parser.arguments, {'text': [b'value']})
+			self.assertEqual(sorted(parser.files), ['i0', 'v1'])
+			self.assertEqual(self.received, 2 * len(self.CONTENT))
+			for spooled in parser.files.values():
+				with open(spooled.path, 'rb') as f:
+					self.assertEqual(f.read(), self.CONTENT)
+				self.assertEqual(spooled.hexdigest, hashlib.sha256(self.CONTENT).hexdigest())
+				self.assertTrue(spooled.name.endswith('a.png'))
+			parser.remove_files()
+		self.assertEqual(os.listdir(self.media_root), [])
+
+	def test_duplicate_file_field(self):
+		parser = MultipartParser(self.BOUNDARY, self.media_root, self.on_data)
+		self.assertRaises(ValidationError, parser.feed, self.body(b'i0', b'i0'))
+		# the first file stays in parser.files, so it's removed with the others
+		self.assertEqual(len(os.listdir(self.media_root)), 1)
+		parser.remove_files()
+		self.assertEqual(os.listdir(self.media_root), [])
+
+	def test_too_long_headers(self):
+		parser = MultipartParser(self.BOUNDARY, self.media_root, self.on_data)
+		parser.feed(b'--' + self.BOUNDARY + b'\r\n')
+		self.assertRaises(ValidationError, parser.feed, b'x' * (MAX_HEADERS_SIZE + 1))
+
+
+class MediaStoreTest(TestCase):
+
+	def setUp(self):
+		self.media_root = tempfile.mkdtemp()
+		self.store = MediaStore(self.media_root)
+		self.addCleanup(shutil.rmtree, self.media_root)
+
+	def test_same_content_is_stored_once(self):
+		first = self.store.add_content(b'content', 'a.PNG')
+		second = self.store.add_content(b'content', 'b.jpg')
+		self.assertEqual(first, second)
+		self.assertTrue(first.endswith(hashlib.sha256(b'content').hexdigest() + '.png'))
+		self.assertEqual(MediaFile.objects.get().references, 2)
+		self.store.release([first])
+		self.assertTrue(os.path.isfile(self.store.path(first)))
+		self.store.release([second, 'not_in_store.png'])
+		self.assertFalse(os.path.exists(self.store.path(first)))
+		self.assertFalse(MediaFile.objects.exists())
+		# content comes back after the last reference is gone
+		self.assertEqual(self.store.add_content(b'content', 'c.png'), first)
+		self.assertTrue(os.path.isfile(self.store.path(first)))
+
+	def test_clean_uploads(self):
+		user = User.objects.create(username='uploads')
+		name = self.store.add_content(b'image', 'a.png')
+		old = UploadedFile.objects.create(symbol='a', file=name, user=user, type='i', time=0)
+		new = UploadedFile.objects.create(symbol='b', file=self.store.add_content(b'image', 'b.png'), user=user, type='i')
+		with mock.patch('chat.management.commands.clean_uploads.media_store', self.store):
+			call_command('clean_uploads')
+		self.assertEqual(list(UploadedFile.objects.values_list('id', flat=True)), [new.id])
+		self.assertEqual(MediaFile.objects.get().references, 1)
+		self.assertTrue(os.path.isfile(self.store.path(name)))
+
+	def test_deleted_message_releases_files(self):
+		user = User.objects.create(username='deleted')
+		message = Message.objects.create(sender=user, room=Room.objects.create(), content='\u3500', symbol='\u3500')
+		img = self.store.add_content(b'image', 'a.png')
+		preview = self.store.add_content(b'preview', 'a.jpg')
+		Image.objects.create(symbol='\u3500', message=message, img=img, preview=preview)
+		message.content = None
+		with mock.patch('chat.tornado.message_handler.media_store', self.store):
+			MessagesHandler.save_deleted_message(mock.Mock(), message)
+		self.assertFalse(Image.objects.exists())
+		self.assertFalse(MediaFile.objects.exists())
+		self.assertEqual(os.listdir(os.path.dirname(self.store.path(img))), [])
+		message.refresh_from_db()
+		self.assertTrue(message.deleted)
+		self.assertIsNone(message.symbol)
+
+
+class PreviewPoolTest(SimpleTestCase):
+	# writes poster frame to the last argument like ffmpeg does
+	FFMPEG = '#!/bin/sh\nfor arg; do last="$arg"; done\necho poster > "$last"\n'
+
+	def setUp(self):
+		self.media_root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.media_root)
+		self.ffmpeg = os.path.join(self.media_root, 'ffmpeg')
+		with open(self.ffmpeg, 'w') as f:
+			f.write(self.FFMPEG)
+		os.chmod(self.ffmpeg, 0o700)
+		self.pool = PreviewPool(None, None, 1, 100, 75, 10, self.ffmpeg)
+
+	def tearDown(self):
+		if self.pool.executor is not None:
+			self.pool.executor.shutdown()
+
+	def test_video_preview_in_spawned_process(self):
+		with mock.patch('chat.tornado.preview_pool.media_store.media_root', self.media_root):
+			path = IOLoop.current().run_sync(lambda: self.pool.generate(1, 'v', os.path.join(self.media_root, 'a.mp4')))
+		self.assertEqual(os.path.dirname(path), self.media_root)
+		with open(path) as f:
+			self.assertEqual(f.read(), 'poster\n')
+
+
+class TokenBucketTest(SimpleTestCase):
+
+	def setUp(self):
+		patcher = mock.patch('chat.tornado.anti_spam.time.time', return_value=1000.0)
+		self.time = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_capacity_and_refill(self):
+		bucket = TokenBucket((2, 5))
+		self.assertTrue(bucket.consume(5))
+		self.assertFalse(bucket.consume())
+		self.time.return_value = 1001.0
+		self.assertTrue(bucket.consume(2))
+		self.assertFalse(bucket.consume())
+		# refill doesn't exceed capacity
+		self.time.return_value = 2000.0
+		self.assertFalse(bucket.consume(6))
+		self.assertTrue(bucket.consume(5))
+
+	def test_local_user_limits_are_shared(self):
+		limits = LocalUserLimits()
+		with self.settings(SPAM_USER_MESSAGES_LIMIT=(1, 2), SPAM_USER_BYTES_LIMIT=(100, 100)):
+			limits.acquire(1)
+			limits.acquire(1)
+		self.assertTrue(limits.consume(1, 10))
+		self.assertTrue(limits.consume(1, 10))
+		self.assertFalse(limits.consume(1, 10))
+		limits.release(1)
+		self.assertIn(1, limits.users)
+		limits.release(1)
+		self.assertNotIn(1, limits.users)
+
+	def test_redis_user_limits_keys(self):
+		result = Future()
+		result.set_result(1)
+		redis = mock.Mock()
+		redis.register_script.return_value.return_value = result
+		with self.settings(SPAM_USER_MESSAGES_LIMIT=(1, 2), SPAM_USER_BYTES_LIMIT=(100, 100)):
+			self.assertTrue(IOLoop.current().run_sync(lambda: RedisUserLimits(redis).consume(7, 10)))
+		script = redis.register_script.return_value
+		self.assertEqual(script.call_args_list, [
+			mock.call(keys=[RedisPrefix.SPAM_MESSAGES % 7], args=[1, 2, 1000000, 1]),
+			mock.call(keys=[RedisPrefix.SPAM_BYTES % 7], args=[100, 100, 1000000, 10]),
+		])
+
+
+class HeartbeatWheelTest(SimpleTestCase):
+
+	def setUp(self):
+		self.wheel = HeartbeatWheel(3, 1)
+		self.wheel.callback = mock.Mock()  # ticks are called by test
+
+	def test_expire(self):
+		silent = mock.Mock()
+		answered = mock.Mock()
+		self.wheel.expect_pong(silent)
+		self.wheel.expect_pong(answered)
+		self.wheel.on_tick()
+		self.wheel.on_tick()
+		self.wheel.cancel(answered)
+		silent.close.assert_not_called()
+		self.wheel.on_tick()
+		silent.close.assert_called_once_with(408, "Ping timeout")
+		answered.close.assert_not_called()
+		self.assertEqual(self.wheel.positions, {})
+
+	def test_ping_moves_deadline(self):
+		handler = mock.Mock()
+		self.wheel.expect_pong(handler)
+		self.wheel.on_tick()
+		self.wheel.on_tick()
+		self.wheel.expect_pong(handler)
+		self.wheel.on_tick()
+		self.wheel.on_tick()
+		handler.close.assert_not_called()
+		self.wheel.on_tick()
+		handler.close.assert_called_once_with(408, "Ping timeout")
+
+	def test_detached_websocket_ignores_ping(self):
+		handler = create_tornado_handler()
+		handler.ws_connection = FakeProtocol(FakeStream())
+		handler.replay_log = FakeReplayLog()
+		handler.replay_owner = 'owner'
+		handler.detached = True
+		ping = json.dumps({VarNames.EVENT: Actions.PING, VarNames.TIME: 1})
+		handler.on_pub_sub_message(PubSubMessage('1', RedisPrefix.PARSABLE_PREFIX + ping))
+		self.assertNotIn(handler, heartbeat_wheel.positions)
+		self.assertEqual(handler.replay_log.frames, [])
+
+
+class CountOverlapTest(SimpleTestCase):
+
+	def test_count_overlap(self):
+		self.assertEqual(count_overlap(['a', 'b', 'c'], ['b', 'c', 'd']), 2)
+		self.assertEqual(count_overlap(['a', 'b', 'c'], ['c']), 1)
+		self.assertEqual(count_overlap(['a', 'b'], ['a', 'b']), 2)
+		self.assertEqual(count_overlap(['a', 'b'], ['b', 'a']), 1)
+		self.assertEqual(count_overlap(['a', 'b'], ['a', 'c']), 0)
+		self.assertEqual(count_overlap(['b'], ['a', 'b']), 0)
+		self.assertEqual(count_overlap([], ['a']), 0)
+		self.assertEqual(count_overlap(['a'], []), 0)
+
+	def test_repeated_frames(self):
+		# the longest overlap wins, so equal frames aren't sent twice
+		self.assertEqual(count_overlap(['x', 'x', 'x'], ['x', 'x', 'y']), 2)
+		self.assertEqual(count_overlap(['x', 'y', 'x'], ['x', 'y', 'x', 'z']), 3)
+
+
+class MessageImagesTest(TestCase):
+
+	def test_group_and_prepare(self):
+		images = [
+			Image(id=1, message_id=5, symbol='\u3500', img='ab/cd/image.png', preview='ab/cd/preview.jpg', type='i'),
+			Image(id=2, message_id=6, symbol='\u3500', img='ab/cd/video.mp4', type='v'),
+			Image(id=3, message_id=5, symbol='\u3501', img='ab/cd/other.png', type='i'),
+		]
+		grouped = group_images(images)
+		self.assertEqual({k: [i.id for i in v] for k, v in grouped.items()}, {5: [1, 3], 6: [2]})
+		files = MessagesCreator.prepare_img_video(grouped, 5)
+		self.assertEqual(files['\u3500'], {
+			VarNames.FILE_URL: settings.MEDIA_URL + 'ab/cd/image.png',
+			VarNames.FILE_TYPE: 'i',
+			VarNames.PREVIEW: settings.MEDIA_URL + 'ab/cd/preview.jpg',
+			VarNames.IMAGE_ID: 1,
+		})
+		self.assertIsNone(files['\u3501'][VarNames.PREVIEW])
+		self.assertIsNone(MessagesCreator.prepare_img_video(grouped, 7))
+
+	def test_images_of_messages_in_one_query(self):
+		user = User.objects.create(username='images')
+		room = Room.objects.create()
+		with_files = [Message.objects.create(sender=user, room=room, content='\u3500', symbol='\u3500') for _ in range(3)]
+		without_files = Message.objects.create(sender=user, room=room, content='text')
+		for message in with_files:
+			Image.objects.create(symbol='\u3500', message=message, img='ab/cd/%d.png' % message.id)
+		with self.assertNumQueries(1):
+			grouped = get_message_images_videos(with_files + [without_files])
+		self.assertEqual(sorted(grouped), [m.id for m in with_files])
+		with self.assertNumQueries(0):
+			self.assertEqual(get_message_images_videos([without_files]), {})
+
+
+class HistorySyncTest(TestCase):
+
+	def setUp(self):
+		user = User.objects.create(username='history')
+		self.rooms = [Room.objects.create(name='r%d' % i) for i in range(3)]
+		self.messages = {
+			room.id: [Message.objects.create(sender=user, room=room, content=str(i)) for i in range(count)]
+			for room, count in zip(self.rooms, (5, 2, 1))
+		}
+
+	def sync(self, known, room_limit, rooms_per_query, **kwargs):
+		options = {'with_history': False, 'last_read': {}, 'was_online': True}
+		options.update(kwargs)
+		return HistorySync(1, known, room_limit=room_limit, rooms_per_query=rooms_per_query, **options)
+
+	def test_parse_known_messages(self):
+		self.assertEqual(parse_known_messages('{"1": 5, "2": {"h": 3, "f": 7}}'), {1: (None, 5), 2: (3, 7)})
+		self.assertEqual(parse_known_messages(None), {})
+
+	def test_rooms_are_limited(self):
+		first, second, third = self.rooms
+		known = {
+			first.id: (None, self.messages[first.id][0].id),
+			second.id: (None, self.messages[second.id][0].id),
+			third.id: (None, self.messages[third.id][0].id),  # nothing is missing
+		}
+		for rooms_per_query, queries in ((1, 3), (2, 2), (3, 1)):
+			sync = self.sync(known, 2, rooms_per_query)
+			# rooms are joined with UNION ALL only where database supports it, e.g. not in sqlite
+			with self.assertNumQueries(queries if connection.features.supports_slicing_ordering_in_compound else 3):
+				loaded = list(sync.load([r.id for r in self.rooms]))
+			self.assertEqual([(room_id, [m.id for m in messages], more) for room_id, messages, more in loaded], [
+				(first.id, [m.id for m in self.messages[first.id][-2:]], True),
+				(second.id, [self.messages[second.id][1].id], False),
+			])
+
+	def test_room_query(self):
+		first = self.rooms[0]
+		messages = self.messages[first.id]
+		self.assertIsNone(self.sync({}, 2, 1).room_query(first.id))
+		# offline messages are loaded after the last read one even if client knows nothing about the room
+		sync = self.sync({}, 10, 1, last_read={first.id: messages[2].id}, was_online=False)
+		loaded = list(sync.load([first.id]))
+		self.assertEqual([m.id for m in loaded[0][1]], [m.id for m in messages[3:]])
+		# history is loaded from the oldest known message, recently edited older ones come with new ones
+		Message.objects.filter(id=messages[1].id).update(edited_times=1)
+		with_history = self.sync({first.id: (messages[2].id, messages[3].id)}, 10, 1, with_history=True)
+		self.assertEqual([m.id for m in list(with_history.load([first.id]))[0][1]], [m.id for m in messages[2:]])
+		without_history = self.sync({first.id: (None, messages[3].id)}, 10, 1)
+		self.assertEqual([m.id for m in list(without_history.load([first.id]))[0][1]], [messages[1].id, messages[4].id])
+
+	@override_settings(HISTORY_SYNC_ROOM_LIMIT=10, HISTORY_SYNC_ROOMS_PER_QUERY=3)
+	def test_offline_messages_images_in_one_query(self):
+		user = User.objects.get(username='history')
+		for room in self.rooms:
+			message = Message.objects.create(sender=user, room=room, content='\u3500', symbol='\u3500')
+			Image.objects.create(symbol='\u3500', message=message, img='ab/cd/%d.png' % message.id)
+			self.messages[room.id].append(message)
+		handler = create_tornado_handler()
+		handler.user_id = user.id
+		known = json.dumps({room.id: self.messages[room.id][0].id for room in self.rooms})
+		room_users = [{VarNames.ROOM_ID: room.id} for room in self.rooms]
+		# messages of every room and images of all of them, unless database can't join rooms
+		queries = 2 if connection.features.supports_slicing_ordering_in_compound else len(self.rooms) + 1
+		with self.assertNumQueries(queries):
+			off, history, more = handler.get_offline_messages(room_users, {}, True, known, False)
+		self.assertEqual(off, {})
+		self.assertEqual(more, [])
+		for room in self.rooms:
+			files = history[room.id][-1][VarNames.FILES]
+			self.assertEqual(files['\u3500'][VarNames.FILE_URL], settings.MEDIA_URL + 'ab/cd/%d.png' % self.messages[room.id][-1].id)
+
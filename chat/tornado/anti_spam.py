@@ -2,24 +2,176 @@ import time
 
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from tornado import gen
 
+from chat.tornado.constants import RedisPrefix
 
-class AntiSpam(object):
+SPAM_MESSAGE = "You're chatting too much, calm down a bit!"
+
+# Takes amount of tokens from bucket stored in hash KEYS[1]
+# ARGV: rate (tokens per second), capacity, current time in ms, amount
+# returns 1 if tokens were taken
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local amount = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate / 1000)
+local allowed = 0
+if tokens >= amount then
+	tokens = tokens - amount
+	allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate))
+return allowed
+"""
+
+
+class TokenBucket(object):
+
+	def __init__(self, limit):
+		"""
+		:param limit: (tokens refilled per second, bucket capacity)
+		"""
+		self.rate, self.capacity = limit
+		self.tokens = self.capacity
+		self.updated = time.time()
+
+	def consume(self, amount=1):
+		"""
+		:return: True if bucket had enough tokens
+		"""
+		now = time.time()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < amount:
+			return False
+		self.tokens -= amount
+		return True
+
+
+class LocalUserLimits(object):
+	"""
+	User buckets shared by websockets of the same user within this process
+	"""
 
 	def __init__(self):
+		self.users = {}  # user_id -> [messages bucket, bytes bucket, opened websockets]
+
+	def acquire(self, user_id):
+		buckets = self.users.get(user_id)
+		if buckets is None:
+			buckets = self.users[user_id] = [
+				TokenBucket(settings.SPAM_USER_MESSAGES_LIMIT),
+				TokenBucket(settings.SPAM_USER_BYTES_LIMIT),
+				0
+			]
+		buckets[2] += 1
+
+	def release(self, user_id):
+		buckets = self.users[user_id]
+		buckets[2] -= 1
+		if buckets[2] == 0:
+			del self.users[user_id]
+
+	def consume(self, user_id, size):
+		messages_bucket, bytes_bucket, _ = self.users[user_id]
+		return messages_bucket.consume() and bytes_bucket.consume(size)
+
+
+class RedisUserLimits(object):
+	"""
+	User buckets stored in redis, so they are shared between all tornado processes
+	"""
+
+	def __init__(self, async_redis):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		"""
+		self.token_bucket_script = async_redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+	def acquire(self, user_id):
+		pass
+
+	def release(self, user_id):
+		pass
+
+	@gen.coroutine
+	def take(self, key, limit, amount, now):
+		rate, capacity = limit
+		return (yield self.token_bucket_script(keys=[key], args=[rate, capacity, now, amount])) == 1
+
+	@gen.coroutine
+	def consume(self, user_id, size):
+		now = int(time.time() * 1000)
+		return (yield self.take(RedisPrefix.SPAM_MESSAGES % user_id, settings.SPAM_USER_MESSAGES_LIMIT, 1, now)) \
+			and (yield self.take(RedisPrefix.SPAM_BYTES % user_id, settings.SPAM_USER_BYTES_LIMIT, size, now))
+
+
+def create_user_limits():
+	if settings.SPAM_REDIS_USER_LIMITS:
+		from chat.global_redis import async_redis
+		return RedisUserLimits(async_redis)
+	else:
+		return LocalUserLimits()
+
+
+user_limits = create_user_limits()
+
+
+class AntiSpam(object):
+	"""
+	Token buckets of a single websocket, memory doesn't depend on amount of received messages
+	"""
+
+	def __init__(self, user_id):
 		self.spammed = 0
-		self.info = {}
+		self.user_id = user_id
+		self.messages = TokenBucket(settings.SPAM_CONNECTION_MESSAGES_LIMIT)
+		self.bytes = TokenBucket(settings.SPAM_CONNECTION_BYTES_LIMIT)
+		self.actions = {}  # event -> TokenBucket, bounded by SPAM_ACTIONS_LIMITS
+		user_limits.acquire(user_id)
+
+	def close(self):
+		user_limits.release(self.user_id)
 
+	@gen.coroutine
 	def check_spam(self, json_message):
 		message_length = len(json_message)
-		info_key = int(round(time.time() * 100))
-		self.info[info_key] = message_length
 		if message_length > settings.MAX_MESSAGE_SIZE:
 			self.spammed += 1
 			raise ValidationError("Message can't exceed %d symbols" % settings.MAX_MESSAGE_SIZE)
-		self.check_timed_spam()
+		yield self.check_timed_spam(message_length)
 
-	def check_timed_spam(self):
-		# TODO implement me
-		pass
-		# raise ValidationError("You're chatting too much, calm down a bit!")
\ No newline at end of file
+	@gen.coroutine
+	def check_timed_spam(self, message_length):
+		"""
+		User limits are checked only if connection limits allow the message,
+		redis limits are resolved asynchronously
+		"""
+		allowed = self.messages.consume() and self.bytes.consume(message_length)
+		if allowed:
+			allowed = user_limits.consume(self.user_id, message_length)
+			if gen.is_future(allowed):
+				allowed = yield allowed
+		if not allowed:
+			self.spammed += 1
+			raise ValidationError(SPAM_MESSAGE)
+
+	def check_action(self, event):
+		"""
+		Applies limits of SPAM_ACTIONS_LIMITS for event
+		"""
+		limit = settings.SPAM_ACTIONS_LIMITS.get(event)
+		if limit is None:
+			return
+		bucket = self.actions.get(event)
+		if bucket is None:
+			bucket = self.actions[event] = TokenBucket(limit)
+		if not bucket.consume():
+			self.spammed += 1
+			raise ValidationError(SPAM_MESSAGE)
@@ -0,0 +1,149 @@
+import logging
+import os
+import socket
+import time
+
+from tornado import gen
+
+from chat.tornado.constants import RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+# Increments connections count of the user in this process and in total, returns total count
+ADD_ONLINE_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+return redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+"""
+
+# Decrements connections count of the user in this process and in total,
+# the user is removed from online when total count reaches zero. Returns total count
+REMOVE_ONLINE_SCRIPT = """
+local node_count = redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+if node_count <= 0 then
+	redis.call('HDEL', KEYS[2], ARGV[1])
+end
+if node_count < 0 then -- connections of this process have been flushed, total doesn't contain this one
+	return tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+end
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+	redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return count
+"""
+
+# Removes connections of process ARGV[1] from total online, returns users that went offline
+FLUSH_NODE_SCRIPT = """
+local node_online = redis.call('HGETALL', KEYS[2])
+local offline = {}
+for i = 1, #node_online, 2 do
+	local count = redis.call('HINCRBY', KEYS[1], node_online[i], -tonumber(node_online[i + 1]))
+	if count <= 0 then
+		redis.call('HDEL', KEYS[1], node_online[i])
+		table.insert(offline, node_online[i])
+	end
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return offline
+"""
+
+# Takes or prolongs leadership of process ARGV[1] for ARGV[2] ms
+ACQUIRE_LEADER_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+	return 1
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	redis.call('PEXPIRE', KEYS[1], ARGV[2])
+	return 1
+end
+return 0
+"""
+
+RELEASE_LEADER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	redis.call('DEL', KEYS[1])
+end
+"""
+
+
+class ClusterNode(object):
+	"""
+	Current tornado process among others that share redis.
+	Every process counts its own websockets of each user, so a process that starts
+	or dies removes only its connections from online. One of the processes is elected
+	as a leader to run periodic tasks, like pinging clients.
+	"""
+
+	def __init__(self, async_redis, on_users_offline):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param on_users_offline: callback with list of user ids that went offline because process has died
+		"""
+		self.redis = async_redis
+		self.on_users_offline = on_users_offline
+		self.node_id = '%s:%d' % (socket.gethostname(), os.getpid())
+		self.is_leader = False
+		self.add_online_script = async_redis.register_script(ADD_ONLINE_SCRIPT)
+		self.remove_online_script = async_redis.register_script(REMOVE_ONLINE_SCRIPT)
+		self.flush_node_script = async_redis.register_script(FLUSH_NODE_SCRIPT)
+		self.acquire_leader_script = async_redis.register_script(ACQUIRE_LEADER_SCRIPT)
+		self.release_leader_script = async_redis.register_script(RELEASE_LEADER_SCRIPT)
+
+	@gen.coroutine
+	def start(self, node_id, flush_online):
+		"""
+		:param node_id: id that stays the same when process restarts, so its previous connections can be removed
+		:param flush_online: remove connections that previous run of this process left in online
+		"""
+		self.node_id = node_id
+		if flush_online:
+			yield self.flush_node(node_id)
+		logger.info("Cluster node %s has started", node_id)
+
+	@gen.coroutine
+	def stop(self):
+		yield self.flush_node(self.node_id)
+		if self.is_leader:
+			yield self.release_leader_script(keys=[RedisPrefix.LEADER], args=[self.node_id])
+			self.is_leader = False
+
+	def add_online(self, user_id):
+		"""
+		:return: Future of amount of websockets of the user in all processes
+		"""
+		return self.add_online_script(keys=[RedisPrefix.ONLINE_VAR, RedisPrefix.NODE_ONLINE % self.node_id], args=[user_id])
+
+	def remove_online(self, user_id):
+		"""
+		:return: Future of amount of websockets of the user left in all processes
+		"""
+		return self.remove_online_script(keys=[RedisPrefix.ONLINE_VAR, RedisPrefix.NODE_ONLINE % self.node_id], args=[user_id])
+
+	@gen.coroutine
+	def flush_node(self, node_id):
+		offline = yield self.flush_node_script(
+			keys=[RedisPrefix.ONLINE_VAR, RedisPrefix.NODE_ONLINE % node_id, RedisPrefix.NODES],
+			args=[node_id]
+		)
+		if offline:
+			logger.info("Removed online of node %s, users %s went offline", node_id, offline)
+			self.on_users_offline([int(user_id) for user_id in offline])
+
+	@gen.coroutine
+	def heartbeat(self, timeout):
+		"""
+		Should be called periodically, more often than timeout
+		:param timeout: ms after which silent process is considered to be dead
+		"""
+		now = time.time()
+		self.redis.zadd(RedisPrefix.NODES, now, self.node_id)
+		is_leader = (yield self.acquire_leader_script(keys=[RedisPrefix.LEADER], args=[self.node_id, timeout])) == 1
+		if is_leader != self.is_leader:
+			logger.info("Node %s is %s the leader", self.node_id, "now" if is_leader else "no longer")
+			self.is_leader = is_leader
+		if is_leader:
+			dead_nodes = yield self.redis.zrangebyscore(RedisPrefix.NODES, '-inf', now - timeout / 1000.0)
+			for node_id in dead_nodes:
+				logger.warning("Node %s has stopped responding, removing its online", node_id)
+				yield self.flush_node(node_id)
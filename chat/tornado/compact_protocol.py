@@ -0,0 +1,108 @@
+import json
+import zlib
+
+from chat.tornado.constants import Actions, VarNames, IpVarNames, UserSettingsVarNames, UserProfileVarNames, \
+	HandlerNames, RedisPrefix
+
+ESCAPE = '$'  # keys that are not in the table start with it
+SEPARATORS = (',', ':')
+
+
+def constant_values(*classes):
+	values = set()
+	for cls in classes:
+		for name, value in vars(cls).items():
+			if not name.startswith('_') and isinstance(value, str) and '{}' not in value:
+				values.add(value)
+	return values
+
+
+def to_base36(number):
+	digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+	res = ''
+	while True:
+		number, rest = divmod(number, 36)
+		res = digits[rest] + res
+		if not number:
+			return res
+
+
+# sorted, so every process builds the same table
+KEYS_TABLE = sorted(constant_values(Actions, VarNames, IpVarNames, UserSettingsVarNames, UserProfileVarNames, HandlerNames))
+KEY_CODES = {key: to_base36(i) for i, key in enumerate(KEYS_TABLE)}
+CODE_KEYS = {code: key for key, code in KEY_CODES.items()}
+# incremented when coding of messages changes
+FORMAT_VERSION = 2
+# changes when constants or coding change, so frames encoded by another version of server can be detected
+TABLE_VERSION = '%08x' % zlib.crc32(','.join(KEYS_TABLE + [str(FORMAT_VERSION)]).encode('utf-8'))
+VALUE_CODES = {key: i for i, key in enumerate(KEYS_TABLE)}
+# values of these keys in the message itself are constants as well
+CODED_VALUES = (VarNames.EVENT, VarNames.HANDLER_NAME)
+
+
+def compact(data, top=True):
+	"""
+	Replaces dict keys with their short codes from KEYS_TABLE and action/handler names of the message
+	itself with their indexes in it. Nested dicts keep their values, and action/handler values
+	that are not in the table go under escaped key, so expand never mistakes them for indexes
+	:param top: data is the message itself, not its part
+	"""
+	if isinstance(data, dict):
+		res = {}
+		for key, value in data.items():
+			if not isinstance(key, str):
+				key = str(key)
+			code = KEY_CODES.get(key)
+			if code is not None and top and key in CODED_VALUES:
+				index = VALUE_CODES.get(value) if isinstance(value, str) else None
+				if index is None:
+					code = None
+				else:
+					value = index
+			if code is None:
+				code = ESCAPE + key
+			res[code] = compact(value, False)
+		return res
+	elif isinstance(data, (list, tuple)):
+		return [compact(v, False) for v in data]
+	return data
+
+
+def expand(data, top=True):
+	"""
+	Reverse of compact
+	"""
+	if isinstance(data, dict):
+		res = {}
+		for code, value in data.items():
+			if code.startswith(ESCAPE):
+				key = code[1:]
+			else:
+				key = CODE_KEYS[code]
+				if top and key in CODED_VALUES:
+					value = KEYS_TABLE[value]
+			res[key] = expand(value, False)
+		return res
+	elif isinstance(data, list):
+		return [expand(v, False) for v in data]
+	return data
+
+
+def dumps(message):
+	"""
+	:return: text marked with COMPACT_PREFIX
+	"""
+	return RedisPrefix.COMPACT_PREFIX + json.dumps(compact(message), separators=SEPARATORS)
+
+
+def loads(text):
+	"""
+	:param text: compact text with COMPACT_PREFIX or plain json
+	"""
+	if text.startswith(RedisPrefix.COMPACT_PREFIX):
+		return expand(json.loads(text[len(RedisPrefix.COMPACT_PREFIX):]))
+	return json.loads(text)
+
+
+def is_compact(text):
+	return text.startswith(RedisPrefix.COMPACT_PREFIX)
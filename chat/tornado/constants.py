@@ -3,6 +3,7 @@ from django.conf import settings
 class Actions(object):
 	LOGIN = 'addOnlineUser'
 	SET_WS_ID = 'setWsId'
+	RESUMED = 'resumed'
 	LOGOUT = 'removeOnlineUser'
 	SEND_MESSAGE = 'sendMessage'
 	PRINT_MESSAGE = 'printMessage'
@@ -77,11 +78,15 @@ class VarNames(object):
 	SYMBOL = 'symbol'
 	LOAD_MESSAGES_HISTORY = 'history'
 	LOAD_MESSAGES_OFFLINE = 'offline'
+	LOAD_MESSAGES_MORE = 'hasMore'
 	ONLINE = 'online'
 	TIME_DIFF ='timeDiff'
 	EDITED_TIMES = 'edited'
 	PREVIEW = 'preview'
 	DELETED = 'deleted'
+	USERS_VERSION = 'usersVersion'
+	USERS_DELTA = 'usersDelta'
+	COMPACT_KEYS = 'compactKeys'
 
 
 class IpVarNames(object):
@@ -131,7 +136,23 @@ class WebRtcRedisStates:
 class RedisPrefix:
 	USER_ID_CHANNEL_PREFIX = 'u'
 	PARSABLE_PREFIX = 'p'
-	ONLINE_VAR = 'online'
+	COMPACT_PREFIX = 'c'  # message is encoded with chat.tornado.compact_protocol
+	ONLINE_VAR = 'online_users'  # hash user_id -> amount of opened websockets
+	SESSIONS = 'sessions'  # hash session_id -> user_id
+	SESSIONS_CHANNEL = 'sessions_removed'  # ids of removed sessions are published here
+	NODE_ONLINE = 'online_users:%s'  # hash user_id -> amount of opened websockets in tornado process
+	NODES = 'tornado_nodes'  # sorted set of tornado processes by their last heartbeat
+	LEADER = 'tornado_leader'  # id of the process that runs periodic tasks
+	USERS_VERSION = 'users_version'  # incremented on every change of users directory
+	USERS_CHANGES = 'users_changes'  # sorted set user_id -> version of the last change
+	LAST_MESSAGE_ID = 'last_message_id'  # id of the latest sent message
+	LAST_READ_PENDING = 'last_read_pending'  # hash user_id -> id of the latest message user has read
+	ROOM_MESSAGES = 'room_messages:%s'  # sorted set message_id -> serialized message
+	ROOM_MESSAGES_FLOOR = 'room_messages_floor:%s'  # lowest message id of complete cached window
+	REPLAY_STATE = 'replay:%s'  # hash with owner, sequence number and channels of websocket by its id
+	REPLAY_FRAMES = 'replay_frames:%s'  # list of the latest frames written to websocket
+	SPAM_MESSAGES = 'spam:m:%s'  # hash with token bucket of messages sent by user
+	SPAM_BYTES = 'spam:b:%s'  # hash with token bucket of bytes sent by user
 	CONNECTION_ID_LENGTH = 8  # should be secure
 
 	@classmethod
@@ -0,0 +1,61 @@
+import logging
+
+from django.conf import settings
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatWheel(object):
+	"""
+	Hashed timing wheel of websockets that have been pinged and should answer with pong.
+	Each slot is a set of websockets that expire on the same tick, pong removes websocket
+	from its slot, so a tick only visits websockets that didn't respond.
+	"""
+
+	def __init__(self, timeout, tick):
+		"""
+		:param timeout: seconds that client has to respond to ping
+		:param tick: seconds between checks of expired websockets
+		"""
+		self.tick = tick
+		self.timeout_ticks = max(1, int(round(timeout / float(tick))))
+		self.slots = [set() for _ in range(self.timeout_ticks + 1)]
+		self.position = 0
+		self.positions = {}  # websocket -> index of its slot
+		self.callback = None
+
+	def expect_pong(self, handler):
+		"""
+		Closes handler if it doesn't call pong_received in timeout
+		:type handler: chat.tornado.tornado_handler.TornadoHandler
+		"""
+		if self.callback is None:
+			self.callback = PeriodicCallback(self.on_tick, self.tick * 1000)
+			self.callback.start()
+		self.cancel(handler)
+		index = (self.position + self.timeout_ticks) % len(self.slots)
+		self.slots[index].add(handler)
+		self.positions[handler] = index
+
+	def cancel(self, handler):
+		index = self.positions.pop(handler, None)
+		if index is not None:
+			self.slots[index].discard(handler)
+
+	def on_tick(self):
+		self.position = (self.position + 1) % len(self.slots)
+		expired = self.slots[self.position]
+		if not expired:
+			return
+		self.slots[self.position] = set()
+		logger.info("Closing %d websockets that didn't respond to ping", len(expired))
+		for handler in expired:
+			del self.positions[handler]
+			try:
+				handler.close(408, "Ping timeout")
+			except Exception as e:
+				logger.error("Unable to close websocket, because %s", e)
+
+
+heartbeat_wheel = HeartbeatWheel(settings.PING_CLOSE_SERVER_DELAY, 1)
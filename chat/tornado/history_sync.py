@@ -0,0 +1,137 @@
+import json
+import logging
+
+from django.db import connection
+from django.db.models import Q
+
+from chat.models import Message, get_milliseconds
+from chat.utils import ONE_DAY
+
+logger = logging.getLogger(__name__)
+
+
+def parse_known_messages(messages):
+	"""
+	:param messages: json of room_id -> the latest message id client has,
+	or room_id -> {'h': the oldest id, 'f': the latest id}
+	:return: dict room_id -> (oldest id or None, latest id)
+	"""
+	res = {}
+	if not messages:
+		return res
+	for room_id, ids in json.loads(messages).items():
+		if isinstance(ids, dict):
+			res[int(room_id)] = (ids.get('h'), ids['f'])
+		else:
+			res[int(room_id)] = (None, ids)
+	return res
+
+
+class HistorySync(object):
+	"""
+	Finds messages that client misses in every room on connect.
+	Every room is a keyset query on (room_id, id) limited to room_limit messages, the newest first.
+	Queries of rooms_per_query rooms are joined with UNION ALL, so a user with many rooms
+	costs a few round-trips and the result is processed room by room.
+	"""
+
+	def __init__(self, user_id, known, with_history, last_read, was_online, room_limit, rooms_per_query):
+		"""
+		:param known: result of parse_known_messages
+		:param with_history: load all messages since the oldest known, not only new and recently edited
+		:param last_read: dict room_id -> id of the latest message user has read
+		:param was_online: user has other tabs opened, so there are no offline messages
+		"""
+		self.user_id = user_id
+		self.known = known
+		self.with_history = with_history
+		self.last_read = last_read
+		self.was_online = was_online
+		self.room_limit = room_limit
+		self.rooms_per_query = rooms_per_query
+
+	def offline_after(self, room_id):
+		"""
+		:return: messages newer than this id are offline, None if there are no offline messages
+		"""
+		if self.was_online:
+			return None
+		return self.last_read.get(room_id)
+
+	def room_query(self, room_id):
+		"""
+		:return: Q of missing messages of the room, or None if client doesn't need any
+		"""
+		known = self.known.get(room_id)
+		offline_after = self.offline_after(room_id)
+		q = None
+		if known is not None:
+			oldest, latest = known
+			if self.with_history and oldest is not None:
+				q = Q(id__gte=oldest)
+			else:
+				q = Q(id__gt=latest) | Q(id__lte=latest, edited_times__gt=0, time__gt=get_milliseconds() - ONE_DAY)
+				if oldest is not None:
+					q &= Q(id__gt=latest) | Q(id__gte=oldest)
+		if offline_after is not None:
+			q = Q(id__gt=offline_after) if q is None else q | Q(id__gt=offline_after)
+		if q is None:
+			return None
+		return Q(room_id=room_id) & q
+
+	def fetch(self, room_queries):
+		"""
+		:param room_queries: list of (room_id, Q)
+		:return: messages of all rooms, up to room_limit + 1 per room
+		"""
+		querysets = [Message.objects.filter(q).order_by('-id')[:self.room_limit + 1] for _, q in room_queries]
+		if len(querysets) == 1:
+			return list(querysets[0])
+		if connection.features.supports_slicing_ordering_in_compound:
+			return list(querysets[0].union(*querysets[1:], all=True))
+		return [message for queryset in querysets for message in queryset]
+
+	def load_chunks(self, room_ids):
+		"""
+		Generator of lists of (room_id, messages sorted by id, whether older missing messages exist)
+		fetched by a single query, rooms without missing messages are skipped
+		"""
+		room_queries = [(room_id, q) for room_id, q in ((r, self.room_query(r)) for r in room_ids) if q is not None]
+		for i in range(0, len(room_queries), self.rooms_per_query):
+			chunk = room_queries[i:i + self.rooms_per_query]
+			by_room = {}
+			for message in self.fetch(chunk):
+				by_room.setdefault(message.room_id, []).append(message)
+			rooms = []
+			for room_id, _ in chunk:
+				messages = by_room.get(room_id)
+				if not messages:
+					continue
+				messages.sort(key=lambda m: m.id)
+				more = len(messages) > self.room_limit
+				if more:
+					messages = messages[1:]
+				rooms.append((room_id, messages, more))
+			yield rooms
+
+	def load(self, room_ids):
+		"""
+		Generator of (room_id, messages sorted by id, whether older missing messages exist)
+		"""
+		for rooms in self.load_chunks(room_ids):
+			for room in rooms:
+				yield room
+
+	def split(self, room_id, messages, restored):
+		"""
+		:param restored: client has restored its connection, so everything it misses is offline
+		:return: (offline messages, history messages)
+		"""
+		offline_after = self.offline_after(room_id)
+		if restored:
+			return messages, []
+		if offline_after is None:
+			return [], messages
+		offline = [m for m in messages if m.id > offline_after]
+		history = [m for m in messages if m.id <= offline_after]
+		return offline, history
@@ -1,7 +1,6 @@
 # -*- encoding: utf-8 -*-
 
 import datetime
-import json
 import re
 from concurrent.futures import ThreadPoolExecutor
 
@@ -17,21 +16,24 @@ from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
 from redis import ConnectionError
-from tornado import ioloop
+from tornado import gen, ioloop
 from tornado.concurrent import run_on_executor
+from tornado.httputil import parse_body_arguments
 
 from chat import settings
 from chat import utils, global_redis
-from chat.global_redis import sync_redis
+from chat.global_redis import sync_redis, session_cache
 from chat.log_filters import id_generator
+from chat.media_store import media_store, get_name_hash
 from chat.models import Issue, IssueDetails, IpAddress, UserProfile, Verification, Message, Subscription, \
 	SubscriptionMessages, RoomUsers, Room, UploadedFile, User
 from chat.socials import GoogleAuth, FacebookAuth
 from chat.tornado.constants import RedisPrefix
 from chat.tornado.message_creator import MessagesCreator
 from chat.tornado.method_dispatcher import MethodDispatcher, require_http_method, login_required_no_redirect, \
-	add_missing_fields, extract_nginx_files, check_captcha, get_user_id
-from chat.utils import check_user, get_message_images_videos, is_blank, get_or_create_ip_model, do_db
+	add_missing_fields, extract_nginx_files, check_captcha, get_user_id, run_on_db_executor
+from chat.tornado.upload_stream import UploadQuota, MultipartParser, get_boundary, MAX_FIELD_SIZE
+from chat.utils import check_user, get_message_images_videos, is_blank, get_or_create_ip_model, db_executor
 
 SERVER_ADDRESS = getattr(settings, "SERVER_ADDRESS", None)
 
@@ -58,8 +60,11 @@ class HttpHandler(MethodDispatcher):
 			raise ValidationError("password should be at least 3 symbols")
 
 	def __generate_session__(self, user_id):
+		"""
+		Blocking, runs in db executor
+		"""
 		session = id_generator(32)
-		sync_redis.hset('sessions', session, user_id)
+		session_cache.add(session, user_id)
 		return session
 
 	def __get_user_by_code(self, token, type):
@@ -126,11 +131,16 @@ class HttpHandler(MethodDispatcher):
 	def __mail_admins(self, *args, **kwargs):
 		mail_admins(*args, **kwargs)
 
-	def __send_sign_up_email(self, user):
+	@staticmethod
+	def __save_sign_up_verification(user):
 		verification = Verification(user=user, type_enum=Verification.TypeChoices.register)
 		verification.save()
 		user.email_verification = verification
 		user.save(update_fields=['email_verification'])
+		return verification
+
+	def __send_sign_up_email(self, user):
+		verification = yield db_executor.submit(self.__save_sign_up_verification, user)
 		link = "{}/#/confirm_email?token={}".format(self.__host, verification.token)
 		text = ('Hi {}, you have registered pychat'
 						'\nTo complete your registration please click on the url bellow: {}'
@@ -208,7 +218,7 @@ class HttpHandler(MethodDispatcher):
 
 	def __send_new_email_ver(self, user, email):
 		new_ver = Verification(user=user, type_enum=Verification.TypeChoices.confirm_email, email=email)
-		new_ver.save()
+		yield db_executor.submit(new_ver.save)
 		link = "{}/#/confirm_email?token={}".format(self.__host, new_ver.token)
 		text = ('Hi {}, you have changed email to curren on pychat \nTo verify it, please click on the url: {}') \
 			.format(user.username, link)
@@ -253,6 +263,7 @@ class HttpHandler(MethodDispatcher):
 		)
 
 	@require_http_method('GET')
+	@run_on_db_executor
 	def test(self):
 		try:
 			Room.objects.get(id=settings.ALL_ROOM_ID)
@@ -266,24 +277,26 @@ class HttpHandler(MethodDispatcher):
 
 	@login_required_no_redirect
 	@require_http_method('POST')
+	@run_on_db_executor
 	def logout(self, registration_id):
 		session_id = self.request.headers.get('session_id')
-		sync_redis.hdel('sessions', session_id)
+		session_cache.remove(session_id)
 		if registration_id is not None:
 			Subscription.objects.filter(registration_id=registration_id).delete()
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('POST')
 	@check_captcha()
+	@run_on_db_executor
 	def auth(self, username, password):
 		"""
 		Logs in into system.
 		"""
 		try:
 			if '@' in username:
-				user = do_db(UserProfile.objects.get, email=username)
+				user = UserProfile.objects.get(email=username)
 			else:
-				user = do_db(UserProfile.objects.get, username=username)
+				user = UserProfile.objects.get(username=username)
 			if not user.check_password(password):
 				raise ValidationError("Invalid password")
 		except User.DoesNotExist:
@@ -294,18 +307,24 @@ class HttpHandler(MethodDispatcher):
 	@add_missing_fields('email', 'sex')
 	# @transaction.atomic TODO, is this works in single thread?
 	def register(self, username, password, email, sex):
-		check_user(username)
 		self.__check_password(password)
+		user_profile = yield db_executor.submit(self.__create_user, username, password, email, sex)
+		if email:
+			yield from self.__send_sign_up_email(user_profile)
+		return (yield db_executor.submit(self.__generate_session__, user_profile.id))
+
+	def __create_user(self, username, password, email, sex):
+		check_user(username)
 		self.__check_email__(email)
 		user_profile = UserProfile(username=username, email=email, sex_str=sex)
 		user_profile.set_password(password)
 		user_profile.save()
 		RoomUsers(user_id=user_profile.id, room_id=settings.ALL_ROOM_ID, notifications=False).save()
-		if email:
-			yield from self.__send_sign_up_email(user_profile)
-		return self.__generate_session__(user_profile.id)
+		global_redis.user_directory.mark_changed(user_profile.id)
+		return user_profile
 
 	@require_http_method('GET')
+	@run_on_db_executor
 	def confirm_email(self, token):
 		"""
 		Accept the verification token sent to email
@@ -341,6 +360,7 @@ class HttpHandler(MethodDispatcher):
 		return (yield self.__oauth(token, FacebookAuth(self.logger)))
 
 	@require_http_method('POST')
+	@run_on_db_executor
 	def validate_user(self, username):
 		"""
 		Validates user during registration
@@ -353,7 +373,8 @@ class HttpHandler(MethodDispatcher):
 	@login_required_no_redirect
 	def register_fcb(self, registration_id, agent, is_mobile):
 		ip = yield from self.__get_or_create_ip()
-		Subscription.objects.update_or_create(
+		yield db_executor.submit(
+			Subscription.objects.update_or_create,
 			registration_id=registration_id, # TODO FCM
 			defaults={
 				'user_id': self.user_id,
@@ -367,6 +388,7 @@ class HttpHandler(MethodDispatcher):
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('GET')
+	@run_on_db_executor
 	# @transaction.atomic TODO, is this works in single thread?
 	def get_firebase_playback(self):
 		registration_id = self.request.headers('HTTP_AUTH')  # TODO FCM
@@ -396,18 +418,23 @@ class HttpHandler(MethodDispatcher):
 
 	@login_required_no_redirect
 	def change_password(self, password, old_password):
+		self.__check_password(password)
+		user = yield db_executor.submit(self.__update_password, password, old_password)
+		if user.email is not None:
+			yield from self.__send_password_changed(user.username, user.email)
+		return settings.VALIDATION_IS_OK
+
+	def __update_password(self, password, old_password):
 		user = UserProfile.objects.get(id=self.user_id)
 		if not user.check_password(old_password):
 			raise ValidationError("Invalid old password")
-		self.__check_password(password)
 		hash_pass = make_password(password)
 		User.objects.filter(id=user.id).update(
 			password=hash_pass
 		)
-		if user.email is not None:
-			yield from self.__send_password_changed(user.username, user.email)
-		return settings.VALIDATION_IS_OK
+		return user
 
+	@run_on_db_executor
 	# @transaction.atomic TODO, is this works in single thread?
 	def accept_token(self, token, password):
 		"""
@@ -424,6 +451,7 @@ class HttpHandler(MethodDispatcher):
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('POST')
+	@run_on_db_executor
 	def verify_token(self, token):
 		try:
 			self.logger.debug('Rendering restore password page with token  %s', token)
@@ -439,21 +467,22 @@ class HttpHandler(MethodDispatcher):
 
 	@login_required_no_redirect
 	def change_email_login(self, email, password):
-		userprofile = UserProfile.objects.get(id=self.user_id)
-		if not userprofile.check_password(password):
-			raise ValidationError("Invalid password")
+		userprofile, is_verified = yield db_executor.submit(self.__check_new_email, email, password)
 		if userprofile.email != email:
-			self.__check_email__(email)
-			if userprofile.email and userprofile.email_verification and userprofile.email_verification.verified:
+			if is_verified:
 				verification = Verification(
 					type_enum=Verification.TypeChoices.email,
 					user_id=self.user_id,
 					email=email
 				)
-				verification.save()
+				yield db_executor.submit(verification.save)
 			elif email:
 				new_ver = yield from self.__send_new_email_ver(userprofile, email)
-				UserProfile.objects.filter(id=self.user_id).update(email_verification_id=new_ver.id, email=email)
+				yield db_executor.submit(
+					UserProfile.objects.filter(id=self.user_id).update,
+					email_verification_id=new_ver.id,
+					email=email
+				)
 			yield from self.__send_email_changed(
 				userprofile.email,
 				email,
@@ -461,28 +490,47 @@ class HttpHandler(MethodDispatcher):
 			)
 		return settings.VALIDATION_IS_OK
 
+	def __check_new_email(self, email, password):
+		"""
+		:return: (UserProfile, whether current email is verified)
+		"""
+		userprofile = UserProfile.objects.get(id=self.user_id)
+		if not userprofile.check_password(password):
+			raise ValidationError("Invalid password")
+		if userprofile.email != email:
+			self.__check_email__(email)
+		is_verified = bool(userprofile.email and userprofile.email_verification and userprofile.email_verification.verified)
+		return userprofile, is_verified
+
 	@require_http_method('GET')
 	# @transaction.atomic TODO, is this works in single thread?
 	def change_email(self, token):
 		self.logger.debug('Proceed change email with token %s', token)
-		user, verification = self.__get_user_by_code(token, Verification.TypeChoices.email)
+		user, verification = yield db_executor.submit(self.__get_user_by_code, token, Verification.TypeChoices.email)
 		new_ver = yield from self.__send_new_email_ver(user, verification.email)
+		yield db_executor.submit(self.__apply_new_email, user, verification, new_ver)
+		return settings.VALIDATION_IS_OK
+
+	@staticmethod
+	def __apply_new_email(user, verification, new_ver):
 		user.email = verification.email
 		user.email_verification = new_ver
 		user.save(update_fields=('email', 'email_verification'))
 		verification.verified = True
 		verification.save(update_fields=('verified',))
-		return settings.VALIDATION_IS_OK
 
 	@require_http_method('POST')
 	@check_captcha()
 	def send_restore_password(self, username_or_password):
 		try:
-			user_profile = UserProfile.objects.get(Q(username=username_or_password) | Q(email=username_or_password))
+			user_profile = yield db_executor.submit(
+				UserProfile.objects.get,
+				Q(username=username_or_password) | Q(email=username_or_password)
+			)
 			if not user_profile.email:
 				raise ValidationError("You didn't specify email address for this user")
 			verification = Verification(type_enum=Verification.TypeChoices.password, user_id=user_profile.id)
-			verification.save()
+			yield db_executor.submit(verification.save)
 			try:
 				yield from self.__send_reset_password_email(user_profile.email, user_profile.username, verification)
 			except Exception as e:
@@ -503,6 +551,7 @@ class HttpHandler(MethodDispatcher):
 		return message
 
 	@require_http_method('POST')
+	@run_on_db_executor
 	def validate_email(self, email):
 		"""
 		POST only, validates email during registration
@@ -511,6 +560,7 @@ class HttpHandler(MethodDispatcher):
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('GET')
+	@run_on_db_executor
 	def profile(self, id):
 		try:
 			user_profile = UserProfile.objects.get(pk=id)
@@ -523,51 +573,64 @@ class HttpHandler(MethodDispatcher):
 	# @transaction.atomic TODO, is this works in single thread?
 	@require_http_method('POST')
 	def report_issue(self, issue, browser):
-		user_id = get_user_id(self.request)
-		issue_object = Issue.objects.get_or_create(content=issue)[0]
-		issue_details = IssueDetails(
-			sender_id=user_id,
-			browser=browser,
-			issue=issue_object
-		)
-		username = User.objects.get(id=user_id).username if user_id else None
+		user_id = yield get_user_id(self.request)
+		issue_details, username = yield db_executor.submit(self.__prepare_issue, issue, browser, user_id)
 
 		yield self.__mail_admins(
 			"{} reported issue".format(username),
 			issue,
 			fail_silently=True
 		)
-		issue_details.save()
+		yield db_executor.submit(issue_details.save)
 		return settings.VALIDATION_IS_OK
 
+	@staticmethod
+	def __prepare_issue(issue, browser, user_id):
+		issue_object = Issue.objects.get_or_create(content=issue)[0]
+		issue_details = IssueDetails(
+			sender_id=user_id,
+			browser=browser,
+			issue=issue_object
+		)
+		username = User.objects.get(id=user_id).username if user_id else None
+		return issue_details, username
+
 	@require_http_method('POST')
 	@login_required_no_redirect
 	@extract_nginx_files
+	@run_on_db_executor
 	def upload_profile_image(self, files):
 		"""
 		POST only, validates email during registration
 		"""
-		up = UserProfile(photo=files['file'], id=self.user_id)
+		previous = UserProfile.objects.filter(id=self.user_id).values_list('photo', flat=True).first()
+		up = UserProfile(photo=media_store.add_upload(files['file']), id=self.user_id)
 		up.save(update_fields=('photo',))
+		if previous:
+			media_store.release([previous])
 		url = up.photo.url
-		message = json.dumps(MessagesCreator.set_profile_image(url))
+		message = global_redis.encode_message(MessagesCreator.set_profile_image(url), False)
 		channel = RedisPrefix.generate_user(self.user_id)
 		global_redis.sync_redis.publish(channel, message)
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('GET')
+	@run_on_db_executor
 	def statistics(self):
 		pie_data = IpAddress.objects.values('country').filter(country__isnull=False).annotate(count=Count("country"))
 		return list(pie_data)
 
 	@require_http_method('POST')
 	@login_required_no_redirect
-	def search_messages(self, data, room, offset):
-		offset = int(offset)
+	@run_on_db_executor
+	def search_messages(self, data, room, before=None):
+		"""
+		:param before: id of the oldest message from the previous page
+		"""
+		before = int(before) if before else None
 		if not RoomUsers.objects.filter(room_id=room, user_id=self.user_id).exists():
 			raise ValidationError("You can't access this room")
-		messages = Message.objects.filter(content__icontains=data, room_id=room).order_by('-id')[
-					  offset:offset + settings.MESSAGES_PER_SEARCH]
+		messages = utils.find_messages(room, data, before, settings.MESSAGES_PER_SEARCH)
 		imv = get_message_images_videos(messages)
 		result = []
 		for message in messages:
@@ -578,6 +641,7 @@ class HttpHandler(MethodDispatcher):
 
 	@require_http_method('POST')
 	@login_required_no_redirect
+	@run_on_db_executor
 	# @transaction.atomic TODO, is this works in single thread?
 	def save_room_settings(self, roomId, roomName, volume, notifications):
 
@@ -601,6 +665,7 @@ class HttpHandler(MethodDispatcher):
 	@require_http_method('POST')
 	@login_required_no_redirect
 	@extract_nginx_files
+	@run_on_db_executor
 	# @transaction.atomic TODO, is this works in single thread?
 	def upload_file(self, files):
 		"""
@@ -611,9 +676,104 @@ class HttpHandler(MethodDispatcher):
 			up = UploadedFile(
 				symbol=name[1],
 				user_id=self.user_id,
-				file=value,
+				file=media_store.add_upload(value),
 				type_enum=UploadedFile.UploadedFileChoices(name[0])
 			)
 			up.save()
 			ufs.append(up.id)
 		return ufs
+
+
+class MediaFileHandler(tornado.web.StaticFileHandler):
+	"""
+	Serves MEDIA_ROOT, files of media store never change, so browsers cache them for CACHE_MAX_AGE
+	"""
+
+	def get_cache_time(self, path, modified, mime_type):
+		if get_name_hash(path) is not None:
+			return self.CACHE_MAX_AGE
+		return super(MediaFileHandler, self).get_cache_time(path, modified, mime_type)
+
+
+@tornado.web.stream_request_body
+class UploadHandler(HttpHandler):
+	"""
+	upload_file and upload_profile_image with body parsed as it arrives. Files are written
+	to MEDIA_ROOT chunk by chunk, so memory doesn't depend on their size, and session is checked
+	before the body is read. Every user can have UPLOAD_USER_QUOTA bytes being uploaded at once.
+	"""
+
+	quota = UploadQuota(settings.UPLOAD_USER_QUOTA)
+
+	def __init__(self, application, request, **kwargs):
+		self.parser = None
+		self.body = b''  # form of nginx_upload_module if it's not multipart
+		self.received = 0  # bytes of files acquired from quota
+		self.uploaded_files = {}  # field -> SpooledFile that isn't saved to db yet
+		super(UploadHandler, self).__init__(application, request, **kwargs)
+
+	@gen.coroutine
+	def prepare(self):
+		if self.request.method != 'POST':
+			return
+		self.user_id = yield get_user_id(self.request)
+		if self.user_id is None:
+			raise tornado.web.HTTPError(403, 'Missing or expired session_id header')
+		self.request.connection.set_max_body_size(settings.UPLOAD_MAX_SIZE)
+		try:
+			boundary = get_boundary(self.request.headers.get('Content-Type', ''))
+		except ValidationError as e:
+			self.finish(str(e.message))
+			return
+		if boundary is not None:
+			self.parser = MultipartParser(boundary, settings.MEDIA_ROOT, self.acquire_quota)
+			self.uploaded_files = self.parser.files
+
+	def acquire_quota(self, size):
+		self.quota.acquire(self.user_id, size)
+		self.received += size
+
+	def data_received(self, chunk):
+		if self._finished:
+			return
+		try:
+			if self.parser is not None:
+				self.parser.feed(chunk)
+			elif len(self.body) + len(chunk) > MAX_FIELD_SIZE:
+				raise ValidationError("Request body is too large")
+			else:
+				self.body += chunk
+		except ValidationError as e:
+			# connection is closed after response since body isn't read till the end
+			self.discard_uploads()
+			self.finish(str(e.message))
+
+	@gen.coroutine
+	def post(self):
+		if self.parser is None:
+			arguments = {}
+			parse_body_arguments(self.request.headers.get('Content-Type', ''), self.body, arguments, {})
+		elif not self.parser.finished:
+			self.discard_uploads()
+			self.finish("Multipart body is incomplete")
+			return
+		else:
+			arguments = self.parser.arguments
+		for name, values in arguments.items():
+			self.request.arguments.setdefault(name, []).extend(values)
+		yield super(UploadHandler, self).post()
+
+	def discard_uploads(self):
+		for spooled in self.uploaded_files.values():
+			spooled.remove()
+		self.uploaded_files = {}
+		if self.received:
+			self.quota.release(self.user_id, self.received)
+			self.received = 0
+
+	def on_connection_close(self):
+		super(UploadHandler, self).on_connection_close()
+		self.discard_uploads()
+
+	def on_finish(self):
+		self.discard_uploads()
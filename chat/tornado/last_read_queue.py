@@ -0,0 +1,124 @@
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from tornado import gen
+
+from chat.models import Message
+from chat.tornado.constants import RedisPrefix
+from chat.utils import db_executor
+
+logger = logging.getLogger(__name__)
+
+# Raises id of the latest message to ARGV[1]
+SET_LAST_MESSAGE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+if not current or current < tonumber(ARGV[1]) then
+	redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+# Marks user ARGV[1] to have read everything up to the latest message,
+# empty string means the latest message is unknown and user has read everything
+PUSH_SCRIPT = """
+local last = redis.call('GET', KEYS[2]) or ''
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current == '' or (current and last ~= '' and tonumber(current) >= tonumber(last)) then
+	return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], last)
+return 1
+"""
+
+# Takes all pending users
+POP_SCRIPT = """
+local pending = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return pending
+"""
+
+
+class LastReadQueue(object):
+	"""
+	Write-behind queue of last read messages. Closed websocket only marks its user in redis
+	with id of the latest message, so the user is written once per flush no matter how many
+	tabs have been closed, and rooms of many users are updated by a single query.
+	Pending users live in redis, so they survive restart of the process.
+	"""
+
+	def __init__(self, sync_redis, async_redis, batch_size):
+		"""
+		:type sync_redis: redis.StrictRedis
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param batch_size: max amount of users updated by a single query
+		"""
+		self.redis = async_redis
+		self.batch_size = batch_size
+		# new messages are saved in db executor
+		self.set_last_message_script = sync_redis.register_script(SET_LAST_MESSAGE_SCRIPT)
+		self.push_script = async_redis.register_script(PUSH_SCRIPT)
+		self.pop_script = async_redis.register_script(POP_SCRIPT)
+		self.flushing = False
+
+	def init_last_message(self):
+		"""
+		Executes db query, should be called on start before websockets are accepted
+		"""
+		max_id = Message.objects.all().aggregate(Max('id'))['id__max']
+		if max_id is not None:
+			self.set_last_message(max_id)
+
+	def set_last_message(self, message_id):
+		self.set_last_message_script(keys=[RedisPrefix.LAST_MESSAGE_ID], args=[message_id])
+
+	def push(self, user_id):
+		return self.push_script(keys=[RedisPrefix.LAST_READ_PENDING, RedisPrefix.LAST_MESSAGE_ID], args=[user_id])
+
+	@gen.coroutine
+	def pop(self):
+		"""
+		:return: list of (user_id, id of the latest message the user has read or None)
+		"""
+		raw = yield self.pop_script(keys=[RedisPrefix.LAST_READ_PENDING])
+		return [(int(raw[i]), int(raw[i + 1]) if raw[i + 1] else None) for i in range(0, len(raw), 2)]
+
+	def restore(self, pending):
+		"""
+		Returns users back if they couldn't be written, newer values that came meanwhile are kept
+		"""
+		return self.redis.pipeline([
+			('HSETNX', RedisPrefix.LAST_READ_PENDING, user_id, '' if message_id is None else message_id)
+			for user_id, message_id in pending
+		], RedisPrefix.LAST_READ_PENDING)
+
+	@staticmethod
+	def write(pending):
+		"""
+		Executes db query, runs in db executor
+		:return: amount of updated rooms
+		"""
+		rows = ' UNION ALL '.join(['SELECT %s user_id, %s message_id'] * len(pending))
+		params = [value for user in pending for value in user]
+		with connection.cursor() as cursor:
+			cursor.execute(settings.UPDATE_LAST_READ_MESSAGES.format(pending=rows), params)
+			return cursor.rowcount
+
+	@gen.coroutine
+	def flush(self):
+		if self.flushing:  # previous flush is still running
+			return
+		self.flushing = True
+		try:
+			pending = yield self.pop()
+			for i in range(0, len(pending), self.batch_size):
+				batch = pending[i:i + self.batch_size]
+				try:
+					updated = yield db_executor.submit(self.write, batch)
+					logger.debug("Updated last read message of %d rooms for %d users", updated, len(batch))
+				except Exception as e:
+					logger.error("Unable to update last read messages of %d users, because %s", len(batch), e)
+					yield self.restore(pending[i:])
+					break
+		finally:
+			self.flushing = False
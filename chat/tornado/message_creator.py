@@ -1,3 +1,5 @@
+import json
+
 from chat.models import get_milliseconds
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix, UserSettingsVarNames, \
 	UserProfileVarNames
@@ -34,9 +36,11 @@ class MessagesCreator(object):
 			VarNames.WEBRTC_OPPONENT_ID: self_id
 		}
 
-	def set_room(self, rooms, users, online, up):
+	def set_room(self, rooms, users, online, up, users_version, users_delta):
 		return {
 			VarNames.ROOM_USERS: users,
+			VarNames.USERS_VERSION: users_version,
+			VarNames.USERS_DELTA: users_delta,
 			VarNames.ONLINE: online,
 			VarNames.ROOMS: rooms,
 			VarNames.HANDLER_NAME: HandlerNames.WS,
@@ -48,6 +52,14 @@ class MessagesCreator(object):
 			VarNames.CURRENT_USER_INFO: self.get_user_profile(up),
 		}
 
+	@staticmethod
+	def resumed():
+		return {
+			VarNames.HANDLER_NAME: HandlerNames.WS,
+			VarNames.EVENT: Actions.RESUMED,
+			VarNames.TIME: get_milliseconds(),
+		}
+
 	def set_settings(self, js_message_id,  message):
 		return  {
 			VarNames.HANDLER_NAME: HandlerNames.WS,
@@ -112,18 +124,28 @@ class MessagesCreator(object):
 			UserProfileVarNames.SURNAME: up.surname,
 		}
 
-	def room_online_logout(self, online):
+	def room_online_logout(self):
 		"""
-		:return: {"action": event, "content": content, "time": "20:48:57"}
+		Only current user is sent, clients apply it to the online list from setWsId
+		:return: {"action": event, "userId": 1, "time": 1529434330000}
 		"""
-		room_less = self.default(online, Actions.LOGOUT, HandlerNames.CHANNELS)
-		return room_less
+		return self.user_logout(self.user_id)
+
+	@staticmethod
+	def user_logout(user_id):
+		return {
+			VarNames.EVENT: Actions.LOGOUT,
+			VarNames.CONTENT: None,
+			VarNames.USER_ID: user_id,
+			VarNames.TIME: get_milliseconds(),
+			VarNames.HANDLER_NAME: HandlerNames.CHANNELS
+		}
 
-	def room_online_login(self, online, sender_name, sex):
+	def room_online_login(self, sender_name, sex):
 		"""
-		:return: {"action": event, "content": content, "time": "20:48:57"}
+		:return: {"action": event, "userId": 1, "user": "name", "sex": "Male", "time": 1529434330000}
 		"""
-		room_less = self.default(online, Actions.LOGIN, HandlerNames.CHANNELS)
+		room_less = self.default(None, Actions.LOGIN, HandlerNames.CHANNELS)
 		room_less[VarNames.USER] = sender_name
 		room_less[VarNames.GENDER] = sex
 		return room_less
@@ -163,11 +185,22 @@ class MessagesCreator(object):
 		res[VarNames.HANDLER_NAME] = HandlerNames.CHANNELS
 		return res
 
+	@classmethod
+	def files_updated(cls, message, files):
+		"""
+		Message with files that have changed without user's edit, e.g. previews have been generated
+		:type message: chat.models.Message
+		"""
+		res = cls.create_message(message, files)
+		res[VarNames.EVENT] = Actions.EDIT_MESSAGE
+		res[VarNames.HANDLER_NAME] = HandlerNames.CHANNELS
+		return res
+
 	@classmethod
 	def append_images(cls, messages, files, prepare_img):
 		"""
 		:type messages: list[chat.models.Message] 
-		:type files: list[chat.models.Image]
+		:type files: dict[int, list[chat.models.Image]]
 		"""
 		res_mess = []
 		for message in messages:
@@ -178,7 +211,7 @@ class MessagesCreator(object):
 	@classmethod
 	def get_messages(cls, messages, channel, files, prepare_img, message_id):
 		"""
-		:type images: list[chat.models.Image]
+		:type files: dict[int, list[chat.models.Image]]
 		:type messages: list[chat.models.Message]
 		:type channel: str
 		"""
@@ -190,6 +223,20 @@ class MessagesCreator(object):
 			VarNames.HANDLER_NAME: HandlerNames.CHANNELS
 		}
 
+	@staticmethod
+	def get_cached_messages(raw_messages, channel, message_id):
+		"""
+		:param raw_messages: json strings of messages created by create_message
+		:return: json of get_messages response, messages are inserted without decoding
+		"""
+		envelope = json.dumps({
+			VarNames.EVENT: Actions.GET_MESSAGES,
+			VarNames.ROOM_ID: channel,
+			VarNames.JS_MESSAGE_ID: message_id,
+			VarNames.HANDLER_NAME: HandlerNames.CHANNELS
+		})
+		return '%s, "%s": [%s]}' % (envelope[:-1], VarNames.CONTENT, ','.join(raw_messages))
+
 	@staticmethod
 	def ping_client(time):
 		return {
@@ -202,15 +249,17 @@ class MessagesCreator(object):
 	def prepare_img_video(files, message_id):
 		"""
 		:type message_id: int
-		:type files: list[chat.models.Image]
+		:type files: dict[int, list[chat.models.Image]]
+		:param files: images grouped by message id, see chat.utils.group_images
 		"""
+		files = files.get(message_id)
 		if files:
 			return {x.symbol: {
 				VarNames.FILE_URL: x.img.url,
 				VarNames.FILE_TYPE: x.type,
 				VarNames.PREVIEW: x.preview.url if x.preview else None,
 				VarNames.IMAGE_ID: x.id
-			} for x in files if x.message_id == message_id}
+			} for x in files}
 
 	@property
 	def channel(self):
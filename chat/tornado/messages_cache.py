@@ -0,0 +1,133 @@
+import json
+import logging
+
+from chat.tornado.constants import RedisPrefix, VarNames
+
+logger = logging.getLogger(__name__)
+
+# Keys: KEYS[1] - sorted set message_id -> serialized message, KEYS[2] - floor,
+# the lowest message id since which the sorted set contains every message of the room, 0 for the whole room.
+# Without floor the sorted set is incomplete and can't be used for reading.
+
+# Replaces message with id ARGV[1] by ARGV[2], ARGV[3] - capacity, ARGV[4] - ttl
+PUT_SCRIPT = """
+local floor = tonumber(redis.call('GET', KEYS[2]))
+local id = tonumber(ARGV[1])
+if floor and id < floor then
+	return 0
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], id, id)
+redis.call('ZADD', KEYS[1], id, ARGV[2])
+if redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1) > 0 and floor then
+	local lowest = tonumber(redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2])
+	redis.call('SET', KEYS[2], math.max(floor, lowest))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if floor then
+	redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+return 1
+"""
+
+# Adds page loaded from db. ARGV[1] - capacity, ARGV[2] - ttl, ARGV[3] - id the page was loaded before
+# or empty string for the latest messages, ARGV[4] - floor of the page, then pairs of id, serialized message.
+# Messages that already exist are newer than the page, so they are not overwritten
+FILL_SCRIPT = """
+local floor = tonumber(redis.call('GET', KEYS[2]))
+if ARGV[3] ~= '' and (not floor or tonumber(ARGV[3]) < floor) then
+	return 0
+end
+for i = 5, #ARGV, 2 do
+	if redis.call('ZCOUNT', KEYS[1], ARGV[i], ARGV[i]) == 0 then
+		redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+	end
+end
+local new_floor = tonumber(ARGV[4])
+if floor then
+	new_floor = math.min(floor, new_floor)
+end
+if redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1) > 0 then
+	local lowest = tonumber(redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2])
+	new_floor = math.max(new_floor, lowest)
+end
+redis.call('SET', KEYS[2], new_floor, 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Returns up to ARGV[2] messages with id less than ARGV[1] (or the latest if ARGV[1] is empty), newest first.
+# nil if cached window doesn't contain enough messages
+GET_SCRIPT = """
+local floor = redis.call('GET', KEYS[2])
+if not floor then
+	return nil
+end
+local max = '+inf'
+if ARGV[1] ~= '' then
+	max = '(' .. ARGV[1]
+end
+local count = tonumber(ARGV[2])
+local messages = redis.call('ZREVRANGEBYSCORE', KEYS[1], max, floor, 'LIMIT', 0, count)
+if #messages < count and tonumber(floor) > 0 then
+	return nil
+end
+return messages
+"""
+
+
+class MessagesCache(object):
+	"""
+	Capped window of the latest messages of every room serialized the same way
+	they're sent to client, see MessagesCreator.create_message.
+	"""
+
+	def __init__(self, sync_redis, async_redis, capacity, ttl):
+		"""
+		:type sync_redis: redis.StrictRedis
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param capacity: max amount of messages cached per room
+		:param ttl: seconds since the last write after which cache of the room is dropped
+		"""
+		self.capacity = capacity
+		self.ttl = ttl
+		# messages are written from db executor, read on IOLoop
+		self.put_script = sync_redis.register_script(PUT_SCRIPT)
+		self.fill_script = sync_redis.register_script(FILL_SCRIPT)
+		self.get_script = async_redis.register_script(GET_SCRIPT)
+
+	@staticmethod
+	def keys(room_id):
+		return [RedisPrefix.ROOM_MESSAGES % room_id, RedisPrefix.ROOM_MESSAGES_FLOOR % room_id]
+
+	def put(self, room_id, message):
+		"""
+		Stores new or edited message
+		:param message: dict created by MessagesCreator.create_message
+		"""
+		self.put_script(
+			keys=self.keys(room_id),
+			args=[message[VarNames.MESSAGE_ID], json.dumps(message), self.capacity, self.ttl]
+		)
+
+	def fill(self, room_id, header_id, count, messages):
+		"""
+		Stores page of messages loaded from db
+		:param header_id: id the page was loaded before, None for the latest messages
+		:param count: requested size of the page
+		:param messages: list of dicts created by MessagesCreator.create_message, newest first
+		"""
+		if len(messages) < count:
+			floor = 0
+		else:
+			floor = messages[-1][VarNames.MESSAGE_ID]
+		args = [self.capacity, self.ttl, header_id or '', floor]
+		for message in messages:
+			args.append(message[VarNames.MESSAGE_ID])
+			args.append(json.dumps(message))
+		self.fill_script(keys=self.keys(room_id), args=args)
+
+	def get(self, room_id, header_id, count):
+		"""
+		:return: Future of list of serialized messages, newest first. None if they should be loaded from db
+		"""
+		return self.get_script(keys=self.keys(room_id), args=[header_id or '', count])
@@ -10,17 +10,16 @@ import tornado.web
 import tornado.web
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.files import File
-from django.core.files.base import ContentFile
 from tornado import gen
+from tornado.concurrent import is_future
 from tornado.httpclient import HTTPRequest
 
 from chat import settings
-from chat.global_redis import sync_redis
-from chat.models import get_random_path
+from chat.global_redis import session_cache
+from chat.media_store import Upload
 from chat.py2_3 import str_type
-import mimetypes
-from chat.utils import http_client, create_id
+from chat.tornado.upload_stream import get_extension
+from chat.utils import http_client, create_id, db_executor
 
 
 def add_missing_fields(*fields):
@@ -77,6 +76,8 @@ def check_captcha(field='g-recaptcha-response'):
 			result =  f(self, *args, **kwargs)
 			if isinstance(result, GeneratorType):
 				result = yield from result
+			elif is_future(result):
+				result = yield result
 			return result
 
 		wrap.__doc__ = f.__doc__
@@ -86,52 +87,51 @@ def check_captcha(field='g-recaptcha-response'):
 	return method_wrapper
 
 
+@gen.coroutine
 def get_user_id(request):
 	session_id = request.headers.get('session_id')
 	if session_id is None:
 		return None
-	user_id_raw = sync_redis.hget('sessions', session_id)
-	if user_id_raw is None:
-		return None
-	return int(user_id_raw)
+	user_id = yield session_cache.get(session_id)
+	return user_id
 
 
 def login_required_no_redirect(func):
 	def wrapper(self, *a, **ka):
-		self.user_id = get_user_id(self.request)
+		self.user_id = yield get_user_id(self.request)
 		self.logger = logging.LoggerAdapter(parent_logger, {
 			'id': create_id(self.user_id, self.id),
 			'ip': self.client_ip
 		})
 		if self.user_id is None:
 			raise tornado.web.HTTPError(403, 'Missing or expired session_id header')
-		return func(self, *a, **ka)
+		result = func(self, *a, **ka)
+		if isinstance(result, GeneratorType):
+			result = yield from result
+		elif is_future(result):
+			result = yield result
+		return result
+	wrapper.__doc__ = func.__doc__
+	wrapper.__name__ = func.__name__
 	return wrapper
 
 
 def extract_nginx_files(fn):
 	"""
 	extracts files for nginx_upload_module
-	or extracts files from tornado self.request
+	or takes files spooled to MEDIA_ROOT by UploadHandler, they are removed if fn fails.
+	fn gets dict field -> chat.media_store.Upload
 	"""
 
-	def get_extension(content_type, filename):
-		result = None
-		extension = None
-		if content_type:
-			if filename:
-				filename = os.path.basename(filename)
-				__, extension = os.path.splitext(filename)
-			extensions = mimetypes.guess_all_extensions(content_type)
-			if extension in extensions or filename in extensions:
-				result =  ''
-			else:
-				result = mimetypes.guess_extension(content_type)
-		return result or ''
-
 	def wrap(self, **kargs):
 		result = {}
-		if kargs:
+		uploaded = getattr(self, 'uploaded_files', None) or {}
+		if uploaded:
+			# handler doesn't remove them anymore, since they are going to be saved
+			self.uploaded_files = {}
+			for symbol, spooled in uploaded.items():
+				result[symbol] = Upload(spooled.path, spooled.name, spooled.hexdigest)
+		elif kargs:
 			files = {}
 			for (key, value) in kargs.items():
 				if key.endswith('.name'):
@@ -148,20 +148,35 @@ def extract_nginx_files(fn):
 				files.setdefault(realkey, {})
 				files[realkey][realvalue] = value
 			for symbol, data in files.items():  # nginx
-				file_path = get_random_path(None, data['name'])
-				file_path += get_extension(data['type'], data['name'])
-				os.rename(data['path'], os.sep.join((settings.MEDIA_ROOT, file_path)))
-				result[symbol] = file_path
-		else:
-			for request_file in self.request.files:
-				target_file = self.request.files[request_file][0]
-				name_with_ext = target_file['filename'] + get_extension(
-					target_file['content_type'],
-					target_file['filename']
-				)
-				result[request_file] = File(ContentFile(target_file['body']), name=name_with_ext)
-
-		return fn(self,result)
+				filename = data['name'] + get_extension(data['type'], data['name'])
+				result[symbol] = Upload(data['path'], filename, None)
+		try:
+			res = fn(self, result)
+			if isinstance(res, GeneratorType):
+				res = yield from res
+			elif is_future(res):
+				res = yield res
+		except Exception:
+			for spooled in uploaded.values():
+				spooled.remove()
+			raise
+		return res
+
+	wrap.__doc__ = fn.__doc__
+	wrap.__name__ = fn.__name__
+	return wrap
+
+
+def run_on_db_executor(fn):
+	"""
+	Runs the whole method in db_executor thread,
+	so it should only contain blocking ORM or sync redis calls
+	"""
+	def wrap(self, *args, **kwargs):
+		return db_executor.submit(fn, self, *args, **kwargs)
+
+	wrap.__doc__ = fn.__doc__
+	wrap.__name__ = fn.__name__
 	return wrap
 
 
@@ -253,6 +268,8 @@ class MethodDispatcher(tornado.web.RequestHandler):
 					result = func(**args)
 					if isinstance(result, GeneratorType):
 						result = yield from result
+					elif is_future(result):
+						result = yield result
 					if not isinstance(result, str):
 						result = json.dumps(result)
 					self.finish(result)
@@ -0,0 +1,274 @@
+import logging
+import struct
+import time
+from collections import deque
+
+from tornado.concurrent import Future
+from tornado.escape import utf8
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+from chat.tornado.ws_protocol import WsProtocol
+
+logger = logging.getLogger(__name__)
+
+WS_FIN_TEXT = 0x81  # FIN bit + text opcode
+WS_RSV1 = 0x40  # marks compressed message
+# seconds between checks of socket buffer while frames are queued
+DRAIN_CHECK_INTERVAL = 0.05
+
+
+def build_frame(first_byte, payload):
+	"""
+	Builds unmasked server websocket frame the same way WebSocketProtocol13._write_frame does
+	"""
+	length = len(payload)
+	if length < 126:
+		header = struct.pack("BB", first_byte, length)
+	elif length <= 0xFFFF:
+		header = struct.pack("!BBH", first_byte, 126, length)
+	else:
+		header = struct.pack("!BBQ", first_byte, 127, length)
+	return header + payload
+
+
+def build_text_frame(text):
+	"""
+	:return: (frame bytes, payload length)
+	"""
+	payload = utf8(text)
+	return build_frame(WS_FIN_TEXT, payload), len(payload)
+
+
+def build_deflate_frame(text, protocol):
+	"""
+	Only for connections without context takeover, each message is compressed by a new zlib object,
+	so the result is the same for every connection with the same options
+	:type protocol: chat.tornado.ws_protocol.WsProtocol
+	:return: (frame bytes, uncompressed payload length)
+	"""
+	payload = utf8(text)
+	return build_frame(WS_FIN_TEXT | WS_RSV1, protocol.compress(payload)), len(payload)
+
+
+class OutboundFrame(object):
+
+	def __init__(self, text, shared_message, key, droppable, wire_format, log):
+		self.text = text
+		self.shared_message = shared_message
+		self.wire_format = wire_format
+		self.key = key
+		self.droppable = droppable
+		self.dropped = False
+		self.log = log
+
+	def get_frame(self, protocol=None):
+		"""
+		:param protocol: WsProtocol of connection without context takeover, None for uncompressed frame
+		:return: (frame bytes, payload length)
+		"""
+		if protocol is None:
+			variant = (self.wire_format, 'text')
+			build = build_text_frame
+		else:
+			variant = (self.wire_format, 'deflate') + protocol.compression_variant
+			build = lambda text: build_deflate_frame(text, protocol)
+		if self.shared_message is not None:
+			return self.shared_message.get_frame(variant, lambda message: build(self.text))
+		return build(self.text)
+
+
+class OutboundQueue(object):
+	"""
+	Messages waiting to be sent to a single websocket. Only write_buffer bytes are passed
+	to the socket stream at once, the rest waits here until client reads them.
+	Frames with the same key replace each other, when limits are exceeded droppable frames are
+	thrown away, and if that doesn't help the client is disconnected as too slow.
+	"""
+
+	def __init__(self, handler, max_bytes, max_messages, write_buffer, compression_threshold):
+		"""
+		:type handler: chat.tornado.tornado_handler.TornadoHandler
+		:param compression_threshold: messages shorter than this are sent uncompressed
+		"""
+		self.handler = handler
+		self.max_bytes = max_bytes
+		self.max_messages = max_messages
+		self.write_buffer = write_buffer
+		self.compression_threshold = compression_threshold
+		self.compression_time = 0  # seconds spent compressing messages of this connection
+		self.frames = deque()
+		self.keys = {}  # key -> OutboundFrame
+		self.size = 0
+		self.count = 0
+		self.waiting_stream = False
+		self.drain_timeout = None
+		self.flush_futures = []
+
+	def put(self, text, shared_message=None, key=None, droppable=False, wire_format='json', log=False):
+		"""
+		:param text: json or compact text to send
+		:param shared_message: PubSubMessage whose frame can be reused between websockets
+		:param key: frame replaces queued frame with the same key
+		:param droppable: frame can be thrown away if client is too slow
+		:param wire_format: representation of shared_message the text is, e.g. json or compact
+		:param log: pass the frame to handler.on_frames_written when it's written, dropped frames are not passed
+		"""
+		if self.handler.ws_connection is None:
+			return False
+		if key is not None:
+			previous = self.keys.pop(key, None)
+			if previous is not None:
+				self.drop(previous)
+		frame = OutboundFrame(text, shared_message, key, droppable, wire_format, log)
+		if key is not None:
+			self.keys[key] = frame
+		self.frames.append(frame)
+		self.size += len(text)
+		self.count += 1
+		if self.size > self.max_bytes or self.count > self.max_messages:
+			self.drop_droppable()
+			if self.size > self.max_bytes or self.count > self.max_messages:
+				self.handler.logger.warning(
+					"Closing slow websocket, %d messages of %d bytes are waiting", self.count, self.size)
+				self.clear()
+				self.handler.close(1008, "Slow consumer")
+				return False
+		self.send()
+		return True
+
+	def flush(self):
+		"""
+		:return: Future resolved when all queued frames are passed to socket
+		"""
+		future = Future()
+		if self.frames:
+			self.flush_futures.append(future)
+		else:
+			future.set_result(None)
+		return future
+
+	def drop(self, frame):
+		frame.dropped = True
+		self.size -= len(frame.text)
+		self.count -= 1
+
+	def drop_droppable(self):
+		dropped = 0
+		for frame in self.frames:
+			if frame.droppable and not frame.dropped:
+				self.drop(frame)
+				if frame.key is not None:
+					del self.keys[frame.key]
+				dropped += 1
+		if dropped:
+			self.frames = deque(f for f in self.frames if not f.dropped)
+			self.handler.logger.warning("Client is too slow, dropped %d messages", dropped)
+
+	def logged_frames(self):
+		"""
+		:return: texts of queued frames that should be logged, in order they would be written
+		"""
+		return [frame.text for frame in self.frames if frame.log and not frame.dropped]
+
+	def clear(self):
+		self.stop_waiting()
+		self.frames.clear()
+		self.keys.clear()
+		self.size = 0
+		self.count = 0
+		self.resolve_flush()
+
+	def resolve_flush(self):
+		futures = self.flush_futures
+		self.flush_futures = []
+		for future in futures:
+			future.set_result(None)
+
+	def pop(self):
+		frame = self.frames.popleft()
+		if not frame.dropped:
+			self.drop(frame)
+			if frame.key is not None:
+				del self.keys[frame.key]
+			return frame
+		return None
+
+	def send(self):
+		if self.waiting_stream:  # will be continued when socket drains
+			return
+		if self.handler.ws_connection is None:
+			self.clear()
+			return
+		protocol = WsProtocol(self.handler.ws_connection)
+		written = None
+		chunks = []
+		logged = []
+		try:
+			buffered = protocol.buffered_bytes()
+			while self.frames and buffered < self.write_buffer:
+				frame = self.pop()
+				if frame is None:
+					continue
+				if frame.log:
+					logged.append(frame.text)
+				compress = protocol.compressed and len(frame.text) >= self.compression_threshold
+				if compress and protocol.context_takeover:
+					# deflate context belongs to connection, frame can't be reused
+					if chunks:
+						protocol.write(b''.join(chunks))
+						chunks = []
+					start = time.time()
+					written = protocol.write_message(frame.text)
+					self.compression_time += time.time() - start
+					buffered = protocol.buffered_bytes()
+				else:
+					# coalesce frames into a single write
+					data, payload_length = frame.get_frame(protocol if compress else None)
+					protocol.count_written(payload_length, len(data))
+					chunks.append(data)
+					buffered += len(data)
+			if chunks:
+				written = protocol.write(b''.join(chunks))
+			if self.frames:
+				self.wait_stream(written)
+			else:
+				self.resolve_flush()
+		except StreamClosedError:
+			protocol.abort()
+			self.clear()
+		finally:
+			if logged:
+				self.handler.on_frames_written(logged)
+
+	def wait_stream(self, written):
+		"""
+		Continues sending when our write reaches the socket. IOStream replaces its write future
+		on every write, so the future of our write never resolves if tornado writes a pong
+		or a close frame after it, socket buffer is polled for that case
+		:param written: Future of the last write of this queue or None
+		"""
+		self.waiting_stream = True
+		if written is not None:
+			IOLoop.current().add_future(written, self.on_stream_written)
+		self.drain_timeout = IOLoop.current().call_later(DRAIN_CHECK_INTERVAL, self.on_drain_check)
+
+	def stop_waiting(self):
+		self.waiting_stream = False
+		if self.drain_timeout is not None:
+			IOLoop.current().remove_timeout(self.drain_timeout)
+			self.drain_timeout = None
+
+	def on_stream_written(self, future):
+		if not self.waiting_stream:  # future of a previous wait
+			return
+		self.stop_waiting()
+		if future.exception() is not None:
+			self.clear()
+		else:
+			self.send()
+
+	def on_drain_check(self):
+		self.drain_timeout = None
+		self.stop_waiting()
+		self.send()
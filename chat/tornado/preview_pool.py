@@ -0,0 +1,154 @@
+import logging
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.db.models import Q
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from chat.media_store import media_store
+from chat.models import Image, Message
+from chat.tornado.constants import VarNames
+from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.preview_worker import PilImage, make_image_preview, make_video_preview
+from chat.utils import db_executor, group_images
+
+logger = logging.getLogger(__name__)
+
+# types of Image that get a preview
+IMAGE_TYPES = (Image.MediaTypeChoices.image.value,)
+VIDEO_TYPES = (Image.MediaTypeChoices.video.value, 'm')  # 'm' is UploadedFile media_record
+
+
+class PreviewPool(object):
+	"""
+	Generates downscaled previews of images and poster frames of videos sent in messages.
+	Decoding runs in worker processes, so IOLoop and db threads aren't blocked by big files.
+	When previews of a message are saved to Image.preview, the room gets the message
+	with updated files as editMessage, so clients load previews instead of originals.
+	"""
+
+	def __init__(self, publish, messages_cache, workers, size, quality, max_size, ffmpeg):
+		"""
+		:param publish: function(channel, message) that sends message to room
+		:type messages_cache: chat.tornado.messages_cache.MessagesCache
+		:param workers: amount of processes, 0 disables previews
+		:param size: max width and height of preview
+		:param max_size: images waiting for a worker, previews of the rest are skipped
+		:param ffmpeg: executable that extracts poster frames, None disables previews of videos
+		"""
+		self.publish = publish
+		self.messages_cache = messages_cache
+		self.workers = workers
+		self.size = size
+		self.quality = quality
+		self.max_size = max_size
+		self.ffmpeg = ffmpeg
+		self.executor = None  # created on first use
+		self.pending = 0
+		if workers > 0 and sys.version_info < (3, 7):
+			logger.warning("Previews are disabled, spawning preview processes requires python 3.7")
+			self.workers = 0
+
+	@property
+	def enabled(self):
+		return self.workers > 0 and (PilImage is not None or self.ffmpeg is not None)
+
+	def put(self, files):
+		"""
+		Returns immediately, previews are generated in background
+		:param files: files of a single message, result of MessagesCreator.prepare_img_video
+		"""
+		if not self.enabled or not files:
+			return
+		image_ids = [f[VarNames.IMAGE_ID] for f in files.values() if not f[VarNames.PREVIEW]]
+		if not image_ids:
+			return
+		if self.pending + len(image_ids) > self.max_size:
+			logger.warning("Preview queue is full, skipping images %s", image_ids)
+			return
+		self.pending += len(image_ids)
+		IOLoop.current().spawn_callback(self.process, image_ids)
+
+	@gen.coroutine
+	def process(self, image_ids):
+		try:
+			images = yield db_executor.submit(self.load, image_ids)
+			paths = yield [self.generate(*image) for image in images]
+			previews = {image[0]: path for image, path in zip(images, paths) if path}
+			if previews:
+				message = yield db_executor.submit(self.save, previews)
+				if message is not None:
+					self.publish(message[VarNames.ROOM_ID], message)
+		except Exception as e:
+			logger.error("Unable to generate previews of images %s, because %s", image_ids, e)
+		finally:
+			self.pending -= len(image_ids)
+
+	def load(self, image_ids):
+		"""
+		Blocking, runs in db executor
+		:return: list of (image id, type, path of original) that need a preview
+		"""
+		types = []
+		if PilImage is not None:
+			types.extend(IMAGE_TYPES)
+		if self.ffmpeg is not None:
+			types.extend(VIDEO_TYPES)
+		images = Image.objects.filter(Q(preview__isnull=True) | Q(preview=''), id__in=image_ids, type__in=types) \
+			.values_list('id', 'type', 'img')
+		return [(image_id, media_type, media_store.path(img)) for image_id, media_type, img in images if img]
+
+	@gen.coroutine
+	def generate(self, image_id, media_type, src):
+		"""
+		:return: path of preview or None
+		"""
+		if self.executor is None:
+			# forked process would inherit locks held by db and redis threads of this one at the moment of fork
+			self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+		executor = self.executor
+		try:
+			if media_type in IMAGE_TYPES:
+				path = yield executor.submit(make_image_preview, src, media_store.media_root, self.size, self.quality)
+			else:
+				path = yield executor.submit(
+					make_video_preview, src, media_store.media_root, self.size, self.quality, self.ffmpeg)
+		except BrokenProcessPool as e:  # a process has crashed, e.g. on a malformed image
+			logger.error("Preview processes have died on image %s, because %s", image_id, e)
+			if self.executor is executor:
+				self.executor = None
+				executor.shutdown(wait=False)
+			return None
+		except Exception as e:
+			logger.warning("Unable to generate preview of image %s, because %s", image_id, e)
+			return None
+		logger.debug("Generated preview %s of image %s", path, image_id)
+		return path
+
+	def save(self, previews):
+		"""
+		Blocking, runs in db executor. Images that have got a preview meanwhile keep it
+		:param previews: dict image id -> path of preview, all images are of the same message
+		:return: message with all its files, None if nothing has been saved
+		"""
+		message_id = None
+		for image_id, path in previews.items():
+			name = media_store.add(path, path)
+			updated = Image.objects.filter(Q(preview__isnull=True) | Q(preview=''), id=image_id).update(preview=name)
+			if updated:
+				message_id = Image.objects.filter(id=image_id).values_list('message_id', flat=True).first()
+			else:
+				media_store.release([name])
+		if message_id is None:
+			return None
+		message = Message.objects.get(id=message_id)
+		files = MessagesCreator.prepare_img_video(group_images(Image.objects.filter(message_id=message_id)), message_id)
+		self.messages_cache.put(message.room_id, MessagesCreator.create_message(message, files))
+		return MessagesCreator.files_updated(message, files)
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=False)
@@ -0,0 +1,58 @@
+"""
+Functions that run in preview processes. Processes are spawned, not forked, so they import
+only this module, which mustn't depend on django settings or models
+"""
+import os
+import subprocess
+import tempfile
+
+try:
+	from PIL import Image as PilImage
+except ImportError:  # Pillow is optional, previews of images are skipped without it
+	PilImage = None
+
+FFMPEG_TIMEOUT = 60
+
+
+def make_image_preview(src, media_root, size, quality):
+	"""
+	:return: path of jpeg in media_root, None if image is already small or can't be read
+	"""
+	with PilImage.open(src) as img:
+		if img.width <= size and img.height <= size:
+			return None
+		img.draft('RGB', (size, size))  # jpeg is decoded at lower scale, way faster for photos
+		img.thumbnail((size, size))
+		if img.mode != 'RGB':
+			img = img.convert('RGB')
+		fd, path = tempfile.mkstemp(dir=media_root, suffix='.jpg')
+		with os.fdopen(fd, 'wb') as f:
+			img.save(f, 'JPEG', quality=quality, optimize=True)
+	return path
+
+
+def make_video_preview(src, media_root, size, quality, ffmpeg):
+	"""
+	Takes the most representative of the first frames
+	:return: path of jpeg in media_root, None if ffmpeg failed
+	"""
+	fd, path = tempfile.mkstemp(dir=media_root, suffix='.jpg')
+	os.close(fd)
+	scale = 'thumbnail,scale=w=%d:h=%d:force_original_aspect_ratio=decrease' % (size, size)
+	# ffmpeg quality is 2..31 lower is better, pillow's is 1..95 higher is better
+	q = max(2, min(31, 31 - quality * 29 // 95))
+	try:
+		subprocess.run(
+			[ffmpeg, '-v', 'error', '-y', '-i', src, '-vf', scale, '-frames:v', '1', '-q:v', str(q), path],
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.PIPE,
+			timeout=FFMPEG_TIMEOUT,
+			check=True
+		)
+	except Exception:
+		os.remove(path)
+		raise
+	if not os.path.getsize(path):
+		os.remove(path)
+		return None
+	return path
@@ -0,0 +1,170 @@
+import json
+import logging
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+
+from chat.models import RoomUsers, Subscription, SubscriptionMessages
+from chat.tornado.constants import RedisPrefix
+from chat.utils import db_executor, http_client
+
+logger = logging.getLogger(__name__)
+
+# FCM errors after which registration id will never be valid again
+DEAD_TOKEN_ERRORS = ('NotRegistered', 'InvalidRegistration', 'MismatchSenderId')
+# FCM errors after which the same request can succeed later
+RETRY_ERRORS = ('Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded')
+
+
+class PushQueue(object):
+	"""
+	Firebase notifications of sent messages, taken off the send path.
+	Messages are collected for batch_interval ms, then offline recipients of all of them are found
+	by a couple of queries and every device gets a single push, since client fetches
+	the message itself via get_firebase_playback. Registration ids are posted in chunks of batch_size,
+	failed chunks are retried with exponential backoff, dead tokens are deactivated by a single query.
+	"""
+
+	def __init__(self, async_redis, api_key, url, batch_size, batch_interval, max_size, retries, retry_delay):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param api_key: FIREBASE_API_KEY, notifications are disabled if it's None
+		:param batch_size: max registration ids in a single request, 1000 is the limit of FCM
+		:param max_size: messages waiting for the next batch, the rest are dropped
+		:param retry_delay: ms before the first retry, doubled for every next one
+		"""
+		self.redis = async_redis
+		self.api_key = api_key
+		self.url = url
+		self.batch_size = batch_size
+		self.batch_interval = batch_interval
+		self.max_size = max_size
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.pending = []  # (room_id, message_id)
+		self.scheduled = False
+
+	@property
+	def enabled(self):
+		return self.api_key is not None
+
+	def put(self, room_id, message_id):
+		"""
+		Returns immediately, recipients are resolved on the next flush
+		"""
+		if not self.enabled:
+			return
+		if len(self.pending) >= self.max_size:
+			logger.warning("Push queue is full, skipping notification of message %s", message_id)
+			return
+		self.pending.append((room_id, message_id))
+		if not self.scheduled:
+			self.scheduled = True
+			IOLoop.current().call_later(self.batch_interval / 1000.0, self.flush)
+
+	@gen.coroutine
+	def flush(self):
+		self.scheduled = False
+		pending = self.pending
+		self.pending = []
+		if not pending:
+			return
+		try:
+			online = yield self.redis.hkeys(RedisPrefix.ONLINE_VAR)
+			reg_ids = yield db_executor.submit(self.save_subscriptions, pending, [int(user_id) for user_id in online])
+		except Exception as e:
+			logger.error("Unable to find subscriptions of %d messages, because %s", len(pending), e)
+			return
+		if not reg_ids:
+			return
+		logger.debug("Notifying %d devices about %d messages", len(reg_ids), len(pending))
+		results = yield [self.send(reg_ids[i:i + self.batch_size]) for i in range(0, len(reg_ids), self.batch_size)]
+		dead = [reg_id for batch_dead in results for reg_id in batch_dead]
+		if dead:
+			logger.info("Deactivating %d subscriptions", len(dead))
+			try:
+				yield db_executor.submit(self.deactivate, dead)
+			except Exception as e:
+				logger.error("Unable to deactivate subscriptions, because %s", e)
+
+	@staticmethod
+	def save_subscriptions(pending, online):
+		"""
+		Blocking, runs in db executor
+		:param pending: list of (room_id, message_id)
+		:param online: ids of users that receive messages via websocket
+		:return: unique registration ids of offline recipients
+		"""
+		room_ids = {room_id for room_id, _ in pending}
+		room_users = {}
+		for room_id, user_id in RoomUsers.objects.filter(room_id__in=room_ids, notifications=True) \
+				.exclude(user_id__in=online).values_list('room_id', 'user_id'):
+			room_users.setdefault(room_id, []).append(user_id)
+		user_ids = {user_id for users in room_users.values() for user_id in users}
+		if not user_ids:
+			return []
+		user_subscriptions = {}
+		for subscription_id, user_id, reg_id in Subscription.objects.filter(user_id__in=user_ids, inactive=False) \
+				.values_list('id', 'user_id', 'registration_id'):
+			user_subscriptions.setdefault(user_id, []).append((subscription_id, reg_id))
+		sub_messages = []
+		reg_ids = {}
+		for room_id, message_id in pending:
+			for user_id in room_users.get(room_id, ()):
+				for subscription_id, reg_id in user_subscriptions.get(user_id, ()):
+					sub_messages.append(SubscriptionMessages(message_id=message_id, subscription_id=subscription_id))
+					reg_ids[reg_id] = True
+		SubscriptionMessages.objects.bulk_create(sub_messages)
+		return list(reg_ids)
+
+	@staticmethod
+	def deactivate(reg_ids):
+		Subscription.objects.filter(registration_id__in=reg_ids).update(inactive=True)
+
+	@gen.coroutine
+	def send(self, reg_ids):
+		"""
+		Posts a single chunk, retrying devices that failed temporarily
+		:return: registration ids that are no longer valid
+		"""
+		dead = []
+		for attempt in range(self.retries + 1):
+			if attempt:
+				delay = self.retry_delay * 2 ** (attempt - 1)
+				logger.info("Retrying push to %d devices in %dms", len(reg_ids), delay)
+				yield gen.sleep(delay / 1000.0)
+			reg_ids, batch_dead = yield self.post(reg_ids)
+			dead.extend(batch_dead)
+			if not reg_ids:
+				break
+		else:
+			logger.error("Giving up push to %d devices after %d retries", len(reg_ids), self.retries)
+		return dead
+
+	@gen.coroutine
+	def post(self, reg_ids):
+		"""
+		:return: (registration ids to retry, registration ids that are no longer valid)
+		"""
+		headers = {"Content-Type": "application/json", "Authorization": "key=%s" % self.api_key}
+		body = json.dumps({"registration_ids": reg_ids})
+		request = HTTPRequest(self.url, method="POST", headers=headers, body=body)
+		response = yield http_client.fetch(request, raise_error=False)
+		if response.code >= 500 or response.code == 599:  # 599 is a network error
+			logger.warning("FireBase responded %s for %d devices", response.code, len(reg_ids))
+			return reg_ids, []
+		try:
+			results = json.loads(response.body.decode('utf-8'))['results']
+		except Exception as e:
+			logger.error("Unable to parse FireBase response %s %.1000s, because %s", response.code, response.body, e)
+			return [], []
+		retry = []
+		dead = []
+		for reg_id, result in zip(reg_ids, results):
+			error = result.get('error')
+			if error in DEAD_TOKEN_ERRORS:
+				dead.append(reg_id)
+			elif error in RETRY_ERRORS:
+				retry.append(reg_id)
+		return retry, dead
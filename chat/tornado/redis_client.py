@@ -0,0 +1,360 @@
+import hashlib
+import logging
+import zlib
+from collections import deque
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK = 64 * 1024
+
+
+class RedisError(Exception):
+	"""
+	Error reply of redis
+	"""
+	pass
+
+
+def encode_command(args):
+	"""
+	:return: command in redis protocol
+	"""
+	res = [b'*%d\r\n' % len(args)]
+	for arg in args:
+		if isinstance(arg, str):
+			arg = arg.encode('utf-8')
+		elif not isinstance(arg, bytes):
+			arg = str(arg).encode('utf-8')
+		res.append(b'$%d\r\n' % len(arg))
+		res.append(arg)
+		res.append(b'\r\n')
+	return b''.join(res)
+
+
+class ReplyParser(object):
+	"""
+	Incremental parser of redis replies. Bulk strings are decoded, since everything this app keeps
+	in redis is utf-8 text. Error replies are returned as RedisError, so replies of a pipeline stay in order.
+	Position, length of the bulk string being received and unfinished arrays are kept between reads,
+	so every byte is parsed once however replies are split.
+	"""
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.pos = 0
+		self.bulk_length = None  # header of bulk string is parsed, its data isn't received yet
+		self.arrays = []  # [items, amount of items left] of unfinished arrays, innermost last
+
+	def feed(self, data):
+		"""
+		:raises ValueError: if data isn't a valid reply, the connection can't be used after it
+		:return: list of replies completed by data
+		"""
+		self.buffer += data
+		replies = []
+		while True:
+			if self.bulk_length is not None:
+				end = self.pos + self.bulk_length
+				if len(self.buffer) < end + 2:
+					break
+				reply = self.buffer[self.pos:end].decode('utf-8')
+				self.pos = end + 2
+				self.bulk_length = None
+			else:
+				end = self.buffer.find(b'\r\n', self.pos)
+				if end < 0:
+					break
+				prefix = self.buffer[self.pos:self.pos + 1]
+				line = bytes(self.buffer[self.pos + 1:end])
+				self.pos = end + 2
+				if prefix == b'$':
+					length = int(line)
+					if length >= 0:
+						self.bulk_length = length
+						continue
+					reply = None
+				elif prefix == b':':
+					reply = int(line)
+				elif prefix == b'+':
+					reply = line.decode('utf-8')
+				elif prefix == b'-':
+					reply = RedisError(line.decode('utf-8'))
+				elif prefix == b'*':
+					length = int(line)
+					if length > 0:
+						self.arrays.append([[], length])
+						continue
+					reply = [] if length == 0 else None
+				else:
+					raise ValueError('Unknown reply type %r' % bytes(prefix))
+			while self.arrays:
+				array = self.arrays[-1]
+				array[0].append(reply)
+				array[1] -= 1
+				if array[1]:
+					break
+				reply = self.arrays.pop()[0]
+			else:
+				replies.append(reply)
+		if self.pos:
+			del self.buffer[:self.pos]
+			self.pos = 0
+		return replies
+
+
+class Connection(object):
+	"""
+	Single redis connection on IOLoop, connects lazily and reconnects on the next command after failure.
+	Commands are written without waiting for replies of previous ones.
+	"""
+
+	def __init__(self, host, port, db):
+		self.host = host
+		self.port = port
+		self.db = db
+		self.stream = None
+		self.connecting = False
+		self.write_queue = []  # commands written before connection is established
+		self.parser = None
+
+	def write(self, data):
+		if self.stream is not None:
+			try:
+				self.stream.write(data)
+			except StreamClosedError:
+				pass  # read loop fails waiting commands
+		else:
+			self.write_queue.append(data)
+			if not self.connecting:
+				self.connect()
+
+	@gen.coroutine
+	def connect(self):
+		self.connecting = True
+		try:
+			stream = yield TCPClient().connect(self.host, self.port)
+		except Exception as e:
+			logger.error("Unable to connect to redis %s:%s, because %s", self.host, self.port, e)
+			self.connecting = False
+			self.write_queue = []
+			self.on_close(e)
+			return
+		stream.set_nodelay(True)
+		self.connecting = False
+		self.stream = stream
+		self.parser = ReplyParser()
+		queue = [encode_command(('SELECT', self.db))] + self.write_queue
+		self.write_queue = []
+		self.on_connect()
+		try:
+			stream.write(b''.join(queue))
+			yield self.read_loop(stream)
+		except Exception as e:
+			if isinstance(e, StreamClosedError):
+				logger.warning("Redis connection %s:%s has been closed", self.host, self.port)
+			else:  # replies can't be matched to commands anymore
+				logger.error("Closing redis connection %s:%s, unable to parse reply, because %s", self.host, self.port, e)
+				stream.close()
+			if self.stream is stream:
+				self.stream = None
+			self.on_close(e)
+
+	@gen.coroutine
+	def read_loop(self, stream):
+		while True:
+			data = yield stream.read_bytes(READ_CHUNK, partial=True)
+			for reply in self.parser.feed(data):
+				try:
+					self.on_reply(reply)
+				except Exception as e:
+					logger.exception("Unable to process redis reply, because %s", e)
+
+	def on_connect(self):
+		pass
+
+	def on_reply(self, reply):
+		raise NotImplementedError()
+
+	def on_close(self, error):
+		raise NotImplementedError()
+
+
+class CommandConnection(Connection):
+	"""
+	Replies are matched to commands in order they were sent
+	"""
+
+	def __init__(self, host, port, db):
+		super(CommandConnection, self).__init__(host, port, db)
+		self.waiting = deque()  # futures of sent commands
+
+	def on_connect(self):
+		self.waiting.appendleft(Future())  # reply to SELECT
+
+	def execute(self, *args):
+		future = Future()
+		self.waiting.append(future)
+		self.write(encode_command(args))
+		return future
+
+	def execute_many(self, commands):
+		"""
+		Writes all commands at once
+		:return: list of futures in order of commands
+		"""
+		futures = [Future() for _ in commands]
+		self.waiting.extend(futures)
+		self.write(b''.join(encode_command(command) for command in commands))
+		return futures
+
+	def on_reply(self, reply):
+		future = self.waiting.popleft()
+		if isinstance(reply, RedisError):
+			future.set_exception(reply)
+		else:
+			future.set_result(reply)
+
+	def on_close(self, error):
+		waiting = self.waiting
+		self.waiting = deque()
+		for future in waiting:
+			future.set_exception(StreamClosedError(real_error=error))
+
+
+class PubSubConnection(Connection):
+	"""
+	Connection in subscribed state, incoming messages are passed to on_message(channel, body)
+	"""
+
+	def __init__(self, host, port, db, on_message, on_disconnect):
+		super(PubSubConnection, self).__init__(host, port, db)
+		self.on_message = on_message
+		self.on_disconnect = on_disconnect
+
+	def subscribe(self, channels):
+		self.write(encode_command(['SUBSCRIBE'] + list(channels)))
+
+	def unsubscribe(self, channels):
+		self.write(encode_command(['UNSUBSCRIBE'] + list(channels)))
+
+	def on_reply(self, reply):
+		# replies to SELECT and (UN)SUBSCRIBE aren't needed
+		if isinstance(reply, list) and reply[0] == 'message':
+			self.on_message(reply[1], reply[2])
+		elif isinstance(reply, RedisError):
+			logger.error("Pubsub error %s", reply)
+
+	def on_close(self, error):
+		self.on_disconnect()
+
+
+class AsyncRedis(object):
+	"""
+	Non-blocking redis client for IOLoop. Commands are pipelined over pool_size connections,
+	the connection is chosen by key, so commands with the same key are executed in order they were sent.
+	Every method returns Future, replies are decoded to str.
+	"""
+
+	def __init__(self, host, port, db, pool_size=1):
+		self.connections = [CommandConnection(host, port, db) for _ in range(pool_size)]
+
+	def get_connection(self, key):
+		if len(self.connections) == 1 or key is None:
+			return self.connections[0]
+		if isinstance(key, str):
+			key = key.encode('utf-8')
+		elif not isinstance(key, bytes):
+			key = str(key).encode('utf-8')
+		return self.connections[zlib.crc32(key) % len(self.connections)]
+
+	def execute(self, *args, route=None):
+		"""
+		:param route: key that chooses connection, first argument after command name by default
+		"""
+		if route is None and len(args) > 1:
+			route = args[1]
+		return self.get_connection(route).execute(*args)
+
+	def pipeline(self, commands, route=None):
+		"""
+		Sends commands in a single write
+		:return: Future of list of replies, raises the first error
+		"""
+		return gen.multi(self.get_connection(route).execute_many(commands))
+
+	def publish(self, channel, message):
+		return self.execute('PUBLISH', channel, message)
+
+	def get(self, key):
+		return self.execute('GET', key)
+
+	def hget(self, key, field):
+		return self.execute('HGET', key, field)
+
+	def hset(self, key, field, value):
+		return self.execute('HSET', key, field, value)
+
+	def hdel(self, key, *fields):
+		return self.execute('HDEL', key, *fields)
+
+	def hkeys(self, key):
+		return self.execute('HKEYS', key)
+
+	@gen.coroutine
+	def hgetall(self, key):
+		res = yield self.execute('HGETALL', key)
+		return dict(zip(res[::2], res[1::2]))
+
+	def hscan(self, key, cursor, count):
+		return self.execute('HSCAN', key, cursor, 'COUNT', count)
+
+	def smembers(self, key):
+		return self.execute('SMEMBERS', key)
+
+	def zadd(self, key, score, member):
+		return self.execute('ZADD', key, score, member)
+
+	def zrangebyscore(self, key, min_score, max_score):
+		return self.execute('ZRANGEBYSCORE', key, min_score, max_score)
+
+	def ping(self):
+		return self.execute('PING')
+
+	def register_script(self, script):
+		return Script(self, script)
+
+
+class Script(object):
+	"""
+	Lua script executed by EVALSHA, loaded into redis on NOSCRIPT reply
+	"""
+
+	def __init__(self, client, script):
+		"""
+		:type client: AsyncRedis
+		"""
+		self.client = client
+		self.script = script
+		self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+	@gen.coroutine
+	def __call__(self, keys=(), args=(), route=None):
+		"""
+		:param route: key that chooses connection, the first key by default
+		"""
+		keys = list(keys)
+		args = list(args)
+		if route is None and keys:
+			route = keys[0]
+		try:
+			res = yield self.client.execute('EVALSHA', self.sha, len(keys), *(keys + args), route=route)
+		except RedisError as e:
+			if not str(e).startswith('NOSCRIPT'):
+				raise
+			res = yield self.client.execute('EVAL', self.script, len(keys), *(keys + args), route=route)
+		return res
@@ -0,0 +1,187 @@
+import json
+
+from tornado import gen
+
+from chat.tornado.constants import RedisPrefix
+
+# KEYS[1] - hash with state of websocket, KEYS[2] - list of its latest frames
+# ARGV: ttl, owner, node id, user id, channels, version of compact keys table or empty string for json
+START_SCRIPT = """
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('HMSET', KEYS[1], 'owner', ARGV[2], 'node', ARGV[3], 'user_id', ARGV[4], 'seq', 0, 'channels', ARGV[5], 'compact', ARGV[6])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# ARGV: ttl, max frames, owner, frames...
+# returns sequence number of the last frame or -1 if websocket has been resumed by another owner
+APPEND_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[3] then
+	return -1
+end
+for i = 4, #ARGV do
+	redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', #ARGV - 3)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return seq
+"""
+
+# ARGV: ttl, owner, channels
+DETACH_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] then
+	return 0
+end
+redis.call('HSET', KEYS[1], 'channels', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+# ARGV: owner, channels
+SET_CHANNELS_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+	return 0
+end
+redis.call('HSET', KEYS[1], 'channels', ARGV[2])
+return 1
+"""
+
+# ARGV: owner
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+	return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+return 1
+"""
+
+# KEYS[3] - sorted set of tornado processes by their last heartbeat
+# ARGV: ttl, new owner, new node id, user id, sequence number client has received, oldest alive heartbeat
+# returns false if frames after client sequence number are not in the log,
+# otherwise {seq, channels, compact, {frames after client sequence number}}
+CLAIM_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'user_id', 'seq', 'channels', 'compact', 'node')
+if state[1] ~= ARGV[4] then
+	return false
+end
+-- previous owner has died, messages published since then are not in the log
+local heartbeat = redis.call('ZSCORE', KEYS[3], state[5])
+if not heartbeat or tonumber(heartbeat) < tonumber(ARGV[6]) then
+	return false
+end
+local seq = tonumber(state[2])
+local client_seq = tonumber(ARGV[5])
+local length = redis.call('LLEN', KEYS[2])
+if client_seq > seq or client_seq < seq - length then
+	return false
+end
+redis.call('HMSET', KEYS[1], 'owner', ARGV[2], 'node', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return {state[2], state[3], state[4], redis.call('LRANGE', KEYS[2], length - (seq - client_seq), -1)}
+"""
+
+
+def count_overlap(logged, received):
+	"""
+	Messages published after the new websocket has subscribed can be also logged by the old one.
+	Both receive pubsub messages in the same order, so duplicates are the end of log and the start of received.
+	:return: amount of received texts that are already at the end of logged
+	"""
+	for length in range(min(len(logged), len(received)), 0, -1):
+		if logged[-length:] == received[:length]:
+			return length
+	return 0
+
+
+class ReplayLog(object):
+	"""
+	Latest frames written to every websocket, stored in redis by websocket id.
+	Client that reconnects with the same id and amount of frames it has received
+	gets the rest from the log instead of loading everything from db.
+	Closed websocket stays subscribed for a grace period and keeps writing its messages to the log.
+	Every websocket state has an owner, so only one process writes frames of it.
+	"""
+
+	def __init__(self, async_redis, size, ttl, grace):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param size: max frames kept for a single websocket
+		:param ttl: seconds state of an idle opened websocket is kept
+		:param grace: seconds closed websocket can be resumed
+		"""
+		self.redis = async_redis
+		self.size = size
+		self.ttl = ttl
+		self.grace = grace
+		self.start_script = async_redis.register_script(START_SCRIPT)
+		self.append_script = async_redis.register_script(APPEND_SCRIPT)
+		self.detach_script = async_redis.register_script(DETACH_SCRIPT)
+		self.set_channels_script = async_redis.register_script(SET_CHANNELS_SCRIPT)
+		self.release_script = async_redis.register_script(RELEASE_SCRIPT)
+		self.claim_script = async_redis.register_script(CLAIM_SCRIPT)
+
+	@staticmethod
+	def keys(ws_id):
+		return [RedisPrefix.REPLAY_STATE % ws_id, RedisPrefix.REPLAY_FRAMES % ws_id]
+
+	def start(self, ws_id, owner, node_id, user_id, channels, compact):
+		"""
+		Drops log of the previous websocket with the same id, sequence starts from 0
+		:param compact: version of compact keys table client has, empty string for json
+		"""
+		return self.start_script(
+			keys=self.keys(ws_id),
+			args=[self.ttl, owner, node_id, user_id, json.dumps(channels), compact],
+			route=ws_id
+		)
+
+	def append(self, ws_id, owner, frames):
+		"""
+		:return: Future of sequence number of the last frame, -1 if websocket is owned by another handler
+		"""
+		return self.append_script(keys=self.keys(ws_id), args=[self.ttl, self.size, owner] + list(frames), route=ws_id)
+
+	def detach(self, ws_id, owner, channels):
+		"""
+		Websocket has been closed, log is kept only for grace period
+		"""
+		return self.detach_script(keys=self.keys(ws_id), args=[self.grace, owner, json.dumps(channels)], route=ws_id)
+
+	def set_channels(self, ws_id, owner, channels):
+		"""
+		Detached websocket has joined or left a room, resumed one takes channels from the state
+		"""
+		return self.set_channels_script(keys=self.keys(ws_id), args=[owner, json.dumps(channels)], route=ws_id)
+
+	def release(self, ws_id, owner):
+		return self.release_script(keys=self.keys(ws_id), args=[owner], route=ws_id)
+
+	@gen.coroutine
+	def get_channels(self, ws_id):
+		"""
+		:return: channels of websocket or None if it can't be resumed
+		"""
+		channels = yield self.redis.execute('HGET', RedisPrefix.REPLAY_STATE % ws_id, 'channels', route=ws_id)
+		return json.loads(channels) if channels else None
+
+	@gen.coroutine
+	def claim(self, ws_id, owner, node_id, user_id, seq, alive_since):
+		"""
+		Takes ownership of websocket state
+		:param seq: amount of frames client has received
+		:param alive_since: previous owner process should have sent a heartbeat after this time
+		:return: (sequence number, channels, compact table version, frames client misses)
+		or None if websocket can't be resumed
+		"""
+		res = yield self.claim_script(
+			keys=self.keys(ws_id) + [RedisPrefix.NODES],
+			args=[self.ttl, owner, node_id, user_id, seq, alive_since],
+			route=ws_id
+		)
+		if not res:
+			return None
+		return int(res[0]), json.loads(res[1]), res[2], res[3]
@@ -0,0 +1,88 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from tornado import gen
+
+from chat.tornado.constants import RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache(object):
+	"""
+	In-process LRU cache of redis `sessions` hash session_id -> user_id.
+	Only existing sessions are cached, entries live for ttl seconds at most.
+	Removed sessions are announced in SESSIONS_CHANNEL, so every process drops them.
+	Sessions are read on IOLoop, created and removed in db executor threads.
+	"""
+
+	def __init__(self, sync_redis, async_redis, capacity, ttl):
+		"""
+		:type sync_redis: redis.StrictRedis
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param ttl: seconds, bounds staleness if an invalidation is lost while pubsub reconnects
+		"""
+		self.redis = sync_redis
+		self.async_redis = async_redis
+		self.capacity = capacity
+		self.ttl = ttl
+		self.logger = logger
+		self.lock = Lock()
+		self.entries = OrderedDict()  # session_id -> (user_id, expires_at)
+		self.generation = 0  # incremented on invalidation, so a concurrent read doesn't cache removed session
+
+	@gen.coroutine
+	def get(self, session_id):
+		"""
+		:return: user_id or None if session doesn't exist
+		"""
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(session_id)
+			if entry is not None:
+				if entry[1] > now:
+					self.entries.move_to_end(session_id)
+					return entry[0]
+				del self.entries[session_id]
+			generation = self.generation
+		user_id = yield self.async_redis.hget(RedisPrefix.SESSIONS, session_id)
+		if user_id is None:
+			return None
+		user_id = int(user_id)
+		self.put(session_id, user_id, generation)
+		return user_id
+
+	def put(self, session_id, user_id, generation=None):
+		with self.lock:
+			if generation is not None and generation != self.generation:
+				return
+			self.entries[session_id] = (user_id, time.time() + self.ttl)
+			self.entries.move_to_end(session_id)
+			if len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
+
+	def add(self, session_id, user_id):
+		self.redis.hset(RedisPrefix.SESSIONS, session_id, user_id)
+		self.put(session_id, user_id)
+
+	def remove(self, session_id):
+		self.redis.hdel(RedisPrefix.SESSIONS, session_id)
+		self.invalidate(session_id)
+		self.redis.publish(RedisPrefix.SESSIONS_CHANNEL, json.dumps(session_id))
+
+	def invalidate(self, session_id):
+		with self.lock:
+			self.generation += 1
+			self.entries.pop(session_id, None)
+
+	def on_pub_sub_message(self, message):
+		"""
+		Called by SubscriptionHub for SESSIONS_CHANNEL
+		:type message: chat.tornado.subscription_hub.PubSubMessage
+		"""
+		session_id = json.loads(message.text)
+		logger.debug("Invalidating session %s", session_id)
+		self.invalidate(session_id)
@@ -0,0 +1,150 @@
+import json
+import logging
+
+from tornado.ioloop import IOLoop
+
+from chat.tornado import compact_protocol
+from chat.tornado.constants import RedisPrefix
+from chat.tornado.redis_client import PubSubConnection
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1  # seconds
+
+
+class PubSubMessage(object):
+	"""
+	Redis pubsub message decoded once per process and shared between all local recipients.
+	Body is either json or compact text, the other representation is created on first access.
+	Handlers must treat it as read-only.
+	"""
+
+	def __init__(self, channel, body):
+		self.channel = channel
+		self.body = body
+		if body.startswith(RedisPrefix.PARSABLE_PREFIX):
+			body = body[len(RedisPrefix.PARSABLE_PREFIX):]
+			self.parsed = compact_protocol.loads(body)
+		else:
+			self.parsed = None
+		if compact_protocol.is_compact(body):
+			self._compact = body
+			self._text = None
+		else:
+			self._compact = None
+			self._text = body
+		self._frames = {}
+		self._decoded = self.parsed
+
+	@property
+	def text(self):
+		"""
+		:return: json representation
+		"""
+		if self._text is None:
+			self._text = json.dumps(self.decoded)
+		return self._text
+
+	@property
+	def compact(self):
+		"""
+		:return: compact representation, json for messages that are not json dicts
+		"""
+		if self._compact is None:
+			decoded = self.decoded
+			self._compact = self._text if decoded is None else compact_protocol.dumps(decoded)
+		return self._compact
+
+	@property
+	def decoded(self):
+		"""
+		Message that is sent to client as is gets decoded on first access, once per process
+		:return: dict or None if message isn't json
+		"""
+		if self._decoded is None:
+			try:
+				self._decoded = compact_protocol.loads(self._text if self._compact is None else self._compact)
+			except ValueError:
+				self._decoded = {}
+		return self._decoded or None
+
+	def get_frame(self, variant, build):
+		"""
+		:param variant: key of the wire representation, e.g. plain or compressed
+		:param build: callable that creates the representation from this message
+		:return: cached result of build(self)
+		"""
+		frame = self._frames.get(variant)
+		if frame is None:
+			frame = self._frames[variant] = build(self)
+		return frame
+
+
+class SubscriptionHub(object):
+	"""
+	Multiplexes redis pub/sub channels of every websocket in this process over
+	a single connection. Each channel is subscribed in redis only once,
+	while the hub counts local handlers listening to it and dispatches
+	incoming messages to them.
+	"""
+
+	def __init__(self, host, port, db):
+		self.redis = PubSubConnection(host, port, db, self.on_message, self.on_disconnect)
+		self.handlers = {}  # channel -> set of MessagesHandler
+
+	def subscribe(self, handler, channels):
+		"""
+		Registers handler for channels, only channels that had no local listeners
+		before hit redis
+		"""
+		new_channels = []
+		for channel in channels:
+			key = str(channel)
+			handlers = self.handlers.setdefault(key, set())
+			if not handlers:
+				new_channels.append(key)
+			handlers.add(handler)
+		if new_channels:
+			logger.debug("Subscribing hub to %s", new_channels)
+			self.redis.subscribe(new_channels)
+
+	def unsubscribe(self, handler, channels):
+		"""
+		Removes handler from channels, channels without local listeners are unsubscribed in redis
+		"""
+		empty_channels = []
+		for channel in channels:
+			key = str(channel)
+			handlers = self.handlers.get(key)
+			if handlers is None:
+				continue
+			handlers.discard(handler)
+			if not handlers:
+				del self.handlers[key]
+				empty_channels.append(key)
+		if empty_channels:
+			logger.debug("Unsubscribing hub from %s", empty_channels)
+			self.redis.unsubscribe(empty_channels)
+
+	def _resubscribe(self):
+		if self.handlers:
+			self.redis.subscribe(list(self.handlers.keys()))
+
+	def on_disconnect(self):
+		logger.error("Hub lost redis connection, resubscribing in %ss", RECONNECT_DELAY)
+		IOLoop.current().call_later(RECONNECT_DELAY, self._resubscribe)
+
+	def on_message(self, channel, body):
+		handlers = self.handlers.get(channel)
+		if not handlers:
+			return
+		try:
+			shared_message = PubSubMessage(channel, body)
+		except ValueError as e:
+			logger.error("Unable to decode message %.1000s from %s, because %s", body, channel, e)
+			return
+		for handler in list(handlers):  # handler can unsubscribe while processing
+			try:
+				handler.on_pub_sub_message(shared_message)
+			except Exception as e:
+				handler.logger.exception("Unable to process pubsub message, because %s", e)
@@ -1,26 +1,33 @@
 import json
 import logging
-from datetime import timedelta
+import time
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import F, Q, Count
-from itertools import chain
-from tornado import ioloop, gen
-from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from django.db.models import Q
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.web import MissingArgumentError
+from tornado.websocket import WebSocketHandler
 
-from chat.models import User, Message, UserJoinedInfo, Room, RoomUsers, UserProfile
+from chat.log_filters import id_generator
+from chat.models import UserJoinedInfo, Room, RoomUsers, UserProfile
 from chat.py2_3 import str_type
+from chat.tornado import compact_protocol
 from chat.tornado.anti_spam import AntiSpam
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix
+from chat.tornado.heartbeat import heartbeat_wheel
+from chat.tornado.history_sync import HistorySync, parse_known_messages
 from chat.tornado.message_creator import MessagesCreator
 from chat.tornado.message_handler import MessagesHandler, WebRtcMessageHandler
-from chat.utils import execute_query, do_db, get_message_images_videos, get_history_message_query, create_id, \
-	get_or_create_ip_model
+from chat.tornado.outbound_queue import OutboundQueue
+from chat.tornado.replay_log import count_overlap
+from chat.tornado.ws_protocol import WsProtocol
+from chat.utils import get_message_images_videos, create_id, \
+	get_or_create_ip_model, db_executor
 
 parent_logger = logging.getLogger(__name__)
 
-
 class Error401(Exception):
 	pass
 
@@ -31,7 +38,20 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		super(TornadoHandler, self).__init__(*args, **kwargs)
 		self.__connected__ = False
 		self.restored_connection = False
-		self.anti_spam = AntiSpam()
+		self.anti_spam = None  # created when user is known
+		self.protocol = None
+		self.compact = False  # client has negotiated compact protocol and received its keys table
+		self.replay_owner = None  # token of this handler in replay log while frames are logged
+		self.detached = False  # closed, but still subscribed, so client can resume
+		self.detach_timeout = None
+		self.resume_buffer = None  # pubsub messages received while frames are replayed
+		self.outbound = OutboundQueue(
+			self,
+			settings.WS_OUTBOUND_MAX_BYTES,
+			settings.WS_OUTBOUND_MAX_MESSAGES,
+			settings.WS_OUTBOUND_WRITE_BUFFER,
+			settings.WS_COMPRESSION_THRESHOLD
+		)
 
 	@property
 	def connected(self):
@@ -44,6 +64,14 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 	def data_received(self, chunk):
 		pass
 
+	def get_compression_options(self):
+		if settings.WS_COMPRESSION:
+			return {
+				'compression_level': settings.WS_COMPRESSION_LEVEL,
+				'mem_level': settings.WS_COMPRESSION_MEM_LEVEL
+			}
+
+	@gen.coroutine
 	def on_message(self, json_message):
 		message = None
 		try:
@@ -51,51 +79,118 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 				raise ValidationError('Skipping message %s, as websocket is not initialized yet' % json_message)
 			if not json_message:
 				raise Exception('Skipping null message')
-			# self.anti_spam.check_spam(json_message)
+			yield self.anti_spam.check_spam(json_message)
 			self.logger.debug('<< %.1000s', json_message)
-			message = json.loads(json_message)
+			message = compact_protocol.loads(json_message)
 			if message[VarNames.EVENT] not in self.process_ws_message:
 				raise Exception("event {} is unknown".format(message[VarNames.EVENT]))
+			self.anti_spam.check_action(message[VarNames.EVENT])
 			channel = message.get(VarNames.ROOM_ID)
 			if channel and channel not in self.channels:
 				raise ValidationError('Access denied for channel {}. Allowed channels: {}'.format(channel, self.channels))
-			self.process_ws_message[message[VarNames.EVENT]](message)
+			result = self.process_ws_message[message[VarNames.EVENT]](message)
+			if result is not None:  # coroutine, next frame is read only when it's processed
+				yield result
 		except ValidationError as e:
 			error_message = self.default(str(e.message), Actions.GROWL_MESSAGE, HandlerNames.WS)
 			if message:
 				error_message[VarNames.JS_MESSAGE_ID] = message.get(VarNames.JS_MESSAGE_ID, None)
 			self.ws_write(error_message)
+		# don't read next frame until client receives what has been sent to it
+		yield self.outbound.flush()
 
 	def on_close(self):
-		if self.async_redis.subscribed:
-			self.logger.info("Close event, unsubscribing from %s", self.channels)
-			self.async_redis.unsubscribe(self.channels)
+		self.log_traffic()
+		heartbeat_wheel.cancel(self)
+		detach = self.replay_owner is not None and self.connected
+		# client hasn't received queued frames, they are logged so it gets them on resume
+		queued = self.outbound.logged_frames() if detach else []
+		self.outbound.clear()
+		if self.anti_spam is not None:
+			self.anti_spam.close()
+		if detach:
+			self.logger.info("Close event, websocket can be resumed in %ss", self.replay_log.grace)
+			self.detached = True
+			if queued:
+				self.log_frames(queued)
+			self.replay_log.detach(self.id, self.replay_owner, self.channels)
+			self.detach_timeout = IOLoop.current().call_later(self.replay_log.grace, self.finish_detach)
 		else:
-			self.logger.info("Close event, not subscribed, channels: %s", self.channels)
-		self.async_redis_publisher.srem(RedisPrefix.ONLINE_VAR, self.id)
-		is_online, online = self.get_online_and_status_from_redis()
-		if self.connected:
-			if not is_online:
-				message = self.room_online_logout(online)
-				self.publish(message, settings.ALL_ROOM_ID)
-			res = do_db(execute_query, settings.UPDATE_LAST_READ_MESSAGE, [self.user_id, ])
-			self.logger.info("Updated %s last read message", res)
+			self.unsubscribe_all()
+
+	def on_channels_changed(self):
+		"""
+		Detached websocket still follows room events, its replay state is the only place resumed one gets them from
+		"""
+		if self.detached and self.replay_owner is not None:
+			self.replay_log.set_channels(self.id, self.replay_owner, self.channels)
+
+	def process_ping_message(self, message):
+		"""
+		Detached websocket has nobody to answer, and pings would push messages out of its replay log
+		"""
+		if self.detached:
+			return True
+		return super(TornadoHandler, self).process_ping_message(message)
+
+	def finish_detach(self):
+		"""
+		Client hasn't resumed in grace period or has resumed in another websocket
+		"""
+		if not self.detached:
+			return
+		self.detached = False
+		IOLoop.current().remove_timeout(self.detach_timeout)
+		if self.replay_owner is not None:
+			self.replay_log.release(self.id, self.replay_owner)
+			self.replay_owner = None
+		self.unsubscribe_all()
+
+	def unsubscribe_all(self):
+		self.logger.info("Close event, unsubscribing from %s", self.channels)
+		self.subscription_hub.unsubscribe(self, self.channels)
+		was_connected = self.connected
 		self.disconnect()
+		if self.id is not None:  # id is generated right before user is added to online
+			IOLoop.current().spawn_callback(self.leave, was_connected)
+
+	@gen.coroutine
+	def leave(self, was_connected):
+		"""
+		Removes closed websocket from online, announces logout if it was the last tab of user
+		"""
+		try:
+			is_online = yield self.remove_online()
+			if was_connected:
+				if not is_online:
+					message = self.room_online_logout()
+					self.publish(message, settings.ALL_ROOM_ID)
+				yield self.last_read_queue.push(self.user_id)
+		except Exception as e:
+			self.logger.exception("Unable to remove websocket from online, because %s", e)
+
+	def log_traffic(self):
+		if self.protocol is None:  # ws_connection is already None on close
+			return
+		protocol = WsProtocol(self.protocol)
+		if not protocol.compressed:
+			return
+		message_bytes, wire_bytes = protocol.traffic()
+		self.logger.info(
+			"Sent %d bytes of messages as %d bytes (%.1f%%), compression took %.3fs",
+			message_bytes,
+			wire_bytes,
+			100.0 * wire_bytes / max(message_bytes, 1),
+			self.outbound.compression_time
+		)
 
-	def disconnect(self, tries=0):
+	def disconnect(self):
 		"""
-		Closes a connection if it's not in proggress, otherwice timeouts closing
-		https://github.com/evilkost/brukva/issues/25#issuecomment-9468227
+		Redis connection is shared via subscription_hub, so only local state is dropped here
 		"""
 		self.connected = False
 		self.closed_channels = self.channels
 		self.channels = []
-		if self.async_redis.connection.in_progress and tries < 1000:  # failsafe eternal loop
-			self.logger.debug('Closing a connection timeouts')
-			ioloop.IOLoop.instance().add_timeout(timedelta(0.00001), self.disconnect, tries+1)
-		else:
-			self.logger.info("Close connection result: %s")
-			self.async_redis.disconnect()
 
 	def generate_self_id(self):
 		"""
@@ -104,51 +199,119 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		and TornadoHandler can restore webrtc_connections to previous state
 		"""
 		conn_arg = self.get_argument('id', None)
+		if conn_arg and ':' in conn_arg:  # client sends the whole id it has received in setWsId
+			conn_arg = conn_arg.split(':', 1)[1]
 		self.id, random = create_id(self.user_id, conn_arg)
-		self.restored_connection =  random == conn_arg
-		self.restored_connection = False
-		self.save_ip()
+		self.restored_connection = random == conn_arg
+		IOLoop.current().spawn_callback(self.save_ip)
 
+	def get_seq_argument(self):
+		"""
+		:return: amount of frames client has received from websocket it resumes, or None
+		"""
+		try:
+			return int(self.get_argument('seq'))
+		except (MissingArgumentError, ValueError):
+			return None
+
+	@gen.coroutine
+	def resume(self, seq):
+		"""
+		Client gets frames it has missed from replay log instead of setWsId.
+		Channels are subscribed before the log is claimed, so nothing published in between is lost
+		:param seq: amount of frames client has received
+		:return: True if websocket has been resumed
+		"""
+		channels = yield self.replay_log.get_channels(self.id)
+		if channels is None or self.ws_connection is None:
+			return False
+		self.resume_buffer = []
+		self.channels = channels
+		self.listen(channels)
+		owner = id_generator(RedisPrefix.CONNECTION_ID_LENGTH)
+		alive_since = time.time() - settings.CLUSTER_NODE_TIMEOUT / 1000.0
+		try:
+			state = yield self.replay_log.claim(self.id, owner, self.cluster_node.node_id, self.user_id, seq, alive_since)
+		except Exception as e:
+			self.logger.error("Unable to claim replay log, because %s", e)
+			state = None
+		buffered = self.resume_buffer
+		self.resume_buffer = None
+		table_version = state[2] if state is not None else None
+		if state is None or self.ws_connection is None or table_version not in ('', compact_protocol.TABLE_VERSION):
+			if state is not None:  # closed meanwhile, or server has been updated and client's keys table is outdated
+				self.replay_log.release(self.id, owner)
+			self.subscription_hub.unsubscribe(self, channels)
+			self.channels = []
+			return False
+		_, claimed_channels, _, frames = state
+		# old websocket could have been detached with other channels after they were read
+		self.subscription_hub.unsubscribe(self, [c for c in channels if c not in claimed_channels])
+		self.listen([c for c in claimed_channels if c not in channels])
+		self.channels = claimed_channels
+		self.compact = table_version != ''
+		self.logger.info("!! Resuming websocket from frame %d, replaying %d frames", seq, len(frames))
+		for frame in frames:
+			self.outbound.put(frame)
+		self.replay_owner = owner
+		self.ws_write(self.resumed())
+		# parsed messages are compared as well, old websocket has applied them to claimed channels
+		received = [m.compact if self.compact else m.text for m in buffered]
+		skip = count_overlap(frames, received)
+		for message in buffered[skip:]:  # the first ones are already replayed from the log
+			super(TornadoHandler, self).on_pub_sub_message(message)
+		self.connected = True
+		yield self.add_online()
+		return True
+
+	def on_pub_sub_message(self, message):
+		if self.resume_buffer is not None:  # written after frames from replay log
+			self.resume_buffer.append(message)
+		else:
+			super(TornadoHandler, self).on_pub_sub_message(message)
+
+	@gen.coroutine
 	def open(self):
 		session_key = self.get_argument('sessionId', None)
-		user_id = self.sync_redis.hget('sessions', session_key)
+		user_id = yield self.session_cache.get(session_key)
 		if user_id is None:
 			self.logger.warning('!! Session key %s has been rejected' % session_key)
 			self.close(403, "Session key %s has been rejected" % session_key)
 			return
-		self.user_id = int(user_id)
+		self.user_id = user_id
+		self.protocol = self.ws_connection
+		self.anti_spam = AntiSpam(self.user_id)
 		self.ip = self.get_client_ip()
-		user_db = do_db(UserProfile.objects.get, id=self.user_id)
 		self.generate_self_id()
 		self._logger = logging.LoggerAdapter(parent_logger, {
 			'id': self.id,
 			'ip': self.ip
 		})
 		self.logger.debug("!! Incoming connection, session %s, thread hash %s", session_key, self.id)
-		self.async_redis.connect()
-		self.async_redis_publisher.sadd(RedisPrefix.ONLINE_VAR, self.id)
-		# since we add user to online first, latest trigger will always show correct online
-		was_online, online = self.get_online_and_status_from_redis()
-		user_rooms_query = Room.objects.filter(users__id=self.user_id, disabled=False) \
-			.values('id', 'name', 'roomusers__notifications', 'roomusers__volume')
-		room_users = [{
-			VarNames.ROOM_ID: room['id'],
-			VarNames.ROOM_NAME: room['name'],
-			VarNames.NOTIFICATIONS: room['roomusers__notifications'],
-			VarNames.VOLUME: room['roomusers__volume'],
-			VarNames.ROOM_USERS: []
-		} for room in user_rooms_query]
-		user_rooms_dict = {room[VarNames.ROOM_ID]: room for room in room_users}
-		room_ids = [room_id[VarNames.ROOM_ID] for room_id in room_users]
-		rooms_users = RoomUsers.objects.filter(room_id__in=room_ids).values('user_id', 'room_id')
-		for ru in rooms_users:
-			user_rooms_dict[ru['room_id']][VarNames.ROOM_USERS].append(ru['user_id'])
+		if settings.WS_REPLAY and self.restored_connection:
+			seq = self.get_seq_argument()
+			if seq is not None and (yield self.resume(seq)):
+				return
+		was_online = yield self.add_online()
+		user_db, room_users, last_read = yield db_executor.submit(self.get_user_rooms)
+		if self.ws_connection is None:  # closed while waiting for db
+			return
 		# get all missed messages
-		self.channels = room_ids  # py2 doesn't support clear()
+		self.channels = [room[VarNames.ROOM_ID] for room in room_users]
 		self.channels.append(self.channel)
 		self.channels.append(self.id)
 		self.listen(self.channels)
-		off_messages, history = self.get_offline_messages(room_users, was_online, self.get_argument('history', False))
+		off_messages, history, more, (users_version, users, users_delta) = yield db_executor.submit(
+			self.get_offline_state,
+			room_users,
+			last_read,
+			was_online,
+			self.get_argument('messages', None),
+			self.get_argument('history', False),
+			self.get_users_version_argument()
+		)
+		if self.ws_connection is None:
+			return
 		for room in room_users:
 			room_id = room[VarNames.ROOM_ID]
 			h = history.get(room_id)
@@ -157,67 +320,107 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 				room[VarNames.LOAD_MESSAGES_HISTORY] = h
 			if o:
 				room[VarNames.LOAD_MESSAGES_OFFLINE] = o
-
-		if settings.SHOW_COUNTRY_CODE:
-			fetched_users  = User.objects.annotate(user_c=Count('id')).values('id', 'username', 'sex', 'userjoinedinfo__ip__country_code', 'userjoinedinfo__ip__country', 'userjoinedinfo__ip__region', 'userjoinedinfo__ip__city')
-			user_dict = [RedisPrefix.set_js_user_structure_flag(
-				user['id'],
-				user['username'],
-				user['sex'],
-				user['userjoinedinfo__ip__country_code'],
-				user['userjoinedinfo__ip__country'],
-				user['userjoinedinfo__ip__region'],
-				user['userjoinedinfo__ip__city']
-			) for user in fetched_users]
-		else:
-			fetched_users = User.objects.values('id', 'username', 'sex')
-			user_dict = [RedisPrefix.set_js_user_structure(
-				user['id'],
-				user['username'],
-				user['sex']
-			) for user in fetched_users]
+			if room_id in more:  # only the newest messages are sent, client loads the rest on demand
+				room[VarNames.LOAD_MESSAGES_MORE] = True
+		# read after subscribing, so login/logout events that come later apply on top of it
+		online = yield self.get_online_from_redis()
 		if self.user_id not in online:
 			online.append(self.user_id)
 
-		self.ws_write(self.set_room(room_users, user_dict, online, user_db))
+		set_room = self.set_room(room_users, users, online, user_db, users_version, users_delta)
+		compact = settings.WS_COMPACT_PROTOCOL and self.get_argument('protocol', None) == 'compact'
+		if compact:
+			set_room[VarNames.COMPACT_KEYS] = compact_protocol.KEYS_TABLE
+		self.ws_write(set_room)
+		# everything queued before setWsId stays json, since client decodes compact frames with its table
+		self.compact = compact
+		if settings.WS_REPLAY:  # client counts frames after setWsId
+			self.replay_owner = id_generator(RedisPrefix.CONNECTION_ID_LENGTH)
+			self.replay_log.start(
+				self.id,
+				self.replay_owner,
+				self.cluster_node.node_id,
+				self.user_id,
+				self.channels,
+				compact_protocol.TABLE_VERSION if compact else ''
+			)
 		if not was_online:  # if a new tab has been opened
-			online_user_names_mes = self.room_online_login(online, user_db.username, user_db.sex_str)
-			self.logger.info('!! First tab, sending refresh online for all')
+			online_user_names_mes = self.room_online_login(user_db.username, user_db.sex_str)
+			self.logger.info('!! First tab, sending user online for all')
 			self.publish(online_user_names_mes, settings.ALL_ROOM_ID)
 		self.logger.info("!! User %s subscribes for %s", self.user_id, self.channels)
 		self.connected = True
 
-	def get_offline_messages(self, user_rooms, was_online, with_history):
-		q_objects = get_history_message_query(self.get_argument('messages', None), user_rooms, with_history)
-		if was_online:
-			off_messages = []
-		else:
-			off_messages = Message.objects.filter(
-				id__gt=F('room__roomusers__last_read_message_id'),
-				room__roomusers__user_id=self.user_id
-			)
+	def get_user_rooms(self):
+		"""
+		:return: (UserProfile, list of rooms with their users, dict room_id -> last read message id)
+		"""
+		user_db = UserProfile.objects.get(id=self.user_id)
+		user_rooms_query = list(Room.objects.filter(users__id=self.user_id, disabled=False) \
+			.values('id', 'name', 'roomusers__notifications', 'roomusers__volume', 'roomusers__last_read_message_id'))
+		room_users = [{
+			VarNames.ROOM_ID: room['id'],
+			VarNames.ROOM_NAME: room['name'],
+			VarNames.NOTIFICATIONS: room['roomusers__notifications'],
+			VarNames.VOLUME: room['roomusers__volume'],
+			VarNames.ROOM_USERS: []
+		} for room in user_rooms_query]
+		last_read = {room['id']: room['roomusers__last_read_message_id'] for room in user_rooms_query}
+		user_rooms_dict = {room[VarNames.ROOM_ID]: room for room in room_users}
+		room_ids = [room_id[VarNames.ROOM_ID] for room_id in room_users]
+		rooms_users = RoomUsers.objects.filter(room_id__in=room_ids).values('user_id', 'room_id')
+		for ru in rooms_users:
+			user_rooms_dict[ru['room_id']][VarNames.ROOM_USERS].append(ru['user_id'])
+		return user_db, room_users, last_read
+
+	def get_users_version_argument(self):
+		"""
+		:return: version of users directory that client already has, or None if it needs all users
+		"""
+		try:
+			return int(self.get_argument('usersVersion'))
+		except (MissingArgumentError, ValueError):
+			return None
+
+	def get_offline_state(self, room_users, last_read, was_online, messages, with_history, users_version):
+		"""
+		:return: (offline messages, history messages, ids of rooms with more messages, (users version, users, is delta))
+		"""
+		off_messages, history, more = self.get_offline_messages(room_users, last_read, was_online, messages, with_history)
+		return off_messages, history, more, self.user_directory.get_users(users_version)
+
+	def get_offline_messages(self, room_users, last_read, was_online, messages, with_history):
+		"""
+		:param last_read: dict room_id -> id of the latest message user has read
+		:return: (dict room_id -> offline messages, dict room_id -> history messages, ids of rooms with more messages)
+		"""
+		sync = HistorySync(
+			self.user_id,
+			parse_known_messages(messages),
+			with_history,
+			last_read,
+			was_online,
+			settings.HISTORY_SYNC_ROOM_LIMIT,
+			settings.HISTORY_SYNC_ROOMS_PER_QUERY
+		)
 		off = {}
 		history = {}
-		if len(q_objects.children) > 0:
-			history_messages = Message.objects.filter(q_objects)
-			all = list(chain(off_messages, history_messages))
-			self.logger.info("Offline messages IDs: %s, history messages: %s", [m.id for m in off_messages], [m.id for m in history_messages])
-		else:
-			history_messages = []
-			all = off_messages
-		if self.restored_connection:
-			off_messages = all
-			history_messages = []
-		imv = get_message_images_videos(all)
-		self.set_video_images_messages(imv, off_messages, off)
-		self.set_video_images_messages(imv, history_messages, history)
-		return off, history
-
-	def set_video_images_messages(self, imv, inm, outm):
-		for message in inm:
-			files = MessagesCreator.prepare_img_video(imv, message.id)
-			prep_m = self.create_message(message, files)
-			outm.setdefault(message.room_id, []).append(prep_m)
+		more = []
+		total = 0
+		for rooms in sync.load_chunks([room[VarNames.ROOM_ID] for room in room_users]):
+			# images of the whole chunk are fetched at once, like its messages
+			imv = get_message_images_videos([m for _, room_messages, _ in rooms for m in room_messages])
+			for room_id, room_messages, room_more in rooms:
+				off_messages, history_messages = sync.split(room_id, room_messages, self.restored_connection)
+				if off_messages:
+					off[room_id] = [self.create_message(m, MessagesCreator.prepare_img_video(imv, m.id)) for m in off_messages]
+				if history_messages:
+					history[room_id] = [self.create_message(m, MessagesCreator.prepare_img_video(imv, m.id)) for m in history_messages]
+				if room_more:
+					more.append(room_id)
+				total += len(room_messages)
+		self.logger.info("Loaded %d missing messages of %d rooms, rooms with more messages: %s", total, len(off.keys() | history.keys()), more)
+		return off, history, more
 
 	def check_origin(self, origin):
 		"""
@@ -228,12 +431,13 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 	@gen.coroutine
 	def save_ip(self):
 		"""
-		This code is not used anymore
+		Remembers ip user has joined from, runs in background so connect isn't delayed by it
 		"""
-		if not do_db(UserJoinedInfo.objects.filter(
-				Q(ip__ip=self.ip) & Q(user_id=self.user_id)).exists):
+		if not (yield db_executor.submit(UserJoinedInfo.objects.filter(
+				Q(ip__ip=self.ip) & Q(user_id=self.user_id)).exists)):
 			ip = yield from get_or_create_ip_model(self.ip, self.logger)
-			UserJoinedInfo.objects.create(ip=ip, user_id=self.user_id)
+			yield db_executor.submit(UserJoinedInfo.objects.create, ip=ip, user_id=self.user_id)
+			yield db_executor.submit(self.user_directory.mark_changed, self.user_id)
 
 	def ws_write(self, message):
 		"""
@@ -242,15 +446,67 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		:type message object
 		"""
 		# self.logger.debug('<< THREAD %s >>', os.getppid())
+		if isinstance(message, dict):
+			message = compact_protocol.dumps(message) if self.compact else json.dumps(message)
+		if not isinstance(message, str_type):
+			raise ValueError('Wrong message type : %s' % str(message))
+		self.logger.debug(">> %.1000s", message)
+		if not self.write_frame(message):
+			self.logger.warning("Websocket is closed. Can't send message << %.1000s >> ", message)
+
+	def ws_write_prepared(self, message):
+		"""
+		Sends pubsub message to client, the frame is built once per process
+		and the same bytes are written to every recipient socket.
+		Online changes of the same user replace each other in the queue and are dropped first
+		:type message: chat.tornado.subscription_hub.PubSubMessage
+		"""
+		key = None
+		droppable = False
+		decoded = message.decoded
+		if decoded is not None and decoded.get(VarNames.EVENT) in (Actions.LOGIN, Actions.LOGOUT):
+			key = (Actions.LOGIN, decoded[VarNames.USER_ID])
+			droppable = True
+		if self.compact:
+			text, wire_format = message.compact, 'compact'
+		else:
+			text, wire_format = message.text, 'json'
+		self.logger.debug(">> %.1000s", text)
+		self.write_frame(text, message, key, droppable, wire_format)
+
+	def write_frame(self, text, shared_message=None, key=None, droppable=False, wire_format='json'):
+		"""
+		Frames of detached websocket wait for client in replay log
+		:return: False if frame can't be delivered
+		"""
+		if self.detached:
+			if self.replay_owner is None:
+				return False
+			self.log_frames([text])
+			return True
+		return self.outbound.put(text, shared_message, key, droppable, wire_format, self.replay_owner is not None)
+
+	def on_frames_written(self, frames):
+		"""
+		Called by outbound queue for frames passed to socket
+		"""
+		if self.replay_owner is not None:
+			self.log_frames(frames)
+
+	def log_frames(self, frames):
+		IOLoop.current().add_future(self.replay_log.append(self.id, self.replay_owner, frames), self.on_frames_logged)
+
+	def on_frames_logged(self, future):
 		try:
-			if isinstance(message, dict):
-				message = json.dumps(message)
-			if not isinstance(message, str_type):
-				raise ValueError('Wrong message type : %s' % str(message))
-			self.logger.debug(">> %.1000s", message)
-			self.write_message(message)
-		except WebSocketClosedError as e:
-			self.logger.warning("%s. Can't send message << %s >> ", e, str(message))
+			seq = future.result()
+		except Exception as e:
+			self.logger.error("Unable to write replay log, because %s", e)
+			return
+		if seq < 0 and self.replay_owner is not None:
+			self.logger.info("Websocket has been resumed by another connection")
+			self.replay_owner = None
+			if self.detached:
+				self.finish_detach()
 
 	def get_client_ip(self):
 		return self.request.headers.get("X-Real-IP") or self.request.remote_ip
@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import mimetypes
+import os
+
+from django.core.exceptions import ValidationError
+from tornado.httputil import HTTPHeaders, _parse_header
+
+from chat.models import get_random_path
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADERS_SIZE = 16 * 1024  # headers of a single part
+MAX_FIELD_SIZE = 64 * 1024  # value of a part that is not a file
+
+
+def get_extension(content_type, filename):
+	"""
+	:return: extension that should be added to filename to match content_type, or empty string
+	"""
+	result = None
+	extension = None
+	if content_type:
+		if filename:
+			filename = os.path.basename(filename)
+			__, extension = os.path.splitext(filename)
+		extensions = mimetypes.guess_all_extensions(content_type)
+		if extension in extensions or filename in extensions:
+			result = ''
+		else:
+			result = mimetypes.guess_extension(content_type)
+	return result or ''
+
+
+def get_boundary(content_type):
+	"""
+	:return: bytes boundary of multipart/form-data Content-Type or None if it's another type
+	"""
+	if not content_type.startswith('multipart/form-data'):
+		return None
+	for field in content_type.split(';'):
+		key, __, value = field.strip().partition('=')
+		if key == 'boundary' and value:
+			if value.startswith('"') and value.endswith('"'):
+				value = value[1:-1]
+			return value.encode('utf-8')
+	raise ValidationError("Boundary of multipart body is missing")
+
+
+class SpooledFile(object):
+	"""
+	Uploaded file written to media root as it arrives, size and hash are counted on the fly.
+	write is a blocking disk write on IOLoop, called for every chunk of the body (64KB by default in tornado)
+	"""
+
+	def __init__(self, media_root, filename, content_type):
+		self.name = get_random_path(None, os.path.basename(filename)) + get_extension(content_type, filename)
+		self.path = os.path.join(media_root, self.name)
+		self.size = 0
+		self.sha256 = hashlib.sha256()
+		self.file = open(self.path, 'wb')
+
+	def write(self, data):
+		self.file.write(data)
+		self.sha256.update(data)
+		self.size += len(data)
+
+	def close(self):
+		if not self.file.closed:
+			self.file.close()
+
+	def remove(self):
+		self.close()
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass  # already moved to media store
+		except OSError as e:
+			logger.warning("Unable to remove upload %s, because %s", self.path, e)
+
+	@property
+	def hexdigest(self):
+		return self.sha256.hexdigest()
+
+
+class UploadQuota(object):
+	"""
+	Bytes being uploaded by every user in this process
+	"""
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.users = {}  # user_id -> bytes received by unfinished uploads
+
+	def acquire(self, user_id, size):
+		"""
+		:raises ValidationError: if user exceeds the limit
+		"""
+		used = self.users.get(user_id, 0) + size
+		if used > self.limit:
+			raise ValidationError("Upload quota of %d bytes is exceeded" % self.limit)
+		self.users[user_id] = used
+
+	def release(self, user_id, size):
+		used = self.users.get(user_id, 0) - size
+		if used > 0:
+			self.users[user_id] = used
+		else:
+			self.users.pop(user_id, None)
+
+
+class MultipartParser(object):
+	"""
+	Incremental multipart/form-data parser. Files are spooled to media_root,
+	other fields are collected to arguments like tornado does for buffered bodies.
+	"""
+
+	def __init__(self, boundary, media_root, on_data):
+		"""
+		:param boundary: bytes from Content-Type header
+		:param on_data: called with amount of bytes of every file chunk before it's written
+		"""
+		self.delimiter = b'\r\n--' + boundary
+		self.media_root = media_root
+		self.on_data = on_data
+		self.buffer = b'\r\n'  # so the first boundary matches delimiter as well
+		self.state = 'preamble'
+		self.field = None  # name of current part
+		self.file = None  # SpooledFile of current part
+		self.value = b''  # value of current part that is not a file
+		self.arguments = {}  # name -> list of bytes values
+		self.files = {}  # name -> SpooledFile
+
+	def feed(self, data):
+		self.buffer += data
+		while self.step():
+			pass
+
+	def step(self):
+		"""
+		:return: True if buffer can be processed further
+		"""
+		if self.state == 'preamble':
+			pos = self.buffer.find(self.delimiter)
+			if pos < 0:
+				self.buffer = self.buffer[-len(self.delimiter):]
+				return False
+			self.buffer = self.buffer[pos + len(self.delimiter):]
+			self.state = 'delimiter'
+			return True
+		elif self.state == 'delimiter':
+			if len(self.buffer) < 2:
+				return False
+			if self.buffer.startswith(b'--'):
+				self.state = 'done'
+				self.buffer = b''
+				return False
+			if self.buffer.startswith(b'\r\n'):
+				self.buffer = self.buffer[2:]
+			self.state = 'headers'
+			return True
+		elif self.state == 'headers':
+			pos = self.buffer.find(b'\r\n\r\n')
+			if pos < 0:
+				if len(self.buffer) > MAX_HEADERS_SIZE:
+					raise ValidationError("Multipart headers are too long")
+				return False
+			self.start_part(self.buffer[:pos].decode('utf-8'))
+			self.buffer = self.buffer[pos + 4:]
+			self.state = 'body'
+			return True
+		elif self.state == 'body':
+			pos = self.buffer.find(self.delimiter)
+			if pos < 0:
+				# tail can be the start of delimiter
+				keep = len(self.delimiter) - 1
+				if len(self.buffer) > keep:
+					self.write_part(self.buffer[:-keep])
+					self.buffer = self.buffer[-keep:]
+				return False
+			self.write_part(self.buffer[:pos])
+			self.end_part()
+			self.buffer = self.buffer[pos + len(self.delimiter):]
+			self.state = 'delimiter'
+			return True
+		return False
+
+	def start_part(self, headers_text):
+		headers = HTTPHeaders.parse(headers_text)
+		disposition, params = _parse_header(headers.get('Content-Disposition', ''))
+		if disposition != 'form-data' or not params.get('name'):
+			raise ValidationError("Invalid multipart part")
+		self.field = params['name']
+		if 'filename' in params:
+			if self.field in self.files:  # the first one would be lost, every file has its own symbol
+				raise ValidationError("Duplicate file field %s" % self.field)
+			self.file = SpooledFile(self.media_root, params['filename'], headers.get('Content-Type'))
+			self.files[self.field] = self.file
+		else:
+			self.value = b''
+
+	def write_part(self, data):
+		if not data:
+			return
+		if self.file is not None:
+			self.on_data(len(data))
+			self.file.write(data)
+		else:
+			self.value += data
+			if len(self.value) > MAX_FIELD_SIZE:
+				raise ValidationError("Field %s is too long" % self.field)
+
+	def end_part(self):
+		if self.file is not None:
+			self.file.close()
+			logger.debug("Received %s of %d bytes, sha256 %s", self.file.name, self.file.size, self.file.hexdigest)
+			self.file = None
+		else:
+			self.arguments.setdefault(self.field, []).append(self.value)
+
+	@property
+	def finished(self):
+		return self.state == 'done'
+
+	def remove_files(self):
+		for spooled in self.files.values():
+			spooled.remove()
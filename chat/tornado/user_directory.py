@@ -0,0 +1,95 @@
+import logging
+from threading import Lock
+
+from django.conf import settings
+from django.db.models import Count
+
+from chat.models import User
+from chat.tornado.constants import RedisPrefix, VarNames
+
+logger = logging.getLogger(__name__)
+
+# Increments directory version and stores it as the version of user's last change
+MARK_CHANGED_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[2], version, ARGV[1])
+return version
+"""
+
+
+class UserDirectory(object):
+	"""
+	In-process cache of users that are sent to client on connect.
+	Every change of user public fields increments a version in redis, so
+	each process reloads only changed users, and a client that reconnects with
+	its known version receives only users changed since then.
+	"""
+
+	def __init__(self, sync_redis):
+		"""
+		:type sync_redis: redis.StrictRedis
+		"""
+		self.redis = sync_redis
+		self.mark_changed_script = sync_redis.register_script(MARK_CHANGED_SCRIPT)
+		self.lock = Lock()
+		self.version = None
+		self.users = {}  # user_id -> js user structure
+		self.changes = {}  # user_id -> version of the last change
+
+	def mark_changed(self, user_id):
+		"""
+		Should be called after user has been created or its name, sex or location has changed
+		:return: new directory version
+		"""
+		return self.mark_changed_script(keys=[RedisPrefix.USERS_VERSION, RedisPrefix.USERS_CHANGES], args=[user_id])
+
+	def get_users(self, known_version):
+		"""
+		Executes db queries, so it should run in db executor
+		:param known_version: version of directory that client already has or None
+		:return: (version, users, is_delta)
+		"""
+		with self.lock:
+			self.refresh()
+			if known_version is not None and known_version <= self.version:
+				users = [self.users[user_id] for user_id, version in self.changes.items()
+						if version > known_version and user_id in self.users]
+				return self.version, users, True
+			return self.version, list(self.users.values()), False
+
+	def refresh(self):
+		version = int(self.redis.get(RedisPrefix.USERS_VERSION) or 0)
+		if self.version is None or version < self.version:  # first load or redis has been flushed
+			logger.info("Loading users directory of version %s", version)
+			changes = self.redis.zrange(RedisPrefix.USERS_CHANGES, 0, -1, withscores=True)
+			self.changes = {int(user_id): int(score) for user_id, score in changes}
+			self.users = {user[VarNames.USER_ID]: user for user in self.load_users(User.objects.all())}
+		elif version > self.version:
+			changes = self.redis.zrangebyscore(RedisPrefix.USERS_CHANGES, self.version + 1, '+inf', withscores=True)
+			changed = {int(user_id): int(score) for user_id, score in changes}
+			logger.debug("Updating users directory from %s to %s, changed users %s", self.version, version, changed)
+			self.changes.update(changed)
+			for user in self.load_users(User.objects.filter(id__in=changed.keys())):
+				self.users[user[VarNames.USER_ID]] = user
+		self.version = version
+
+	@staticmethod
+	def load_users(query):
+		if settings.SHOW_COUNTRY_CODE:
+			fetched_users = query.annotate(user_c=Count('id')).values('id', 'username', 'sex', 'userjoinedinfo__ip__country_code', 'userjoinedinfo__ip__country', 'userjoinedinfo__ip__region', 'userjoinedinfo__ip__city')
+			return [RedisPrefix.set_js_user_structure_flag(
+				user['id'],
+				user['username'],
+				user['sex'],
+				user['userjoinedinfo__ip__country_code'],
+				user['userjoinedinfo__ip__country'],
+				user['userjoinedinfo__ip__region'],
+				user['userjoinedinfo__ip__city']
+			) for user in fetched_users]
+		else:
+			fetched_users = query.values('id', 'username', 'sex')
+			return [RedisPrefix.set_js_user_structure(
+				user['id'],
+				user['username'],
+				user['sex']
+			) for user in fetched_users]
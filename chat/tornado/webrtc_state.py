@@ -0,0 +1,235 @@
+from tornado import gen
+
+from chat.tornado.constants import WebRtcRedisStates
+
+# Every script refreshes TTL ARGV[1] of the connection, so only abandoned connections expire
+# KEYS[1] - hash connection_id -> ws id of offerer, KEYS[2] - hash ws id -> status of connection
+OFFER_SCRIPT = """
+redis.call('HSET', KEYS[1], KEYS[2], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+SET_STATUS_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Moves ws ARGV[2] to status ARGV[3] if offerer is in status ARGV[4]
+# and ws is in one of statuses ARGV[5..], returns offerer ws id
+RESPOND_SCRIPT = """
+local sender = redis.call('HGET', KEYS[1], KEYS[2])
+if not sender or redis.call('HGET', KEYS[2], sender) ~= ARGV[4] then
+	return false
+end
+local status = redis.call('HGET', KEYS[2], ARGV[2])
+for i = 5, #ARGV do
+	if status == ARGV[i] then
+		redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+		redis.call('EXPIRE', KEYS[2], ARGV[1])
+		return sender
+	end
+end
+return false
+"""
+
+# Moves ws ARGV[2] to status ARGV[3] if it is in one of statuses ARGV[4..],
+# returns statuses of all participants after the change
+ANSWER_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], ARGV[2])
+for i = 4, #ARGV do
+	if status == ARGV[i] then
+		redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+		redis.call('EXPIRE', KEYS[1], ARGV[1])
+		return redis.call('HGETALL', KEYS[1])
+	end
+end
+return false
+"""
+
+# Closes file transfer for ws ARGV[2], offerer closes it for opponent ARGV[3]
+CLOSE_FILE_SCRIPT = """
+local status = redis.call('HGET', KEYS[2], ARGV[2])
+if not status then
+	return {'denied'}
+end
+if status == ARGV[4] then
+	return {'closed'}
+end
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+local sender = redis.call('HGET', KEYS[1], KEYS[2])
+if sender == ARGV[2] then
+	redis.call('HSET', KEYS[2], ARGV[3], ARGV[4])
+	return {'sender'}
+end
+local sender_status = sender and redis.call('HGET', KEYS[2], sender)
+if not sender_status then
+	return {'denied'}
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+return {'receiver', sender, sender_status}
+"""
+
+STATUSES_SCRIPT = """
+local ttl = table.remove(ARGV, 1)
+local res = redis.call('HMGET', KEYS[1], unpack(ARGV))
+if res[1] then
+	redis.call('EXPIRE', KEYS[1], ttl)
+end
+return res
+"""
+
+# KEYS[1] - hash connection_id -> ws id of offerer, KEYS[2..] - connections to check.
+# Removes connections that have expired or whose participants are all in status ARGV[1],
+# or every connection if ARGV[2] is 1
+SWEEP_SCRIPT = """
+local removed = 0
+for i = 2, #KEYS do
+	local remove = ARGV[2] == '1' or redis.call('EXISTS', KEYS[i]) == 0
+	if not remove then
+		remove = true
+		for _, status in ipairs(redis.call('HVALS', KEYS[i])) do
+			if status ~= ARGV[1] then
+				remove = false
+				break
+			end
+		end
+	end
+	if remove then
+		redis.call('DEL', KEYS[i])
+		redis.call('HDEL', KEYS[1], KEYS[i])
+		removed = removed + 1
+	end
+end
+return removed
+"""
+
+
+class WebRtcConnections(object):
+	"""
+	State machine of webrtc connections stored in redis. Every transition is a lua script
+	that validates and updates statuses of the connection in a single round-trip,
+	so concurrent messages of participants can't interleave between the check and the update.
+	Commands are routed by connection id, so transitions sent by this process keep their order.
+	"""
+
+	def __init__(self, async_redis, connections_key, ttl):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		:param connections_key: hash connection_id -> ws id of offerer
+		:param ttl: seconds connection is kept after its last signaling message
+		"""
+		self.redis = async_redis
+		self.connections_key = connections_key
+		self.ttl = ttl
+		self.offer_script = async_redis.register_script(OFFER_SCRIPT)
+		self.set_status_script = async_redis.register_script(SET_STATUS_SCRIPT)
+		self.respond_script = async_redis.register_script(RESPOND_SCRIPT)
+		self.answer_script = async_redis.register_script(ANSWER_SCRIPT)
+		self.close_file_script = async_redis.register_script(CLOSE_FILE_SCRIPT)
+		self.statuses_script = async_redis.register_script(STATUSES_SCRIPT)
+
+	def offer(self, connection_id, ws_id):
+		"""
+		Creates connection with offerer ws_id in ready status
+		"""
+		return self.offer_script(
+			keys=[self.connections_key, connection_id],
+			args=[self.ttl, ws_id, WebRtcRedisStates.READY],
+			route=connection_id
+		)
+
+	def set_offered(self, connection_id, ws_id):
+		"""
+		Following transitions of this process are sent after it, so they see the status
+		"""
+		return self.set_status_script(keys=[connection_id], args=[self.ttl, ws_id, WebRtcRedisStates.OFFERED])
+
+	@gen.coroutine
+	def get_sender(self, connection_id):
+		"""
+		:return: ws id of offerer or None
+		"""
+		sender = yield self.redis.execute('HGET', self.connections_key, connection_id, route=connection_id)
+		return sender
+
+	def get_statuses(self, connection_id, *ws_ids):
+		"""
+		:return: list of statuses in order of ws_ids, None for absent
+		"""
+		return self.statuses_script(keys=[connection_id], args=[self.ttl] + list(ws_ids))
+
+	def respond(self, connection_id, ws_id, status, sender_status, allowed_statuses):
+		"""
+		:param sender_status: required status of offerer
+		:return: ws id of offerer or None if transition is not allowed
+		"""
+		return self.respond_script(
+			keys=[self.connections_key, connection_id],
+			args=[self.ttl, ws_id, status, sender_status] + list(allowed_statuses),
+			route=connection_id
+		)
+
+	@gen.coroutine
+	def answer(self, connection_id, ws_id, status, allowed_statuses):
+		"""
+		:return: dict ws id -> status of all participants after transition, or None if it's not allowed
+		"""
+		res = yield self.answer_script(
+			keys=[connection_id],
+			args=[self.ttl, ws_id, status] + list(allowed_statuses)
+		)
+		if not res:
+			return None
+		return dict(zip(res[::2], res[1::2]))
+
+	@gen.coroutine
+	def close_file(self, connection_id, ws_id, opponent_id):
+		"""
+		:return: (result, sender, sender_status), result is one of
+		'denied', 'closed' - already closed, 'sender' - ws_id is offerer, 'receiver'
+		"""
+		res = yield self.close_file_script(
+			keys=[self.connections_key, connection_id],
+			args=[self.ttl, ws_id, opponent_id or '', WebRtcRedisStates.CLOSED],
+			route=connection_id
+		)
+		res = list(res) + [None] * (3 - len(res))
+		return tuple(res)
+
+
+class WebRtcSweeper(object):
+	"""
+	Connection hashes expire by themselves, but their entries in connections_key don't.
+	Sweeper walks connections_key with HSCAN a batch at a time, so redis isn't blocked,
+	and removes entries of expired connections and connections closed by all participants.
+	"""
+
+	def __init__(self, async_redis, connections_key, batch_size):
+		"""
+		:type async_redis: chat.tornado.redis_client.AsyncRedis
+		"""
+		self.redis = async_redis
+		self.connections_key = connections_key
+		self.batch_size = batch_size
+		self.cursor = 0
+		self.sweep_script = async_redis.register_script(SWEEP_SCRIPT)
+
+	@gen.coroutine
+	def sweep(self, remove_all=False):
+		"""
+		Checks the next batch of connections
+		:param remove_all: remove connections regardless of their state
+		:return: (amount of removed connections, True if whole hash has been walked)
+		"""
+		cursor, connections = yield self.redis.hscan(self.connections_key, self.cursor, self.batch_size)
+		self.cursor = int(cursor)
+		removed = 0
+		if connections:
+			removed = yield self.sweep_script(
+				keys=[self.connections_key] + connections[::2],
+				args=[WebRtcRedisStates.CLOSED, 1 if remove_all else 0]
+			)
+		return removed, self.cursor == 0
@@ -0,0 +1,85 @@
+"""
+Internals of tornado websocket connection that outbound queue needs to write prebuilt frames
+and to watch the socket buffer. Targets tornado 4.5 (pinned 4.5.3 in requirements.txt),
+every private attribute of tornado this project touches is read or written only here,
+so check them when tornado is upgraded and update SUPPORTED_TORNADO.
+"""
+import tornado
+
+SUPPORTED_TORNADO = (4, 5)
+
+if tornado.version_info[:2] != SUPPORTED_TORNADO:
+	raise ImportError("chat.tornado.ws_protocol relies on internals of tornado %s, but %s is installed" % (
+		'.'.join(str(v) for v in SUPPORTED_TORNADO), tornado.version))
+
+
+class WsProtocol(object):
+	"""
+	Wraps tornado.websocket.WebSocketProtocol13 of a single connection
+	"""
+
+	def __init__(self, protocol):
+		"""
+		:type protocol: tornado.websocket.WebSocketProtocol13
+		"""
+		self.protocol = protocol
+
+	@property
+	def compressed(self):
+		"""
+		:return: True if client has negotiated permessage-deflate
+		"""
+		return self.protocol._compressor is not None
+
+	@property
+	def context_takeover(self):
+		"""
+		:return: True if deflate context is kept between messages, so frames can't be shared between connections
+		"""
+		return self.compressed and self.protocol._compressor._compressor is not None
+
+	@property
+	def compression_variant(self):
+		"""
+		:return: options that produce the same compressed frame, used to share it between connections
+		"""
+		compressor = self.protocol._compressor
+		return compressor._compression_level, compressor._mem_level, compressor._max_wbits
+
+	def compress(self, payload):
+		"""
+		Only for connections without context takeover, each message is compressed by a new zlib object
+		"""
+		return self.protocol._compressor.compress(payload)
+
+	def buffered_bytes(self):
+		"""
+		:return: bytes written to socket stream that haven't reached the socket yet
+		"""
+		return self.protocol.stream._write_buffer_size
+
+	def write(self, data):
+		"""
+		Writes prebuilt frames as they are
+		:return: Future resolved when data reaches the socket
+		"""
+		return self.protocol.stream.write(data)
+
+	def write_message(self, text):
+		return self.protocol.write_message(text)
+
+	def count_written(self, payload_length, wire_length):
+		"""
+		Frames written past write_message are counted as tornado counts its own
+		"""
+		self.protocol._message_bytes_out += payload_length
+		self.protocol._wire_bytes_out += wire_length
+
+	def traffic(self):
+		"""
+		:return: (bytes of messages, bytes sent to socket), tornado counts them only for compressed connections
+		"""
+		return self.protocol._message_bytes_out, self.protocol._wire_bytes_out
+
+	def abort(self):
+		self.protocol._abort()
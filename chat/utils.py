@@ -1,16 +1,18 @@
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import connection, OperationalError, InterfaceError
+from django.db import connection, OperationalError, InterfaceError, close_old_connections
 from django.db.models import Q
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 
 from chat.log_filters import id_generator
-from chat.models import Image, UploadedFile, get_milliseconds
+from chat.models import Image, UploadedFile, get_milliseconds, MessageSearchToken, Message
 from chat.models import User
 from chat.models import UserProfile, IpAddress
 from chat.py2_3 import dict_values_to_list
@@ -20,6 +22,9 @@ USERNAME_REGEX = str(settings.MAX_USERNAME_LENGTH).join(['^[a-zA-Z-_0-9]{1,', '}
 logger = logging.getLogger(__name__)
 
 ONE_DAY = 60 * 60 * 24 * 1000
+SEARCH_TOKEN_REGEX = re.compile(r'\w+', re.UNICODE)
+SEARCH_TOKEN_MAX_LENGTH = MessageSearchToken._meta.get_field('token').max_length
+
 
 def is_blank(check_str):
 	if check_str and check_str.strip():
@@ -27,29 +32,6 @@ def is_blank(check_str):
 	else:
 		return True
 
-def get_history_message_query(messages, user_rooms, with_history):
-	cb = with_history_q if with_history else no_history_q
-	q_objects = Q()
-	if messages:
-		pmessages = json.loads(messages)
-	else:
-		pmessages = {}
-	for room_id in user_rooms:
-		room_hf = pmessages.get(str(room_id))
-		if room_hf:
-			cb(q_objects, room_id, room_hf['h'], room_hf['f'])
-	return q_objects
-
-
-def with_history_q(q_objects, room_id, h, f):
-	q_objects.add(Q(id__gte=h, room_id=room_id), Q.OR)
-
-
-def no_history_q(q_objects, room_id, h, f):
-	q_objects.add(Q(room_id=room_id) & (
-			(Q(id__gte=h) & Q(id__lte=f) & Q(edited_times__gt=0) & Q(time__gt=get_milliseconds() - ONE_DAY)) | Q(id__gt=f)), Q.OR)
-
-
 def evaluate(query_set):
 	do_db(len, query_set)
 	return query_set
@@ -76,6 +58,37 @@ def do_db(callback, *args, **kwargs):
 			raise e
 
 
+class DbExecutor(object):
+	"""
+	Runs blocking ORM calls in a dedicated thread pool so a slow query doesn't stall the IOLoop.
+	Django keeps connections per thread, so every worker uses its own mysql connection.
+	"""
+
+	def __init__(self, max_workers, max_queue_size):
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.slots = BoundedSemaphore(max_queue_size)
+
+	def submit(self, callback, *args, **kwargs):
+		"""
+		:raises ValidationError: if too many queries are already queued
+		:return: concurrent.futures.Future that can be yielded from tornado coroutines
+		"""
+		if not self.slots.acquire(False):
+			logger.warning("DB queue is full, rejecting %s", getattr(callback, '__name__', callback))
+			raise ValidationError("Server is too busy, please try again later")
+		return self.executor.submit(self.run, callback, *args, **kwargs)
+
+	def run(self, callback, *args, **kwargs):
+		try:
+			close_old_connections()
+			return do_db(callback, *args, **kwargs)
+		finally:
+			self.slots.release()
+
+
+db_executor = DbExecutor(settings.DB_THREAD_WORKERS, settings.DB_MAX_QUEUE_SIZE)
+
+
 def execute_query(query, *args, **kwargs):
 	cursor = connection.cursor()
 	cursor.execute(query, *args, **kwargs)
@@ -114,7 +127,7 @@ http_client = AsyncHTTPClient()
 
 def get_or_create_ip_model(user_ip, logger):
 	try:
-		return IpAddress.objects.get(ip=user_ip)
+		return (yield db_executor.submit(IpAddress.objects.get, ip=user_ip))
 	except IpAddress.DoesNotExist:
 		try:
 			if not hasattr(settings, 'IP_API_URL'):
@@ -124,7 +137,8 @@ def get_or_create_ip_model(user_ip, logger):
 			response = json.loads(raw_response.body)
 			if response['status'] != "success":
 				raise Exception("Creating iprecord failed, server responded: %s" % raw_response)
-			return IpAddress.objects.create(
+			return (yield db_executor.submit(
+				IpAddress.objects.create,
 				ip=user_ip,
 				isp=response['isp'],
 				country=response['country'],
@@ -135,10 +149,10 @@ def get_or_create_ip_model(user_ip, logger):
 				lon=response['lon'],
 				zip=response['zip'],
 				timezone=response['timezone']
-			)
+			))
 		except Exception as e:
 			logger.error("Error while creating ip with country info, because %s", e)
-			return IpAddress.objects.create(ip=user_ip)
+			return (yield db_executor.submit(IpAddress.objects.create, ip=user_ip))
 
 
 def create_id(user_id=0, random=None):
@@ -172,16 +186,32 @@ def update_symbols(files, message):
 		message.symbol = new_symbol
 
 
+def group_images(images):
+	"""
+	:type images: list[chat.models.Image]
+	:return: dict message_id -> list of its images, for MessagesCreator.prepare_img_video
+	"""
+	res = {}
+	for image in images:
+		res.setdefault(image.message_id, []).append(image)
+	return res
+
+
 def get_message_images_videos(messages):
+	"""
+	:return: images of messages grouped by message id, fetched by a single query
+	"""
 	ids = [message.id for message in messages if message.symbol]
 	if ids:
-		images = Image.objects.filter(message_id__in=ids)
+		return group_images(Image.objects.filter(message_id__in=ids))
 	else:
-		images = []
-	return images
+		return {}
 
 
 def up_files_to_img(files, message_id):
+	"""
+	Images take names of uploaded files, so references of media store move with them
+	"""
 	blk_video = {}
 	for f in files:
 		stored_file = blk_video.setdefault(f.symbol, Image(symbol=f.symbol))
@@ -194,3 +224,49 @@ def up_files_to_img(files, message_id):
 	images = Image.objects.bulk_create(dict_values_to_list(blk_video))
 	files.delete()
 	return images
+
+
+def get_search_tokens(content):
+	"""
+	:return: distinct lowercase words of content, cut to MessageSearchToken.token length
+	"""
+	if not content:
+		return []
+	tokens = []
+	for word in SEARCH_TOKEN_REGEX.findall(content.lower()):
+		token = word[:SEARCH_TOKEN_MAX_LENGTH]
+		if token not in tokens:
+			tokens.append(token)
+	return tokens
+
+
+def index_message(message):
+	"""
+	Replaces search tokens of a sent, edited or deleted message
+	:type message: Message
+	"""
+	MessageSearchToken.objects.filter(message_id=message.id).delete()
+	if not message.deleted:
+		MessageSearchToken.objects.bulk_create([
+			MessageSearchToken(token=token, room_id=message.room_id, message_id=message.id)
+			for token in get_search_tokens(message.content)
+		])
+
+
+def find_messages(room_id, search, before_id, count):
+	"""
+	Every word of search should be in message, the last one can be a prefix since user is still typing it
+	:param before_id: id of the last message from previous page or None
+	:return: messages, newest first
+	"""
+	tokens = get_search_tokens(search)
+	if not tokens:
+		return []
+	query = MessageSearchToken.objects.filter(room_id=room_id, token__startswith=tokens[-1])
+	for token in tokens[:-1]:
+		query = query.filter(message_id__in=MessageSearchToken.objects.filter(room_id=room_id, token=token).values('message_id'))
+	if before_id is not None:
+		query = query.filter(message_id__lt=before_id)
+	ids = list(query.order_by('-message_id').values_list('message_id', flat=True).distinct()[:count])
+	return list(Message.objects.filter(id__in=ids).order_by('-id'))
+
@@ -56,13 +56,15 @@ export function getRoomsBaseDict(
       volume,
       notifications,
       name,
-      users
+      users,
+      hasMore
     }: {
       roomId: number;
       volume: number;
       notifications: boolean;
       name: string;
       users: number[];
+      hasMore?: boolean;
     },
     oldRoom: RoomModel|null = null
 ): RoomModel {
@@ -89,7 +91,7 @@ export function getRoomsBaseDict(
     messages: oldRoom ? oldRoom.messages : {},
     newMessagesCount: oldRoom ? oldRoom.newMessagesCount : 0,
     changeOnline: oldRoom ? oldRoom.changeOnline : [],
-    allLoaded: oldRoom ? oldRoom.allLoaded : false,
+    allLoaded: oldRoom && !hasMore ? oldRoom.allLoaded : false,
     search: oldRoom ? oldRoom.search : {
       searchActive: false,
       searchText: '',
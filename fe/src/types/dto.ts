@@ -15,6 +15,7 @@ export interface RoomDto {
   notifications: boolean;
   volume: number;
   roomId: number;
+  hasMore?: boolean; // only the newest missing messages were sent, older ones are loaded on scroll
 }
 
 export interface UserDto {
@@ -34,6 +34,9 @@ export interface ScreenShareData {
 export interface SetWsIdMessage extends DefaultMessage, OpponentWsId {
   rooms:  RoomDto[];
   users: UserDto[];
+  usersVersion: number;
+  usersDelta: boolean;
+  compactKeys?: string[];
   online: number[];
   time: number;
   userImage: string;
@@ -117,7 +120,6 @@ export interface SetProfileImageMessage extends DefaultMessage {
 }
 
 interface ChangeUserOnline extends DefaultMessage, UserDto {
-  content: number[];
   time: number;
 }
 
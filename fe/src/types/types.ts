@@ -226,6 +226,7 @@ export interface RemoveMessageProgress {
 export interface PubSetRooms extends DefaultMessage {
   rooms:  RoomDto[];
   users: UserDto[];
+  usersDelta: boolean;
   online: number[];
 }
 
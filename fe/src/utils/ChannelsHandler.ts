@@ -208,9 +208,9 @@ export default class ChannelsHandler extends MessageHandler {
     this.store.addMessages({messages, roomId: roomId});
   }
 
-  public initUsers(users: UserDto[]) {
-    this.logger.debug('set users {}', users)();
-    const um: UserDictModel = {};
+  public initUsers(users: UserDto[], delta: boolean = false) {
+    this.logger.debug('set users {}, delta {}', users, delta)();
+    const um: UserDictModel = delta ? {...this.store.allUsersDict} : {};
     users.forEach(u => {
       um[u.userId] = convertUser(u);
     });
@@ -231,7 +231,7 @@ export default class ChannelsHandler extends MessageHandler {
 
   public init(m: PubSetRooms) {
     this.store.setOnline([...m.online]);
-    this.initUsers(m.users);
+    this.initUsers(m.users, m.usersDelta);
     this.initRooms(m.rooms);
   }
 
@@ -299,12 +299,12 @@ export default class ChannelsHandler extends MessageHandler {
       this.store.addUser(newVar);
     }
     this.addChangeOnlineEntry(message.userId, message.time, true);
-    this.store.setOnline([...message.content]);
+    this.store.setOnline([...this.store.online.filter(id => id !== message.userId), message.userId]);
   }
 
   private removeOnlineUser(message: RemoveOnlineUserMessage) {
     this.addChangeOnlineEntry(message.userId, message.time, false);
-    this.store.setOnline(message.content);
+    this.store.setOnline(this.store.online.filter(id => id !== message.userId));
   }
 
   private printMessage(inMessage: EditMessage) {
@@ -31,6 +31,7 @@ import {
 } from '@/types/converters';
 import {UserProfileDto, UserSettingsDto} from '@/types/dto';
 import {sub} from '@/utils/sub';
+import {parse} from '@/utils/compactProtocol';
 import {DefaultStore} from '@/utils/store';
 
 enum WsState {
@@ -48,6 +49,7 @@ export default class WsHandler extends MessageHandler {
     setUserProfile: <HandlerType>this.setUserProfile,
     setProfileImage: <HandlerType>this.setProfileImage,
     setWsId: <HandlerType>this.setWsId,
+    resumed: <HandlerType>this.resumed,
     userProfileChanged: <HandlerType>this.userProfileChanged,
     ping: <HandlerType>this.ping,
     pong: this.pong
@@ -65,6 +67,8 @@ export default class WsHandler extends MessageHandler {
   private readonly callBacks: { [id: number]: Function } = {};
 
   private messageId: number = 0;
+  // frames received since setWsId, server replays the rest when connection is resumed
+  private receivedFrames: number = 0;
   private wsState: WsState = WsState.NOT_INITED;
 
   // this.dom = {
@@ -74,6 +78,8 @@ export default class WsHandler extends MessageHandler {
   // };
   // private progressInterval = {}; TODO this was commented along with usage, check if it breaks anything
   private wsConnectionId = '';
+  private usersVersion: number|null = null;
+  private compactKeys: string[]|null = null;
 
   constructor(API_URL: string, sessionHolder: SessionHolder, store: DefaultStore) {
     super();
@@ -331,7 +337,10 @@ public acceptFile(connId: string, received: number) {
   }
 
   private setWsId(message: SetWsIdMessage) {
+    this.receivedFrames = 0;
     this.wsConnectionId = message.opponentWsId;
+    this.usersVersion = message.usersVersion;
+    this.compactKeys = message.compactKeys || null;
     this.setUserInfo(message.userInfo);
     this.setUserSettings(message.userSettings);
     this.setUserImage(message.userImage);
@@ -341,7 +350,8 @@ public acceptFile(connId: string, received: number) {
       handler: 'channels',
       rooms: message.rooms,
       online: message.online,
-      users: message.users
+      users: message.users,
+      usersDelta: message.usersDelta
     };
     sub.notify(pubSetRooms);
     const inetAppear: DefaultMessage = {
@@ -352,6 +362,15 @@ public acceptFile(connId: string, received: number) {
     this.logger.debug('CONNECTION ID HAS BEEN SET TO {})', this.wsConnectionId)();
   }
 
+  private resumed() {
+    const inetAppear: DefaultMessage = {
+      action: 'internetAppear',
+      handler: 'lan'
+    };
+    sub.notify(inetAppear);
+    this.logger.debug('Connection {} has been resumed', this.wsConnectionId)();
+  }
+
   private userProfileChanged(message: UserProfileChangedMessage) {
     const user: UserModel = convertUser(message);
     this.store.setUser(user);
@@ -393,9 +412,10 @@ public acceptFile(connId: string, received: number) {
 
   private onWsMessage(message: MessageEvent) {
     const jsonData = message.data;
+    this.receivedFrames++;
     let data: DefaultMessage;
     try {
-      data = JSON.parse(jsonData);
+      data = parse(jsonData, this.compactKeys);
       this.logData(this.loggerIn, jsonData, data);
     } catch (e) {
       this.logger.error('Unable to parse incomming message {}', jsonData)();
@@ -556,7 +576,13 @@ public acceptFile(connId: string, received: number) {
     if (this.loadHistoryFromWs && this.wsState !== WsState.CONNECTION_IS_LOST) {
       s += '&history=true';
     }
-    s += `&sessionId=${this.sessionHolder.session}`;
+    if (this.wsConnectionId && this.wsState === WsState.CONNECTION_IS_LOST) {
+      s += `&seq=${this.receivedFrames}`;
+    }
+    if (this.usersVersion !== null && Object.keys(this.store.allUsersDict).length > 0) {
+      s += `&usersVersion=${this.usersVersion}`;
+    }
+    s += `&sessionId=${this.sessionHolder.session}&protocol=compact`;
 
     this.ws = new WebSocket(s);
     this.ws.onmessage = this.onWsMessage.bind(this);
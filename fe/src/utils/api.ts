@@ -45,12 +45,16 @@ export default class Api extends MessageHandler {
   public async search(
       data: string,
       room: number,
-      offset: number,
+      before: number|null,
       requestInterceptor?: (a: XMLHttpRequest) => void
   ): Promise<MessageModelDto[]> {
+   const params: {[id: string]: string|number} = {data, room};
+   if (before) {
+     params.before = before;
+   }
    return this.xhr.doPost<MessageModelDto[]>({
       url: '/search_messages',
-      params: {data, room, offset},
+      params,
       isJsonDecoded: true,
       requestInterceptor
     });
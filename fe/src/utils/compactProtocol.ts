@@ -0,0 +1,45 @@
+// Decoder of chat/tornado/compact_protocol.py
+// Keys are codes of keys table, unknown keys start with '$'.
+// Values of action and handler of the message itself (not of nested objects) are indexes of the same table,
+// such values that are not in the table come under escaped key.
+
+export const COMPACT_PREFIX = 'c';
+const ESCAPE = '$';
+const CODED_VALUES = ['action', 'handler'];
+
+export function isCompact(data: string): boolean {
+  return data.charAt(0) === COMPACT_PREFIX;
+}
+
+export function expand(data: any, keys: string[], top: boolean = true): any {
+  if (Array.isArray(data)) {
+    return data.map(v => expand(v, keys, false));
+  } else if (data !== null && typeof data === 'object') {
+    const res: {[key: string]: any} = {};
+    for (const code in data) {
+      let value = data[code];
+      let key: string;
+      if (code.charAt(0) === ESCAPE) {
+        key = code.substr(1);
+      } else {
+        key = keys[parseInt(code, 36)];
+        if (top && CODED_VALUES.indexOf(key) >= 0) {
+          value = keys[value];
+        }
+      }
+      res[key] = expand(value, keys, false);
+    }
+
+    return res;
+  }
+
+  return data;
+}
+
+export function parse(data: string, keys: string[]|null): any {
+  if (keys && isCompact(data)) {
+    return expand(JSON.parse(data.substr(COMPACT_PREFIX.length)), keys);
+  }
+
+  return JSON.parse(data);
+}
@@ -185,7 +185,9 @@ function encodeFiles(html: string, files: { [id: string]: FileModel } | null) {
     html = html.replace(imageUnicodeRegex, (s) => {
       const v = files[s];
       if (v) {
-        if (v.type === 'i') {
+        if (v.type === 'i' && v.preview) {
+          return `<img src='${resolveMediaUrl(v.preview)}' associatedImage='${v.url}' imageId='${v.id}' symbol='${s}' class='${PASTED_IMG_CLASS}'/>`;
+        } else if (v.type === 'i') {
           return `<img src='${resolveMediaUrl(v.url!)}' imageId='${v.id}' symbol='${s}' class='${PASTED_IMG_CLASS}'/>`;
         } else if (v.type === 'v' || v.type === 'm') {
           const className = v.type === 'v' ? 'video-player' : 'video-player video-record';
@@ -256,6 +258,19 @@ export function setVideoEvent(e: HTMLElement) {
   });
 }
 
+export function setImageEvent(e: HTMLElement) {
+  const r: NodeListOf<HTMLElement> = e.querySelectorAll('[associatedImage]');
+  forEach<HTMLElement>(r, (e: HTMLElement) => {
+    e.onclick = function (event) {
+      const url: string = resolveMediaUrl(e.getAttribute('associatedImage')!);
+      logger.debug('Loading original image {}', url)();
+      e.removeAttribute('associatedImage');
+      e.onclick = null;
+      (<HTMLImageElement>e).src = url;
+    };
+  });
+}
+
 export function setAudioEvent(e: HTMLElement) {
   const r: NodeListOf<HTMLElement> = e.querySelectorAll('.audio-record');
   forEach<HTMLElement>(r, (e: HTMLElement) => {